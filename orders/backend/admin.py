@@ -3,7 +3,9 @@ from django.contrib.auth.admin import UserAdmin
 from django.utils.translation import ugettext_lazy as _
 
 from .models import User, Shop, Category, Product, ProductInfo,\
-    ProductParameter, Order, OrderItem, Contact
+    ProductParameter, Order, OrderItem, Contact, OrderChange, ShopOrderLine,\
+    OrderStateChange, STATE_CHOICES
+from .notifications import notify_order_state_changes
 
 class ContactInline(admin.TabularInline):
     model = Contact
@@ -25,6 +27,31 @@ class ProductParameterInline(admin.TabularInline):
     extra = 1
 
 
+class OrderStateChangeInline(admin.TabularInline):
+    model = OrderStateChange
+    fields = ('from_state', 'to_state', 'changed_by', 'created_at')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+def make_transition_action(state, label):
+    """
+    Действие админки для пакетной смены статуса выбранных заказов
+    """
+    def transition_action(modeladmin, request, queryset):
+        changes = queryset.transition(state, user=request.user,
+                                      notify=notify_order_state_changes)
+        modeladmin.message_user(request, f'Обновлено заказов: {len(changes)}')
+
+    transition_action.__name__ = f'make_{state}'
+    transition_action.short_description = f'Перевести в статус «{label}»'
+    return transition_action
+
+
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
     model = User
@@ -68,10 +95,29 @@ class Order(admin.ModelAdmin):
     model = Order
     fields = ('user', 'state', 'contact')
     list_display = ('user', 'dt', 'state')
+    list_filter = ('state',)
     ordering = ('dt',)
     inlines = [
         OrderItemInline,
+        OrderStateChangeInline,
     ]
+    actions = [make_transition_action(state, label)
+               for state, label in STATE_CHOICES
+               if state not in ('basket', 'new')]
+
+    def get_readonly_fields(self, request, obj=None):
+        # статус существующего заказа меняется только через действия
+        if obj:
+            return ('state',)
+        return ()
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        if form.instance.state != 'basket':
+            # разносятся только добавленные позиции, цены разнесённых
+            # не меняются
+            ShopOrderLine.objects.fan_out([form.instance.id])
+            OrderChange.objects.log_changes([form.instance.id])
 
 
 
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class BackendConfig(AppConfig):
     name = 'backend'
     verbose_name = 'Бэкэнд'
+
+    def ready(self):
+        from . import signals, database, prometheus, slow_queries
@@ -0,0 +1,198 @@
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from .models import User
+from .prometheus import CACHE_REQUESTS
+
+# Снимки пользователей по ключу токена хранятся в общем кэше
+# AUTH_TOKEN_CACHE (AUTH_TOKEN_CACHE_TTL секунд) и в локальном LRU процесса
+# (AUTH_TOKEN_LOCAL_CACHE_SIZE записей, AUTH_TOKEN_LOCAL_TTL секунд).
+# Пароль в снимок не попадает и при обращении загружается из базы.
+# Сброс снимков токена оставляет в общем кэше отметку об отзыве этого ключа
+# и меняет версию отзыва. Процесс сверяет версии не чаще раза
+# в AUTH_TOKEN_REVOCATION_CHECK секунд и при смене версии удаляет
+# из локального LRU только отозванные ключи. Поколение меняется при сбросе
+# всех снимков (invalidate_all_tokens) и входит в ключи общего кэша
+
+SNAPSHOT_FIELDS = tuple(field.attname for field in User._meta.concrete_fields
+                        if field.attname != 'password')
+
+REVOKED_KEY = 'auth:token-revoked'
+GENERATION_KEY = 'auth:token-generation'
+
+_local_lock = threading.Lock()
+_local = OrderedDict()
+# Время последней сверки с общим кэшем и версии, полученные при ней
+_synced = {'at': None, 'versions': None}
+
+
+def _cache_key(generation, key):
+    return f'auth:token:{generation}:{key}'
+
+
+def _revoked_key(key):
+    return f'auth:token-revoked:{key}'
+
+
+def get_versions(cache):
+    """
+    (версия отзыва, поколение) из общего кэша одним запросом.
+    Версия, вытесненная из кэша, заменяется новой случайной
+    """
+    keys = (REVOKED_KEY, GENERATION_KEY)
+    versions = cache.get_many(keys)
+    if len(versions) < len(keys):
+        for key in keys:
+            if key not in versions:
+                cache.add(key, uuid4().hex, None)
+        versions = cache.get_many(keys)
+    return versions[REVOKED_KEY], versions[GENERATION_KEY]
+
+
+def sync_local(cache):
+    """
+    Сверяет локальные снимки с общим кэшем, если с прошлой сверки прошло
+    AUTH_TOKEN_REVOCATION_CHECK секунд. Возвращает текущее поколение
+    """
+    with _local_lock:
+        synced_at, versions = _synced['at'], _synced['versions']
+    if synced_at is not None and time.monotonic() - synced_at < \
+            settings.AUTH_TOKEN_REVOCATION_CHECK:
+        return versions[1]
+    current = get_versions(cache)
+    revoked = {}
+    if versions is not None and current[1] == versions[1] \
+            and current[0] != versions[0]:
+        with _local_lock:
+            markers = {_revoked_key(key): key for key in _local}
+        revoked = cache.get_many(list(markers))
+    with _local_lock:
+        if versions is None or current[1] != versions[1]:
+            _local.clear()
+        for marker in revoked:
+            _local.pop(markers[marker], None)
+        _synced.update(at=time.monotonic(), versions=current)
+    return current[1]
+
+
+def _local_get(key):
+    with _local_lock:
+        entry = _local.get(key)
+        if entry is None:
+            return None
+        expires, snapshot = entry
+        if expires < time.monotonic():
+            del _local[key]
+            return None
+        _local.move_to_end(key)
+        return snapshot
+
+
+def _local_set(key, snapshot):
+    with _local_lock:
+        _local[key] = (time.monotonic() + settings.AUTH_TOKEN_LOCAL_TTL,
+                       snapshot)
+        _local.move_to_end(key)
+        while len(_local) > settings.AUTH_TOKEN_LOCAL_CACHE_SIZE:
+            _local.popitem(last=False)
+
+
+def get_user_snapshot(key):
+    """
+    Значения полей пользователя по ключу токена из кэша или из базы.
+    Снимки неактивных пользователей не кэшируются
+    """
+    cache = caches[settings.AUTH_TOKEN_CACHE]
+    generation = sync_local(cache)
+    snapshot = _local_get(key)
+    if snapshot is not None:
+        CACHE_REQUESTS.labels('auth_token', 'local').inc()
+        return snapshot
+    snapshot = cache.get(_cache_key(generation, key))
+    if snapshot is not None:
+        CACHE_REQUESTS.labels('auth_token', 'shared').inc()
+    else:
+        CACHE_REQUESTS.labels('auth_token', 'miss').inc()
+        snapshot = User.objects.filter(
+            auth_token__key=key).values_list(*SNAPSHOT_FIELDS).first()
+        if snapshot is None or not snapshot[
+                SNAPSHOT_FIELDS.index('is_active')]:
+            return snapshot
+        cache.set(_cache_key(generation, key), snapshot,
+                  settings.AUTH_TOKEN_CACHE_TTL)
+    _local_set(key, snapshot)
+    return snapshot
+
+
+def invalidate_tokens(keys):
+    """
+    Удаляет снимки пользователей по ключам токенов из общего кэша
+    и отзывает эти ключи в локальных снимках всех процессов.
+    Повторно удаляет их после фиксации транзакции, чтобы параллельный
+    запрос не успел закэшировать старые данные
+    """
+    keys = list(keys)
+    if not keys:
+        return
+
+    def invalidate():
+        with _local_lock:
+            for key in keys:
+                _local.pop(key, None)
+        cache = caches[settings.AUTH_TOKEN_CACHE]
+        _, generation = get_versions(cache)
+        cache.delete_many([_cache_key(generation, key) for key in keys])
+        # локальный снимок старше отметки истекает сам
+        cache.set_many({_revoked_key(key): True for key in keys},
+                       settings.AUTH_TOKEN_LOCAL_TTL)
+        cache.set(REVOKED_KEY, uuid4().hex, None)
+
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+def invalidate_all_tokens():
+    """
+    Сбрасывает все снимки во всех процессах. Вызывается после изменений,
+    которые не вызывают сигналов: User.objects.filter(...).update(
+    is_active=False) и т.п.
+    """
+    def invalidate():
+        caches[settings.AUTH_TOKEN_CACHE].set_many(
+            {REVOKED_KEY: uuid4().hex, GENERATION_KEY: uuid4().hex}, None)
+        with _local_lock:
+            _local.clear()
+            _synced.update(at=None, versions=None)
+
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Аутентификация по токену без запроса к базе при попадании в кэш.
+    Кэш сбрасывается при сохранении пользователя (блокировка, смена пароля)
+    и удалении токена, в том числе массовом, см. backend.signals.
+    QuerySet.update() сигналов не вызывает: после него нужно вызвать
+    invalidate_all_tokens()
+    """
+
+    def authenticate_credentials(self, key):
+        snapshot = get_user_snapshot(key)
+        if snapshot is None:
+            raise AuthenticationFailed(_('Invalid token.'))
+        user = User.from_db('default', SNAPSHOT_FIELDS, snapshot)
+        if not user.is_active:
+            raise AuthenticationFailed(_('User inactive or deleted.'))
+        return user, Token(key=key, user=user)
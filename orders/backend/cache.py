@@ -0,0 +1,99 @@
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction, DEFAULT_DB_ALIAS
+
+from rest_framework.response import Response
+
+from .models import Shop
+from .prometheus import CACHE_REQUESTS
+
+# Кэш списков каталога (категории, магазины) в CATALOG_CACHE.
+# Ключ ответа включает версию списка. Изменение данных (импорт,
+# PartnerState.post, сохранение и удаление категорий и магазинов,
+# в том числе в админке - см. backend.signals) заменяет версию новой
+# случайной, и старые ответы больше не читаются, а вытесняются
+# по CATALOG_CACHE_TIMEOUT.
+# Там же - множество активных магазинов для поиска товаров: версия
+# общая со списком магазинов. Попадания и промахи считаются
+# в метрике cache_requests_total{cache="catalog"}
+
+CATEGORIES = 'categories'
+SHOPS = 'shops'
+
+
+def get_cache():
+    return caches[settings.CATALOG_CACHE]
+
+
+def version_key(name):
+    return f'catalog-version:{name}'
+
+
+def get_version(name):
+    cache = get_cache()
+    version = cache.get(version_key(name))
+    if version is None:
+        # версия, вытесненная из кэша, не должна повторить прежнюю
+        cache.add(version_key(name), uuid4().hex, None)
+        version = cache.get(version_key(name))
+    return version
+
+
+def invalidate(*names):
+    """
+    Сбрасывает списки names сразу и ещё раз после фиксации транзакции,
+    чтобы параллельный запрос не закэшировал старые данные
+    """
+    def bump():
+        get_cache().set_many(
+            {version_key(name): uuid4().hex for name in names}, None)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def get_active_shop_ids():
+    """
+    id магазинов, принимающих заказы (Shop.state)
+    """
+    key = f'catalog:active-shops:{get_version(SHOPS)}'
+    cache = get_cache()
+    shop_ids = cache.get(key)
+    if shop_ids is not None:
+        CACHE_REQUESTS.labels('catalog', 'hit').inc()
+    else:
+        CACHE_REQUESTS.labels('catalog', 'miss').inc()
+        # с основной базы, как и списки каталога
+        shop_ids = frozenset(Shop.objects.using(DEFAULT_DB_ALIAS).filter(
+            state=True).values_list('id', flat=True))
+        cache.set(key, shop_ids, settings.CATALOG_CACHE_TIMEOUT)
+    return shop_ids
+
+
+class CachedListMixin:
+    """
+    Ответ ListAPIView из кэша списка cache_name.
+    Ключ учитывает параметры запроса (страницу) и хост ссылок пагинации
+    """
+    cache_name = None
+
+    def get_queryset(self):
+        # кэш заполняется с основной базы: реплика может ещё не получить
+        # изменение, сбросившее версию, и старые данные остались бы в кэше
+        return super().get_queryset().using(DEFAULT_DB_ALIAS)
+
+    def list(self, request, *args, **kwargs):
+        key = 'catalog:{}:{}:{}:{}'.format(
+            self.cache_name, get_version(self.cache_name),
+            request.get_host(), request.query_params.urlencode())
+        cache = get_cache()
+        data = cache.get(key)
+        if data is not None:
+            CACHE_REQUESTS.labels('catalog', 'hit').inc()
+        else:
+            CACHE_REQUESTS.labels('catalog', 'miss').inc()
+            data = super().list(request, *args, **kwargs).data
+            cache.set(key, data, settings.CATALOG_CACHE_TIMEOUT)
+        return Response(data)
@@ -0,0 +1,45 @@
+from celery.signals import task_prerun
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Настройка соединений с базой (профили DATABASES см. в settings):
+# прагмы SQLite при открытии соединения и проверка постоянных
+# соединений (CONN_MAX_AGE) перед запросом и задачей Celery.
+# Запросы выполняются курсором драйвера, минуя execute_wrapper,
+# и не попадают в метрики запросов
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    for name, value in settings.SQLITE_PRAGMAS.items():
+        connection.connection.execute(f'PRAGMA {name} = {value}')
+
+
+def check_connections():
+    """
+    Закрывает постоянные соединения, которые больше не отвечают
+    (перезапуск базы или PgBouncer), - следующий запрос откроет новое
+    """
+    if not settings.DB_HEALTH_CHECKS:
+        return
+    for connection in connections.all():
+        if (connection.connection is not None
+                and not connection.in_atomic_block
+                and not connection.is_usable()):
+            connection.close()
+
+
+@receiver(request_started)
+def check_request_connections(**kwargs):
+    check_connections()
+
+
+@task_prerun.connect
+def check_task_connections(**kwargs):
+    check_connections()
@@ -0,0 +1,210 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+from itertools import islice
+from tempfile import TemporaryFile
+
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+
+from yaml import dump as dump_yaml
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .models import Category, ProductInfo, ProductParameter, ShopOrderLine
+
+# Выгрузка каталога магазина в формате прайса do_import (yaml),
+# а также в csv и jsonl. Товары и их параметры читаются двумя
+# упорядоченными по id курсорами порциями по EXPORT_CHUNK_SIZE строк
+# и сливаются по ходу чтения, поэтому память не зависит
+# от размера каталога. Выгрузки читают из подключения EXPORT_DATABASE,
+# где в PostgreSQL доступны серверные курсоры
+
+GOODS_COLUMNS = ('id', 'category', 'model', 'name', 'price', 'price_rrc',
+                 'quantity')
+
+
+class Echo:
+    """
+    Псевдофайл для csv.writer: возвращает записанную строку
+    """
+    def write(self, value):
+        return value
+
+
+def catalog_goods(shop_id, chunk_size=None):
+    """
+    Товары магазина в виде словарей со схемой прайса do_import
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    infos = ProductInfo.objects.using(settings.EXPORT_DATABASE).filter(
+        shop_id=shop_id
+    ).order_by('id').values_list(
+        'id', 'external_id', 'product__category_id', 'model',
+        'product__name', 'price', 'price_rrc', 'quantity'
+    ).iterator(chunk_size=chunk_size)
+    parameters = ProductParameter.objects.using(
+        settings.EXPORT_DATABASE
+    ).filter(
+        product_info__shop_id=shop_id
+    ).order_by('product_info_id', 'id').values_list(
+        'product_info_id', 'parameter__name', 'value'
+    ).iterator(chunk_size=chunk_size)
+
+    parameter = next(parameters, None)
+    for info_id, *fields in infos:
+        good = dict(zip(GOODS_COLUMNS, fields))
+        good['parameters'] = {}
+        while parameter is not None and parameter[0] <= info_id:
+            if parameter[0] == info_id:
+                good['parameters'][parameter[1]] = parameter[2]
+            parameter = next(parameters, None)
+        yield good
+
+
+def export_yaml(shop, goods):
+    yield dump_yaml({'shop': shop.name}, allow_unicode=True)
+    categories = Category.objects.using(settings.EXPORT_DATABASE).filter(
+        shops=shop).order_by('id').values('id', 'name')
+    yield dump_yaml({'categories': list(categories)}, allow_unicode=True,
+                    sort_keys=False, default_flow_style=False)
+    yield 'goods:\n'
+    for good in goods:
+        yield dump_yaml([good], allow_unicode=True, sort_keys=False,
+                        default_flow_style=False)
+
+
+def export_csv(shop, goods):
+    writer = csv.writer(Echo())
+    yield writer.writerow(GOODS_COLUMNS + ('parameters',))
+    for good in goods:
+        parameters = json.dumps(good.pop('parameters'), ensure_ascii=False)
+        yield writer.writerow(tuple(good.values()) + (parameters,))
+
+
+def export_jsonl(shop, goods):
+    for good in goods:
+        yield json.dumps(good, ensure_ascii=False) + '\n'
+
+
+# формат: (content type, функция выгрузки)
+CATALOG_FORMATS = {
+    'yaml': ('application/x-yaml', export_yaml),
+    'csv': ('text/csv', export_csv),
+    'jsonl': ('application/x-ndjson', export_jsonl),
+}
+
+
+def export_catalog(shop, file_format, chunk_size=None):
+    """
+    Генератор фрагментов выгрузки каталога магазина в формате file_format
+    """
+    _, export = CATALOG_FORMATS[file_format]
+    return export(shop, catalog_goods(shop.id, chunk_size))
+
+
+def write_text(chunks):
+    """
+    Функция записи текстовых фрагментов выгрузки в бинарный файл
+    """
+    def write(file):
+        for chunk in chunks:
+            file.write(chunk.encode())
+    return write
+
+
+def save_export(job, write):
+    """
+    Формирует выгрузку во временном файле и сохраняет его в хранилище
+    как файл выгрузки job. write(file) записывает выгрузку в файл
+    """
+    with TemporaryFile() as tmp:
+        write(tmp)
+        tmp.seek(0)
+        job.file.save(f'{job.kind}-{job.id}.{job.file_format}', File(tmp),
+                      save=False)
+    job.state = 'done'
+    job.finished_at = timezone.now()
+    job.save()
+
+
+# Выгрузка заказов для бухгалтерии: по строке на позицию заказа
+# магазина (ShopOrderLine) за период. Строки читаются кортежами
+# values_list порциями по EXPORT_CHUNK_SIZE и сразу пишутся в файл
+
+# (колонка, поле, тип колонки в parquet)
+ORDER_EXPORT_COLUMNS = (
+    ('order_id', 'order_id', 'int64'),
+    ('dt', 'order__dt', 'timestamp'),
+    ('state', 'order__state', 'string'),
+    ('user_id', 'order__user_id', 'int64'),
+    ('email', 'order__user__email', 'string'),
+    ('city', 'order__contact__city', 'string'),
+    ('phone', 'order__contact__phone', 'string'),
+    ('shop_id', 'shop_id', 'int64'),
+    ('shop', 'shop__name', 'string'),
+    ('external_id', 'external_id', 'int64'),
+    ('product', 'product_name', 'string'),
+    ('quantity', 'quantity', 'int64'),
+    ('price', 'price', 'int64'),
+)
+
+
+def order_rows(date_from, date_to, shop_id=None, chunk_size=None):
+    """
+    Позиции заказов, оформленных с date_from по date_to включительно
+    """
+    lines = ShopOrderLine.objects.using(settings.EXPORT_DATABASE).filter(
+        order__dt__gte=timezone.make_aware(
+            datetime.combine(date_from, time.min)),
+        order__dt__lt=timezone.make_aware(
+            datetime.combine(date_to + timedelta(days=1), time.min)),
+    ).exclude(order__state='basket')
+    if shop_id is not None:
+        lines = lines.filter(shop_id=shop_id)
+    return lines.order_by('order_id', 'id').values_list(
+        *(field for _, field, _ in ORDER_EXPORT_COLUMNS)
+    ).iterator(chunk_size=chunk_size or settings.EXPORT_CHUNK_SIZE)
+
+
+def export_orders_csv(rows):
+    def chunks():
+        writer = csv.writer(Echo())
+        yield writer.writerow(
+            [column for column, _, _ in ORDER_EXPORT_COLUMNS])
+        for row in rows:
+            yield writer.writerow(row)
+    return write_text(chunks())
+
+
+def export_orders_parquet(rows):
+    def write(file):
+        types = {'int64': pyarrow.int64(), 'string': pyarrow.string(),
+                 'timestamp': pyarrow.timestamp('us', tz='UTC')}
+        schema = pyarrow.schema([(column, types[kind]) for column, _, kind
+                                 in ORDER_EXPORT_COLUMNS])
+        writer = pyarrow.parquet.ParquetWriter(file, schema)
+        try:
+            # одна порция строк - одна группа строк parquet
+            while True:
+                batch = list(islice(rows, settings.EXPORT_CHUNK_SIZE))
+                if not batch:
+                    break
+                writer.write_table(pyarrow.Table.from_arrays(
+                    [pyarrow.array(values, type=field.type)
+                     for values, field in zip(zip(*batch), schema)],
+                    schema=schema))
+        finally:
+            writer.close()
+    return write
+
+
+# формат: функция записи; parquet доступен при установленном pyarrow
+ORDER_EXPORT_FORMATS = {'csv': export_orders_csv}
+if pyarrow is not None:
+    ORDER_EXPORT_FORMATS['parquet'] = export_orders_parquet
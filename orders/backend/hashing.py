@@ -0,0 +1,106 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, \
+    Argon2PasswordHasher, BCryptSHA256PasswordHasher
+
+# Хеширование паролей выполняется в ограниченном пуле потоков процесса:
+# одновременно хешируется не больше PASSWORD_HASHING_WORKERS паролей,
+# ещё PASSWORD_HASHING_QUEUE запросов ждут своей очереди не дольше
+# PASSWORD_HASHING_TIMEOUT секунд. Остальные сразу получают отказ
+# (HashingBusy, ответ 503 в PasswordHashingBusyMiddleware), и всплеск
+# логинов не выстраивает в очередь все потоки веб-сервера
+
+_pool_lock = threading.Lock()
+_pool = None
+_worker = threading.local()
+
+
+class HashingBusy(Exception):
+    """
+    Пул хеширования паролей перегружен
+    """
+
+
+class HashingPool:
+    def __init__(self, workers, queue, timeout):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='password-hashing')
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.timeout = timeout
+
+    def run(self, func, *args, **kwargs):
+        """
+        Выполняет func(*args, **kwargs) в пуле и возвращает результат.
+        Вызовы из потоков пула (verify() вызывает encode())
+        выполняются сразу
+        """
+        if getattr(_worker, 'active', False):
+            return func(*args, **kwargs)
+        if not self.slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self.executor.submit(self._call, func, args, kwargs)
+        except RuntimeError:
+            self.slots.release()
+            raise
+        # место освобождается, когда хеш вычислен, даже если
+        # запрос перестал ждать результат
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HashingBusy()
+
+    @staticmethod
+    def _call(func, args, kwargs):
+        _worker.active = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _worker.active = False
+
+
+def get_hashing_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = HashingPool(settings.PASSWORD_HASHING_WORKERS,
+                                settings.PASSWORD_HASHING_QUEUE,
+                                settings.PASSWORD_HASHING_TIMEOUT)
+        return _pool
+
+
+class PooledHasherMixin:
+    """
+    Хешер, вычисляющий и проверяющий хеши в пуле хеширования
+    """
+
+    def encode(self, password, salt, *args, **kwargs):
+        return get_hashing_pool().run(super().encode, password, salt,
+                                      *args, **kwargs)
+
+    def verify(self, password, encoded):
+        return get_hashing_pool().run(super().verify, password, encoded)
+
+
+# Хешеры с параметрами из настроек. Имена алгоритмов не меняются,
+# поэтому ранее сохранённые хеши проверяются, а при смене параметров
+# пересчитываются при следующем входе пользователя
+
+class PooledPBKDF2PasswordHasher(PooledHasherMixin, PBKDF2PasswordHasher):
+    iterations = (settings.PBKDF2_ITERATIONS
+                  or PBKDF2PasswordHasher.iterations)
+
+
+class PooledArgon2PasswordHasher(PooledHasherMixin, Argon2PasswordHasher):
+    time_cost = settings.ARGON2_TIME_COST
+    memory_cost = settings.ARGON2_MEMORY_COST
+    parallelism = settings.ARGON2_PARALLELISM
+
+
+class PooledBCryptSHA256PasswordHasher(PooledHasherMixin,
+                                       BCryptSHA256PasswordHasher):
+    rounds = settings.BCRYPT_ROUNDS
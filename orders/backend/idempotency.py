@@ -0,0 +1,80 @@
+from functools import wraps
+from hashlib import sha256
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, JsonResponse
+
+from rest_framework.response import Response
+
+from .prometheus import CACHE_REQUESTS
+
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+KEY_TOO_LONG_STATUS = {'Status': False,
+                       'Errors': 'Слишком длинный Idempotency-Key'}
+IN_PROGRESS_STATUS = {'Status': False,
+                      'Errors': 'Запрос с этим Idempotency-Key '
+                                'ещё выполняется'}
+KEY_REUSED_STATUS = {'Status': False,
+                     'Errors': 'Idempotency-Key уже использован '
+                               'для другого запроса'}
+
+
+def idempotent(view_method):
+    """
+    Декоратор метода APIView для запросов с заголовком Idempotency-Key.
+    Ответ на первый запрос сохраняется в кэше на IDEMPOTENCY_TTL секунд,
+    повтор с тем же ключом и телом получает сохранённый ответ
+    без повторного выполнения метода
+    """
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.META.get(IDEMPOTENCY_HEADER)
+        if not key or not request.user.is_authenticated:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > 255:
+            return JsonResponse(KEY_TOO_LONG_STATUS, status=400)
+
+        cache = caches[settings.IDEMPOTENCY_CACHE]
+        cache_key = 'idempotency:' + sha256(
+            f'{request.user.id}:{request.method}:{request.path}:{key}'.encode()
+        ).hexdigest()
+        fingerprint = sha256(request.body).hexdigest()
+
+        # ключ занимается атомарно, чтобы параллельные повторы
+        # не выполнили запрос дважды
+        if cache.add(cache_key, {'fingerprint': fingerprint},
+                     settings.IDEMPOTENCY_LOCK_TIMEOUT):
+            CACHE_REQUESTS.labels('idempotency', 'miss').inc()
+            try:
+                response = view_method(self, request, *args, **kwargs)
+            except Exception:
+                cache.delete(cache_key)
+                raise
+            if (isinstance(response, Response) or response.streaming
+                    or response.status_code >= 500):
+                cache.delete(cache_key)
+            else:
+                cache.set(cache_key, {
+                    'fingerprint': fingerprint,
+                    'status': response.status_code,
+                    'content_type': response['Content-Type'],
+                    'content': response.content,
+                }, settings.IDEMPOTENCY_TTL)
+            return response
+
+        stored = cache.get(cache_key)
+        if stored is None or 'status' not in stored:
+            return JsonResponse(IN_PROGRESS_STATUS, status=409)
+        if stored['fingerprint'] != fingerprint:
+            return JsonResponse(KEY_REUSED_STATUS, status=422)
+        CACHE_REQUESTS.labels('idempotency', 'replay').inc()
+        response = HttpResponse(stored['content'], status=stored['status'],
+                                content_type=stored['content_type'])
+        response[REPLAYED_HEADER] = 'true'
+        return response
+
+    return wrapper
@@ -0,0 +1,104 @@
+import csv
+from collections import namedtuple
+from itertools import groupby
+from operator import itemgetter
+
+from django.utils.html import escape
+
+from .models import ShopOrderLine
+
+# Накладные строятся по позициям заказов в разрезе магазинов
+# (ShopOrderLine) одним запросом; строки читаются порциями и
+# группируются в накладные по ходу чтения, поэтому в памяти
+# одновременно находится только одна накладная
+
+INVOICE_COLUMNS = (
+    'order_id', 'shop_id', 'shop__name', 'order__dt', 'order__user__email',
+    'order__contact__city', 'order__contact__street',
+    'order__contact__house', 'order__contact__building',
+    'order__contact__apartment', 'order__contact__phone',
+    'product_name', 'model', 'external_id', 'quantity', 'price',
+)
+
+LINE_HEADER = ('№', 'Товар', 'Модель', 'Артикул', 'Количество', 'Цена',
+               'Сумма')
+
+InvoiceLine = namedtuple('InvoiceLine', 'name model external_id quantity '
+                                        'price')
+
+
+class Invoice(namedtuple('Invoice', 'order_id shop_id shop dt email '
+                                    'contact lines')):
+    """
+    Накладная магазина по одному заказу
+    """
+
+    @property
+    def total(self):
+        return sum(line.quantity * line.price for line in self.lines)
+
+    @property
+    def filename(self):
+        return f'invoice-{self.order_id}-{self.shop_id}'
+
+
+def invoice_rows(order_ids, chunk_size=2000):
+    """
+    Строки накладных по указанным заказам, упорядоченные
+    по заказу и магазину. Читаются с сервера порциями
+    """
+    return ShopOrderLine.objects.filter(
+        order_id__in=order_ids
+    ).order_by(
+        'order_id', 'shop_id', 'id'
+    ).values_list(*INVOICE_COLUMNS).iterator(chunk_size=chunk_size)
+
+
+def group_invoices(rows):
+    """
+    Собирает накладные из упорядоченного потока строк INVOICE_COLUMNS
+    """
+    for (order_id, shop_id), lines in groupby(rows, key=itemgetter(0, 1)):
+        lines = list(lines)
+        first = lines[0]
+        contact = ', '.join(part for part in first[5:11] if part)
+        yield Invoice(order_id, shop_id, first[2], first[3], first[4],
+                      contact, [InvoiceLine(*line[11:16]) for line in lines])
+
+
+def render_csv(invoice, out):
+    """
+    Записывает накладную в формате CSV в файлоподобный объект
+    """
+    writer = csv.writer(out)
+    writer.writerow(('Накладная', f'Заказ №{invoice.order_id}', invoice.shop))
+    writer.writerow(('Дата', invoice.dt.strftime('%d.%m.%Y %H:%M')))
+    writer.writerow(('Покупатель', invoice.email, invoice.contact))
+    writer.writerow(LINE_HEADER)
+    for number, line in enumerate(invoice.lines, 1):
+        writer.writerow((number, line.name, line.model, line.external_id,
+                         line.quantity, line.price,
+                         line.quantity * line.price))
+    writer.writerow(('Итого', '', '', '', '', '', invoice.total))
+
+
+def render_html(invoice, out):
+    """
+    Записывает накладную в формате HTML в файлоподобный объект
+    """
+    out.write('<html><head><meta charset="utf-8"></head><body>')
+    out.write(f'<h1>Накладная по заказу №{invoice.order_id}</h1>'
+              f'<p>Магазин: {escape(invoice.shop)}</p>'
+              f'<p>Дата: {invoice.dt.strftime("%d.%m.%Y %H:%M")}</p>'
+              f'<p>Покупатель: {escape(invoice.email)}, '
+              f'{escape(invoice.contact)}</p>')
+    out.write('<table border="1"><tr>')
+    out.write(''.join(f'<th>{title}</th>' for title in LINE_HEADER))
+    out.write('</tr>')
+    for number, line in enumerate(invoice.lines, 1):
+        out.write(f'<tr><td>{number}</td><td>{escape(line.name)}</td>'
+                  f'<td>{escape(line.model)}</td><td>{line.external_id}</td>'
+                  f'<td>{line.quantity}</td><td>{line.price}</td>'
+                  f'<td>{line.quantity * line.price}</td></tr>')
+    out.write(f'<tr><th colspan="6">Итого</th><th>{invoice.total}</th></tr>'
+              f'</table></body></html>')
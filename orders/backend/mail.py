@@ -0,0 +1,132 @@
+import smtplib
+import threading
+import time
+
+from celery.signals import worker_init, worker_process_shutdown
+from celery.utils.time import rate
+from kombu.utils.limits import TokenBucket
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.mail.backends.smtp import EmailBackend as SMTPBackend
+
+from .prometheus import SMTP_LATENCY, SMTP_MESSAGES
+
+
+# Соединение с SMTP-сервером держится отдельно в каждом потоке воркера
+
+_pool = threading.local()
+
+# Ограничение частоты отправки писем: token bucket в памяти процесса,
+# общий для его потоков. Квота EMAIL_RATE_LIMIT делится поровну между
+# процессами воркера, разбирающего очередь email (-c 1 - весь лимит
+# у одного процесса). Очередь email должен разбирать один воркер,
+# иначе суммарная частота превысит квоту почтового провайдера
+
+_rate_lock = threading.Lock()
+_buckets = {}
+_processes = 1
+
+
+def get_pooled_connection():
+    """
+    Возвращает открытое соединение с почтовым сервером, общее для всех
+    задач потока. Соединение открывается один раз и переиспользуется;
+    если оно простаивало дольше EMAIL_KEEPALIVE секунд, перед отправкой
+    проверяется командой NOOP и при необходимости открывается заново
+    """
+    connection = getattr(_pool, 'connection', None)
+    if connection is None:
+        connection = get_connection(fail_silently=False)
+        _pool.connection = connection
+        _pool.checked_at = 0
+    if not isinstance(connection, SMTPBackend):
+        return connection
+
+    now = time.monotonic()
+    if connection.connection is None:
+        connection.open()
+    elif now - _pool.checked_at > settings.EMAIL_KEEPALIVE:
+        try:
+            status = connection.connection.noop()[0]
+        except (smtplib.SMTPException, OSError):
+            status = None
+        if status != 250:
+            close_pooled_connection()
+            return get_pooled_connection()
+    _pool.checked_at = now
+    return connection
+
+
+def close_pooled_connection():
+    """
+    Закрывает соединение потока с почтовым сервером
+    """
+    connection = getattr(_pool, 'connection', None)
+    if connection is not None:
+        connection.close()
+        _pool.connection = None
+
+
+def wait_for_quota(count):
+    """
+    Ждёт, пока доля процесса в лимите EMAIL_RATE_LIMIT (например, '60/m')
+    позволит отправить count писем. Допускается всплеск до
+    EMAIL_RATE_BURST писем. Ожидание не блокирует другие потоки
+    """
+    if not settings.EMAIL_RATE_LIMIT:
+        return
+    key = (settings.EMAIL_RATE_LIMIT, settings.EMAIL_RATE_BURST, _processes)
+    for _ in range(count):
+        while True:
+            with _rate_lock:
+                bucket = _buckets.get(key)
+                if bucket is None:
+                    bucket = _buckets[key] = TokenBucket(
+                        rate(settings.EMAIL_RATE_LIMIT) / _processes,
+                        capacity=max(settings.EMAIL_RATE_BURST // _processes,
+                                     1))
+                if bucket.can_consume(1):
+                    break
+                delay = bucket.expected_time(1)
+            time.sleep(delay)
+
+
+def send_messages(messages):
+    """
+    Отправляет письма одной пачкой через общее соединение
+    в пределах лимита EMAIL_RATE_LIMIT.
+    При разрыве соединения сервером переподключается
+    и повторяет отправку один раз
+    возвращает количество отправленных писем
+    """
+    wait_for_quota(len(messages))
+    started = time.perf_counter()
+    try:
+        try:
+            sent = get_pooled_connection().send_messages(messages)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            close_pooled_connection()
+            sent = get_pooled_connection().send_messages(messages)
+    except Exception:
+        SMTP_MESSAGES.labels('error').inc(len(messages))
+        raise
+    SMTP_LATENCY.observe(time.perf_counter() - started)
+    SMTP_MESSAGES.labels('sent').inc(sent or 0)
+    return sent
+
+
+@worker_init.connect
+def share_quota_between_processes(sender, **kwargs):
+    """
+    Запоминает число процессов воркера до их запуска, если воркер
+    разбирает очередь email
+    """
+    global _processes
+    if 'email' in sender.app.amqp.queues.consume_from:
+        _processes = max(sender.concurrency or 1, 1)
+
+
+@worker_process_shutdown.connect
+def close_connection_on_shutdown(**kwargs):
+    close_pooled_connection()
@@ -0,0 +1,36 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from backend.outbox import publish_pending, delete_published
+
+# Как часто удалять опубликованные сообщения, секунд
+CLEANUP_INTERVAL = 60 * 60
+
+
+class Command(BaseCommand):
+    help = 'Публикует задачи из outbox в брокер Celery'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='опубликовать накопившееся и завершиться')
+
+    def handle(self, *args, **options):
+        cleaned_at = 0
+        while True:
+            published = publish_pending()
+            while published:
+                self.stdout.write(f'Опубликовано задач: {published}')
+                published = publish_pending()
+
+            if time.monotonic() - cleaned_at > CLEANUP_INTERVAL:
+                delete_published(
+                    timezone.now() - timedelta(seconds=settings.OUTBOX_RETENTION))
+                cleaned_at = time.monotonic()
+
+            if options['once']:
+                return
+            time.sleep(settings.OUTBOX_POLL_INTERVAL)
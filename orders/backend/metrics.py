@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import defaultdict
+
+# Метрики запросов по имени маршрута (backend:products, backend:basket, ...):
+# число запросов к базе, время SQL, время сериализации и общее время.
+# Данные собираются RequestMetricsMiddleware и копятся в памяти процесса
+
+_lock = threading.Lock()
+_totals = defaultdict(lambda: {
+    'requests': 0, 'queries': 0, 'max_queries': 0,
+    'sql_time': 0.0, 'serializer_time': 0.0, 'total_time': 0.0})
+_local = threading.local()
+_listeners = []
+
+
+class RequestRecord:
+    """
+    Метрики одного запроса
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.serializer_time = 0.0
+        self.total_time = 0.0
+        self.url_name = None
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        """
+        Обёртка для connection.execute_wrapper(): считает запросы и время
+        """
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.sql_time += time.perf_counter() - started
+
+
+def start_request():
+    _local.record = RequestRecord()
+    _local.depth = 0
+    return _local.record
+
+
+def finish_request(url_name, record):
+    """
+    Добавляет метрики запроса к итогам по маршруту url_name
+    """
+    _local.record = None
+    record.url_name = url_name
+    if url_name is None:
+        return
+    with _lock:
+        totals = _totals[url_name]
+        totals['requests'] += 1
+        totals['queries'] += record.queries
+        totals['max_queries'] = max(totals['max_queries'], record.queries)
+        totals['sql_time'] += record.sql_time
+        totals['serializer_time'] += record.serializer_time
+        totals['total_time'] += record.total_time
+    for listener in list(_listeners):
+        listener(record)
+
+
+def add_listener(listener):
+    """
+    listener(record) вызывается после каждого запроса (см. query_budget)
+    """
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+def snapshot():
+    """
+    Средние значения по маршрутам, время в миллисекундах
+    """
+    with _lock:
+        totals = {name: dict(values) for name, values in _totals.items()}
+    return {
+        name: {
+            'requests': values['requests'],
+            'queries_avg': round(values['queries'] / values['requests'], 2),
+            'queries_max': values['max_queries'],
+            'sql_ms_avg': round(
+                values['sql_time'] * 1000 / values['requests'], 3),
+            'serializer_ms_avg': round(
+                values['serializer_time'] * 1000 / values['requests'], 3),
+            'total_ms_avg': round(
+                values['total_time'] * 1000 / values['requests'], 3),
+        }
+        for name, values in sorted(totals.items())
+    }
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+class MeasuredSerializerMixin:
+    """
+    Учитывает время to_representation() сериализатора в метриках
+    текущего запроса. Вложенные сериализаторы входят во время внешнего
+    """
+
+    def to_representation(self, instance):
+        record = getattr(_local, 'record', None)
+        if record is None or _local.depth:
+            return super().to_representation(instance)
+        _local.depth += 1
+        started = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            record.serializer_time += time.perf_counter() - started
+            _local.depth -= 1
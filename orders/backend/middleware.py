@@ -0,0 +1,96 @@
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import JsonResponse
+
+from rest_framework.permissions import SAFE_METHODS
+
+from . import metrics, prometheus, slow_queries
+from .hashing import HashingBusy
+from .routers import pin
+
+BUSY_STATUS = {'Status': False,
+               'Errors': 'Сервер перегружен, повторите попытку позже'}
+
+
+class PasswordHashingBusyMiddleware:
+    """
+    Отвечает 503 с заголовком Retry-After, если пул хеширования
+    паролей перегружен (вход, регистрация, смена пароля)
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, HashingBusy):
+            response = JsonResponse(BUSY_STATUS, status=503)
+            response['Retry-After'] = str(
+                settings.PASSWORD_HASHING_RETRY_AFTER)
+            return response
+        return None
+
+
+class RequestMetricsMiddleware:
+    """
+    Собирает метрики запроса по имени маршрута: число запросов к базе,
+    время SQL, время сериализации и общее время (backend.metrics)
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        record = metrics.start_request()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(
+                    connection.execute_wrapper(record.execute_wrapper))
+            response = self.get_response(request)
+        record.total_time = time.perf_counter() - started
+        resolver_match = getattr(request, 'resolver_match', None)
+        url_name = resolver_match.view_name if resolver_match else None
+        metrics.finish_request(url_name, record)
+        if url_name is not None:
+            prometheus.observe_request(url_name, request.method,
+                                       response.status_code, record)
+        return response
+
+
+class SlowQueryCallerMiddleware:
+    """
+    Включает журнал медленных запросов к базе на время запроса
+    и подписывает записи именем маршрута (backend.slow_queries)
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with slow_queries.caller(None):
+            return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        slow_queries.set_caller(request.resolver_match.view_name)
+
+
+class ReplicaPinMiddleware:
+    """
+    После изменяющего запроса пользователь какое-то время читает
+    с основной базы, а не с реплик (backend.routers)
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if request.method not in SAFE_METHODS:
+            pin(getattr(request, 'user', None))
+        return response
@@ -1,8 +1,12 @@
+import json
+
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.core.mail import EmailMultiAlternatives
 
-from django.db import models
-from django.db.models import Sum
+from django.db import connections, models, transaction
+from django.db.models import Case, F, Sum, Value, When
 
 from django.utils.translation import gettext_lazy as _
 from django_rest_passwordreset.tokens import get_token_generator
@@ -19,6 +23,18 @@ STATE_CHOICES = (
     ('canceled', 'Отменен'),
 )
 
+# Допустимые переходы между статусами заказа
+
+ORDER_TRANSITIONS = {
+    'basket': ('new',),
+    'new': ('confirmed', 'canceled'),
+    'confirmed': ('assembled', 'canceled'),
+    'assembled': ('sent', 'canceled'),
+    'sent': ('delivered',),
+    'delivered': (),
+    'canceled': (),
+}
+
 USER_TYPE_CHOICES = (
     ('shop', 'Магазин'),
     ('buyer', 'Покупатель'),
@@ -101,6 +117,10 @@ class User(AbstractUser):
         'Unselect this instead of deleting account.'), )
     type = models.CharField(choices=USER_TYPE_CHOICES, max_length=5,
                             default='buyer', verbose_name='тип пользователя')
+    order_digest = models.BooleanField(default=False,
+                                       verbose_name='сводка по заказам',
+                                       help_text='присылать одно письмо '
+                                                 'по всем заказам за период')
 
     def __str__(self):
         return f'{self.first_name} {self.last_name}'
@@ -214,7 +234,51 @@ class ProductParameter(models.Model):
                                     name='unique_product_parameter'), ]
 
 
+class OrderQuerySet(models.QuerySet):
+    """
+    Выборка заказов с поддержкой пакетной смены статуса
+    """
+
+    def transition(self, state, user=None, notify=None, **fields):
+        """
+        Переводит заказы выборки в статус state одним UPDATE.
+        Заказы, для которых переход по ORDER_TRANSITIONS недопустим,
+        пропускаются. Переходы записываются в историю OrderStateChange
+        и в журнал изменений OrderChange. Журнал пишется последним:
+        запись в него блокирует другие записи в журнал до фиксации
+        принимает статус, пользователя, сменившего статус,
+        функцию уведомления notify(changes, state), которая вызывается
+        в той же транзакции до записи в журнал,
+        и дополнительные поля для обновления
+        возвращает список (id заказа, id покупателя, прежний статус)
+        """
+        sources = [source for source, targets in ORDER_TRANSITIONS.items()
+                   if state in targets]
+        with transaction.atomic():
+            changes = list(self.filter(
+                state__in=sources
+            ).select_for_update().order_by('id').values_list(
+                'id', 'user_id', 'state'))
+            if not changes:
+                return changes
+            order_ids = [order_id for order_id, _, _ in changes]
+            self.model.objects.filter(id__in=order_ids).update(state=state,
+                                                               **fields)
+            OrderStateChange.objects.bulk_create([
+                OrderStateChange(order_id=order_id, from_state=from_state,
+                                 to_state=state, changed_by=user)
+                for order_id, _, from_state in changes])
+            if state == 'new':
+                ShopOrderLine.objects.fan_out(order_ids)
+            if notify is not None:
+                notify(changes, state)
+            OrderChange.objects.log_changes(order_ids)
+        return changes
+
+
 class Order(models.Model):
+    objects = OrderQuerySet.as_manager()
+
     user = models.ForeignKey(User, on_delete=models.CASCADE, blank=True,
                              verbose_name='пользователь', related_name='orders')
     dt = models.DateTimeField(auto_now_add=True, verbose_name='дата создания')
@@ -241,7 +305,86 @@ class Order(models.Model):
 
 
 
+class OrderItemManager(models.Manager):
+    """
+    Менеджер позиций заказа со слиянием количества
+    """
+
+    def supports_upsert(self):
+        """
+        Поддерживает ли база INSERT ... ON CONFLICT DO UPDATE
+        (PostgreSQL 9.5+, SQLite 3.24+)
+        """
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            return True
+        if connection.vendor == 'sqlite':
+            return connection.Database.sqlite_version_info >= (3, 24, 0)
+        return False
+
+    def merge_quantities(self, order_id, quantities):
+        """
+        Добавляет количество к позициям заказа: существующие позиции
+        увеличиваются на переданное количество, недостающие создаются
+        принимает id заказа и словарь {id информации о продукте: количество}
+        """
+        if not quantities:
+            return
+        if self.supports_upsert():
+            self._merge_upsert(order_id, quantities)
+        else:
+            self._merge_fallback(order_id, quantities)
+
+    def _merge_upsert(self, order_id, quantities):
+        """
+        Слияние одним запросом INSERT ... ON CONFLICT DO UPDATE
+        """
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        opts = self.model._meta
+        table = quote(opts.db_table)
+        order_column, product_info_column, quantity_column = (
+            quote(opts.get_field(name).column)
+            for name in ('order', 'product_info', 'quantity'))
+        values = ', '.join(['(%s, %s, %s)'] * len(quantities))
+        params = [param for product_info_id, quantity in quantities.items()
+                  for param in (order_id, product_info_id, quantity)]
+        sql = (f'INSERT INTO {table} '
+               f'({order_column}, {product_info_column}, {quantity_column}) '
+               f'VALUES {values} '
+               f'ON CONFLICT ({order_column}, {product_info_column}) '
+               f'DO UPDATE SET {quantity_column} = '
+               f'{table}.{quantity_column} + excluded.{quantity_column}')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def _merge_fallback(self, order_id, quantities):
+        """
+        Переносимое слияние: один UPDATE для существующих позиций
+        и один INSERT для новых в рамках транзакции
+        """
+        with transaction.atomic(using=self.db):
+            existing = set(self.select_for_update().filter(
+                order_id=order_id, product_info_id__in=quantities
+            ).values_list('product_info_id', flat=True))
+            if existing:
+                self.filter(
+                    order_id=order_id, product_info_id__in=existing
+                ).update(quantity=F('quantity') + Case(
+                    *[When(product_info_id=product_info_id,
+                           then=Value(quantities[product_info_id]))
+                      for product_info_id in existing],
+                    output_field=models.PositiveIntegerField()))
+            self.bulk_create([
+                self.model(order_id=order_id, product_info_id=product_info_id,
+                           quantity=quantity)
+                for product_info_id, quantity in quantities.items()
+                if product_info_id not in existing])
+
+
 class OrderItem(models.Model):
+    objects = OrderItemManager()
+
     order = models.ForeignKey(Order, on_delete=models.CASCADE, blank=True,
                               verbose_name='заказ',
                               related_name='ordered_items')
@@ -312,3 +455,355 @@ class ConfirmEmailToken(models.Model):
 
     def __str__(self):
         return f'Токен смены пароля для пользователя {self.user}'
+
+
+# Журнал изменений заказов для инкрементальной выдачи поставщикам
+
+# ключ рекомендательной блокировки PostgreSQL для записи в журнал
+ORDER_CHANGE_LOCK = 4_207_011
+
+
+class OrderChangeManager(models.Manager):
+    """
+    Менеджер журнала изменений заказов
+    """
+
+    def log_changes(self, order_ids):
+        """
+        Записывает изменение заказов в журнал: по одной строке на каждую
+        пару (заказ, магазин), затронутую позициями заказа.
+        Позиции берутся из ShopOrderLine, поэтому заказы должны быть
+        предварительно разнесены по магазинам (ShopOrderLine.objects.fan_out)
+        принимает список id заказов
+        """
+        with transaction.atomic(using=self.db, savepoint=False):
+            self.lock_sequence()
+            pairs = ShopOrderLine.objects.using(self.db).filter(
+                order_id__in=order_ids
+            ).values_list(
+                'order_id', 'shop_id'
+            ).distinct()
+            return self.bulk_create([
+                self.model(order_id=order_id, shop_id=shop_id)
+                for order_id, shop_id in pairs])
+
+    def lock_sequence(self):
+        """
+        Выдаёт id журнала в порядке фиксации транзакций, иначе поставщик,
+        прочитавший id N+1, пропустил бы изменение N, зафиксированное позже.
+        В PostgreSQL последовательность выдаёт id при вставке, поэтому
+        записи сериализуются рекомендательной блокировкой до конца
+        транзакции. SQLite держит блокировку записи до фиксации сам.
+        Поэтому после записи в журнал в транзакции не должно быть
+        долгих операций
+        """
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)',
+                               [ORDER_CHANGE_LOCK])
+
+
+class OrderChange(models.Model):
+    """
+    Запись журнала изменений заказа.
+    Автоинкрементный id возрастает в порядке фиксации транзакций
+    (OrderChangeManager.lock_sequence) и служит курсором ленты
+    заказов поставщика (PartnerOrders ?since=<cursor>)
+    """
+    objects = OrderChangeManager()
+
+    id = models.BigAutoField(primary_key=True)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE,
+                              verbose_name='заказ', related_name='changes')
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE,
+                             verbose_name='магазин',
+                             related_name='order_changes')
+    created_at = models.DateTimeField(auto_now_add=True,
+                                      verbose_name='дата изменения')
+
+    class Meta:
+        verbose_name = 'изменение заказа'
+        verbose_name_plural = 'журнал изменений заказов'
+        indexes = [
+            models.Index(fields=['shop', 'id'], name='order_change_shop_seq'), ]
+
+    def __str__(self):
+        return f'{self.order_id} ({self.shop_id}) #{self.id}'
+
+
+# Позиции заказов, разнесённые по магазинам
+
+class ShopOrderLineManager(models.Manager):
+    """
+    Менеджер позиций заказов в разрезе магазинов
+    """
+
+    def fan_out(self, order_ids):
+        """
+        Разносит позиции заказов по магазинам-поставщикам,
+        фиксируя цену и описание товара на момент оформления заказа.
+        Разносятся только позиции, ещё не разнесённые: уже разнесённые
+        сохраняют цену и описание, даже если информация о продукте
+        удалена импортом прайса
+        принимает список id заказов
+        """
+        items = OrderItem.objects.filter(
+            order_id__in=order_ids, shop_line=None
+        ).values_list(
+            'id', 'order_id', 'product_info_id', 'product_info__shop_id',
+            'quantity', 'product_info__price', 'product_info__product__name',
+            'product_info__model', 'product_info__external_id'
+        )
+        return self.bulk_create([
+            self.model(order_item_id=item_id, order_id=order_id,
+                       product_info_id=product_info_id, shop_id=shop_id,
+                       quantity=quantity, price=price, product_name=name,
+                       model=model, external_id=external_id)
+            for (item_id, order_id, product_info_id, shop_id, quantity, price,
+                 name, model, external_id) in items])
+
+
+class ShopOrderLine(models.Model):
+    """
+    Позиция заказа в разрезе магазина: узкая таблица,
+    из которой поставщику отдаются только его позиции.
+    Импорт прайса пересоздаёт информацию о продуктах магазина, поэтому
+    позиция хранит копию описания товара и переживает удаление
+    product_info и order_item
+    """
+    objects = ShopOrderLineManager()
+
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE,
+                             verbose_name='магазин',
+                             related_name='order_lines')
+    order = models.ForeignKey(Order, on_delete=models.CASCADE,
+                              verbose_name='заказ', related_name='shop_lines')
+    order_item = models.OneToOneField(OrderItem, on_delete=models.SET_NULL,
+                                      null=True,
+                                      verbose_name='заказанная позиция',
+                                      related_name='shop_line')
+    product_info = models.ForeignKey(ProductInfo, on_delete=models.SET_NULL,
+                                     null=True,
+                                     verbose_name='информация о продукте',
+                                     related_name='shop_order_lines')
+    product_name = models.CharField(max_length=64, verbose_name='товар')
+    model = models.CharField(max_length=64, blank=True, verbose_name='модель')
+    external_id = models.PositiveIntegerField(verbose_name='внешний ID')
+    quantity = models.PositiveIntegerField(verbose_name='количество')
+    price = models.PositiveIntegerField(verbose_name='цена')
+
+    class Meta:
+        verbose_name = 'позиция заказа магазина'
+        verbose_name_plural = 'позиции заказов магазинов'
+        indexes = [
+            models.Index(fields=['shop', 'order'],
+                         name='shop_order_line_shop_order'), ]
+
+    def __str__(self):
+        return f'{self.order_id}: {self.product_name} x {self.quantity}'
+
+
+class OrderStateChange(models.Model):
+    """
+    История смены статусов заказов. Записи только добавляются
+    """
+    order = models.ForeignKey(Order, on_delete=models.CASCADE,
+                              verbose_name='заказ',
+                              related_name='state_changes')
+    from_state = models.CharField(max_length=16, choices=STATE_CHOICES,
+                                  verbose_name='прежний статус')
+    to_state = models.CharField(max_length=16, choices=STATE_CHOICES,
+                                verbose_name='новый статус')
+    changed_by = models.ForeignKey(User, on_delete=models.SET_NULL,
+                                   blank=True, null=True,
+                                   verbose_name='кем изменён',
+                                   related_name='order_state_changes')
+    created_at = models.DateTimeField(auto_now_add=True,
+                                      verbose_name='дата изменения')
+
+    class Meta:
+        verbose_name = 'смена статуса заказа'
+        verbose_name_plural = 'история статусов заказов'
+        ordering = ('-created_at',)
+
+    def __str__(self):
+        return f'{self.order_id}: {self.from_state} -> {self.to_state}'
+
+
+# Очередь исходящих писем
+
+class OutgoingEmail(models.Model):
+    """
+    Письмо, ожидающее отправки. Очередь разбирается задачей
+    send_queued_emails пачками через одно SMTP-соединение.
+    claimed_at - время, когда письмо взято в отправку воркером,
+    key - ключ, по которому письмо ставится в очередь не более одного раза
+    """
+    key = models.CharField(max_length=64, unique=True, null=True, blank=True,
+                           verbose_name='ключ')
+    subject = models.CharField(max_length=255, verbose_name='тема')
+    body = models.TextField(verbose_name='текст')
+    recipients = models.TextField(verbose_name='получатели',
+                                  help_text='адреса через запятую')
+    attachments = models.TextField(blank=True, default='',
+                                   verbose_name='вложения',
+                                   help_text='json: [[имя, текст, тип], ...]')
+    created_at = models.DateTimeField(auto_now_add=True,
+                                      verbose_name='дата создания')
+    claimed_at = models.DateTimeField(null=True, blank=True,
+                                      verbose_name='взято в отправку')
+    sent_at = models.DateTimeField(null=True, blank=True,
+                                   verbose_name='дата отправки')
+
+    class Meta:
+        verbose_name = 'исходящее письмо'
+        verbose_name_plural = 'очередь исходящих писем'
+        indexes = [
+            models.Index(fields=['sent_at', 'id'],
+                         name='outgoing_email_queue'), ]
+
+    def __str__(self):
+        return f'{self.subject} -> {self.recipients}'
+
+    def as_message(self):
+        """
+        Письмо в виде объекта для отправки через почтовый backend
+        """
+        message = EmailMultiAlternatives(self.subject, self.body,
+                                         settings.EMAIL_HOST_USER,
+                                         self.recipients.split(','))
+        for filename, content, mimetype in json.loads(self.attachments or '[]'):
+            message.attach(filename, content, mimetype)
+        return message
+
+
+# Outbox: задачи Celery, записанные в одной транзакции с изменением данных
+
+class OutboxMessageManager(models.Manager):
+    """
+    Менеджер outbox-сообщений
+    """
+
+    def enqueue(self, task, *args, **kwargs):
+        """
+        Записывает вызов задачи в outbox. Должен выполняться в той же
+        транзакции, что и изменение данных, ради которого ставится задача
+        принимает задачу Celery (или её имя) и её аргументы
+        """
+        return self.create(task=getattr(task, 'name', task),
+                           payload=json.dumps({'args': args,
+                                               'kwargs': kwargs}))
+
+    def enqueue_many(self, task, calls):
+        """
+        Записывает несколько вызовов одной задачи одним INSERT
+        принимает задачу Celery (или её имя) и список кортежей аргументов
+        """
+        task = getattr(task, 'name', task)
+        return self.bulk_create([
+            self.model(task=task,
+                       payload=json.dumps({'args': args, 'kwargs': {}}))
+            for args in calls])
+
+
+class OutboxMessage(models.Model):
+    """
+    Вызов задачи Celery, ожидающий публикации в брокер.
+    Публикуется пачками процессом relay_outbox
+    """
+    objects = OutboxMessageManager()
+
+    task = models.CharField(max_length=128, verbose_name='задача')
+    payload = models.TextField(verbose_name='аргументы (json)')
+    created_at = models.DateTimeField(auto_now_add=True,
+                                      verbose_name='дата создания')
+    published_at = models.DateTimeField(null=True, blank=True,
+                                        verbose_name='дата публикации')
+
+    class Meta:
+        verbose_name = 'сообщение outbox'
+        verbose_name_plural = 'outbox задач'
+        indexes = [
+            models.Index(fields=['published_at', 'id'],
+                         name='outbox_pending'), ]
+
+    def __str__(self):
+        return f'{self.task} #{self.id}'
+
+
+# Сводки по заказам: события копятся и отправляются одним письмом
+
+class OrderDigestEntry(models.Model):
+    """
+    Событие по заказу, ожидающее отправки в сводке пользователю
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             verbose_name='пользователь',
+                             related_name='order_digest_entries')
+    order = models.ForeignKey(Order, on_delete=models.CASCADE,
+                              verbose_name='заказ',
+                              related_name='digest_entries')
+    state = models.CharField(max_length=16, choices=STATE_CHOICES,
+                             verbose_name='статус')
+    created_at = models.DateTimeField(auto_now_add=True,
+                                      verbose_name='дата события')
+
+    class Meta:
+        verbose_name = 'событие сводки по заказам'
+        verbose_name_plural = 'события сводок по заказам'
+        indexes = [
+            models.Index(fields=['user', 'created_at'],
+                         name='order_digest_user_created'), ]
+
+    def __str__(self):
+        return f'{self.user_id}: {self.order_id} ({self.state})'
+
+
+# Выгрузки: файлы формируются задачами Celery и скачиваются после готовности
+
+EXPORT_KIND_CHOICES = (
+    ('catalog', 'Каталог магазина'),
+    ('orders', 'Заказы за период'),
+)
+
+EXPORT_STATE_CHOICES = (
+    ('pending', 'В очереди'),
+    ('running', 'Формируется'),
+    ('done', 'Готова'),
+    ('failed', 'Ошибка'),
+)
+
+
+class ExportJob(models.Model):
+    """
+    Выгрузка данных в файл. Параметры выгрузки хранятся в json,
+    файл сохраняется в MEDIA_ROOT/exports
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             verbose_name='пользователь',
+                             related_name='export_jobs')
+    kind = models.CharField(max_length=16, choices=EXPORT_KIND_CHOICES,
+                            verbose_name='вид выгрузки')
+    file_format = models.CharField(max_length=16, verbose_name='формат')
+    params = models.TextField(default='{}',
+                              verbose_name='параметры (json)')
+    state = models.CharField(max_length=16, choices=EXPORT_STATE_CHOICES,
+                             default='pending', verbose_name='статус')
+    file = models.FileField(upload_to='exports/', blank=True,
+                            verbose_name='файл')
+    error = models.TextField(blank=True, verbose_name='ошибка')
+    created_at = models.DateTimeField(auto_now_add=True,
+                                      verbose_name='дата создания')
+    finished_at = models.DateTimeField(null=True, blank=True,
+                                       verbose_name='дата завершения')
+
+    class Meta:
+        verbose_name = 'выгрузка'
+        verbose_name_plural = 'выгрузки'
+
+    def __str__(self):
+        return f'{self.kind}.{self.file_format} #{self.id} ({self.state})'
+
+    def get_params(self):
+        return json.loads(self.params)
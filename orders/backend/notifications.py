@@ -0,0 +1,84 @@
+from collections import defaultdict
+
+from django.db.models import Count, F, Sum
+
+from .models import User, OrderItem, OutboxMessage, OrderDigestEntry, \
+    ConfirmEmailToken, STATE_CHOICES
+from .tasks import send_email_task, render_invoices_task
+
+# Письма готовятся здесь, в транзакции веб-запроса, и передаются задаче
+# send_email целиком: воркеру не нужно повторно читать пользователей,
+# токены и заказы из базы
+
+
+def email_payload(subject, body, recipients):
+    """
+    Компактное описание письма для задачи send_email
+    """
+    return {'to': list(recipients), 'subject': subject, 'body': body}
+
+
+def notify_new_user(user):
+    """
+    Создаёт токен подтверждения почты и ставит письмо с ним в outbox.
+    Вызывать нужно в транзакции регистрации пользователя
+    """
+    token = ConfirmEmailToken.objects.create(user=user)
+    OutboxMessage.objects.enqueue(send_email_task, email_payload(
+        f'Токен для подтверждения почты {user.email}',
+        token.key,
+        [user.email]))
+
+
+def notify_new_order(user, order_id):
+    """
+    Ставит в outbox отправку накладных администратору и уведомляет
+    покупателя об оформлении заказа: письмом через outbox
+    или записью в сводку, если пользователь включил сводки.
+    Вызывать нужно в транзакции оформления заказа
+    """
+    OutboxMessage.objects.enqueue(render_invoices_task, [order_id])
+    if user.order_digest:
+        OrderDigestEntry.objects.create(user=user, order_id=order_id,
+                                        state='new')
+        return
+    summary = OrderItem.objects.filter(order_id=order_id).aggregate(
+        items=Count('id'),
+        total=Sum(F('quantity') * F('product_info__price')))
+    OutboxMessage.objects.enqueue(send_email_task, email_payload(
+        'Обновление статуса заказа',
+        f'Заказ №{order_id} сформирован\n'
+        f'Позиций: {summary["items"]}, сумма: {summary["total"] or 0}',
+        [user.email]))
+
+
+def notify_order_state_changes(changes, state):
+    """
+    Ставит в очередь по одному письму на каждого покупателя,
+    заказы которого сменили статус; покупателям со сводками
+    события добавляются в сводку. Задачи пишутся в outbox,
+    поэтому вызывать нужно в транзакции смены статуса
+    принимает результат Order.objects.transition() и новый статус
+    """
+    orders_by_user = defaultdict(list)
+    for order_id, user_id, _ in changes:
+        orders_by_user[user_id].append(order_id)
+    users = User.objects.filter(
+        id__in=orders_by_user).values_list('id', 'email', 'order_digest')
+
+    digest_entries, payloads = [], []
+    for user_id, email, order_digest in users:
+        order_ids = orders_by_user[user_id]
+        if order_digest:
+            digest_entries.extend(
+                OrderDigestEntry(user_id=user_id, order_id=order_id,
+                                 state=state)
+                for order_id in order_ids)
+        else:
+            orders = ', '.join(f'№{order_id}' for order_id in order_ids)
+            payloads.append((email_payload(
+                'Обновление статуса заказа',
+                f'Заказы {orders}: {dict(STATE_CHOICES)[state]}',
+                [email]),))
+    OrderDigestEntry.objects.bulk_create(digest_entries)
+    OutboxMessage.objects.enqueue_many(send_email_task, payloads)
@@ -0,0 +1,46 @@
+import json
+
+from celery import current_app
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboxMessage
+
+
+def publish_pending(batch_size=None):
+    """
+    Публикует пачку неопубликованных сообщений outbox в брокер
+    через одно соединение и помечает их опубликованными.
+    Доставка "как минимум один раз": при сбое после публикации
+    сообщения будут опубликованы повторно
+    возвращает количество опубликованных сообщений
+    """
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    with transaction.atomic():
+        batch = list(OutboxMessage.objects.select_for_update(
+            skip_locked=True
+        ).filter(
+            published_at=None
+        ).order_by('id')[:batch_size])
+        if not batch:
+            return 0
+        with current_app.producer_or_acquire() as producer:
+            for message in batch:
+                payload = json.loads(message.payload)
+                current_app.send_task(message.task, args=payload['args'],
+                                      kwargs=payload['kwargs'],
+                                      producer=producer)
+        OutboxMessage.objects.filter(
+            id__in=[message.id for message in batch]
+        ).update(published_at=timezone.now())
+    return len(batch)
+
+
+def delete_published(before):
+    """
+    Удаляет сообщения, опубликованные раньше указанного момента
+    """
+    return OutboxMessage.objects.filter(
+        published_at__lt=before).delete()[0]
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+
+from celery.signals import task_prerun, task_postrun, before_task_publish, \
+    after_task_publish, worker_process_shutdown
+from prometheus_client import Counter, Histogram, CollectorRegistry, \
+    REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+# Метрики в формате Prometheus. Значения копятся в памяти процесса;
+# при нескольких процессах (gunicorn, prefork-воркеры Celery) нужно
+# задать переменную окружения prometheus_multiproc_dir - каталог,
+# через который процессы делятся значениями (очищается при запуске).
+# /metrics в этом режиме собирает значения всех процессов
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Время обработки запроса',
+    ['url_name', 'method', 'status'])
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', 'Число запросов к базе на запрос',
+    ['url_name'], buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89, float('inf')))
+TASK_LATENCY = Histogram(
+    'celery_task_duration_seconds', 'Время выполнения задачи Celery',
+    ['task', 'state'])
+PUBLISH_LATENCY = Histogram(
+    'celery_publish_duration_seconds', 'Время публикации задачи в брокер',
+    ['task'], buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+                       float('inf')))
+IMPORT_ROWS = Counter(
+    'import_rows_total',
+    'Информация о продуктах, удалённая и добавленная импортом',
+    ['operation'])
+SMTP_LATENCY = Histogram(
+    'smtp_send_duration_seconds', 'Время отправки пачки писем')
+SMTP_MESSAGES = Counter(
+    'smtp_messages_total', 'Отправленные письма', ['result'])
+CACHE_REQUESTS = Counter(
+    'cache_requests_total', 'Обращения к кэшам приложения',
+    ['cache', 'result'])
+
+_started = threading.local()
+
+
+class QueueCollector:
+    """
+    Глубина очередей Celery и число неопубликованных сообщений outbox.
+    Считается при каждом запросе /metrics
+    """
+
+    def collect(self):
+        from .models import OutboxMessage
+        outbox = GaugeMetricFamily('outbox_pending_messages',
+                                   'Неопубликованные сообщения outbox')
+        outbox.add_metric([], OutboxMessage.objects.filter(
+            published_at=None).count())
+        yield outbox
+
+        if not settings.METRICS_QUEUE_DEPTH:
+            return
+        from celery import current_app
+        depth = GaugeMetricFamily('celery_queue_length',
+                                  'Сообщения в очереди брокера',
+                                  labels=['queue'])
+        try:
+            with current_app.connection_for_read() as connection:
+                connection.ensure_connection(max_retries=1)
+                channel = connection.default_channel
+                for queue in sorted(celery_queues()):
+                    depth.add_metric([queue], channel.queue_declare(
+                        queue, passive=True).message_count)
+        except Exception:
+            return
+        yield depth
+
+
+def celery_queues():
+    queues = {settings.CELERY_DEFAULT_QUEUE}
+    queues.update(route['queue'] for route in settings.CELERY_ROUTES.values())
+    return queues
+
+
+def get_registry():
+    if 'prometheus_multiproc_dir' not in os.environ:
+        return REGISTRY
+    from prometheus_client import multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def metrics_view(request):
+    """
+    Метрики в текстовом формате Prometheus для адресов METRICS_ALLOWED_IPS
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    queues = CollectorRegistry()
+    queues.register(QueueCollector())
+    return HttpResponse(generate_latest(get_registry())
+                        + generate_latest(queues),
+                        content_type=CONTENT_TYPE_LATEST)
+
+
+def observe_request(url_name, method, status, record):
+    REQUEST_LATENCY.labels(url_name, method, status).observe(
+        record.total_time)
+    REQUEST_QUERIES.labels(url_name).observe(record.queries)
+
+
+@task_prerun.connect
+def task_started(task_id, task, **kwargs):
+    if not hasattr(_started, 'tasks'):
+        _started.tasks = {}
+    _started.tasks[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def task_finished(task_id, task, state=None, **kwargs):
+    started = getattr(_started, 'tasks', {}).pop(task_id, None)
+    if started is not None:
+        TASK_LATENCY.labels(task.name, state or 'UNKNOWN').observe(
+            time.perf_counter() - started)
+
+
+@before_task_publish.connect
+def publish_started(**kwargs):
+    _started.publish = time.perf_counter()
+
+
+@after_task_publish.connect
+def publish_finished(sender=None, **kwargs):
+    started = getattr(_started, 'publish', None)
+    if started is not None:
+        _started.publish = None
+        PUBLISH_LATENCY.labels(sender).observe(time.perf_counter() - started)
+
+
+@worker_process_shutdown.connect
+def mark_process_dead(pid=None, **kwargs):
+    if 'prometheus_multiproc_dir' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -0,0 +1,45 @@
+"""
+Плагин pytest: тест падает, если запрос к маршруту выполнил больше
+запросов к базе, чем указано в настройке QUERY_BUDGETS
+({'backend:products': 4, ...}). Для отдельного теста бюджет
+переопределяется маркером:
+
+    @pytest.mark.query_budget({'backend:basket': 10})
+
+Подключается через pytest_plugins в orders/conftest.py
+или опцией -p backend.query_budget
+"""
+import pytest
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'query_budget(budgets): бюджет запросов к базе '
+                   'по именам маршрутов для теста')
+
+
+@pytest.hookimpl(hookwrapper=True, trylast=True)
+def pytest_pyfunc_call(pyfuncitem):
+    from django.conf import settings
+    from . import metrics
+
+    records = []
+    metrics.add_listener(records.append)
+    try:
+        outcome = yield
+    finally:
+        metrics.remove_listener(records.append)
+    if outcome.excinfo is not None:
+        return
+
+    budgets = dict(getattr(settings, 'QUERY_BUDGETS', {}))
+    for marker in reversed(list(pyfuncitem.iter_markers('query_budget'))):
+        budgets.update(marker.args[0])
+    exceeded = [f'{record.url_name}: {record.queries} > '
+                f'{budgets[record.url_name]}'
+                for record in records
+                if record.queries > budgets.get(record.url_name,
+                                                record.queries)]
+    if exceeded:
+        pytest.fail('Превышен бюджет запросов к базе: ' + ', '.join(exceeded),
+                    pytrace=False)
@@ -0,0 +1,106 @@
+import threading
+import time
+from itertools import count
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, DatabaseError
+
+from rest_framework.permissions import SAFE_METHODS
+
+# Чтение с реплик: безопасные запросы представлений с ReplicaReadsMixin
+# (каталог, история заказов) читают с реплик DATABASE_REPLICAS по кругу,
+# пропуская недоступные REPLICA_RETRY_SECONDS секунд. Пользователь,
+# изменивший данные, REPLICA_PIN_SECONDS секунд читает с основной базы,
+# чтобы видеть свои изменения несмотря на отставание реплик.
+# Отметки хранятся в кэше REPLICA_PIN_CACHE, общем для всех процессов
+
+_state = threading.local()
+_counter = count()
+_down_until = {}
+
+
+def use_replicas(enabled=True):
+    """
+    Включает чтение с реплик в текущем потоке
+    """
+    _state.replicas = enabled
+    _state.wrote = False
+
+
+def pin_key(user_id):
+    return f'replica-pin:{user_id}'
+
+
+def pin(user):
+    """
+    Направляет чтения пользователя на основную базу
+    """
+    if user is not None and user.is_authenticated:
+        caches[settings.REPLICA_PIN_CACHE].set(
+            pin_key(user.id), True, settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned(user):
+    return (user.is_authenticated
+            and caches[settings.REPLICA_PIN_CACHE].get(pin_key(user.id))
+            is not None)
+
+
+def healthy(alias):
+    if _down_until.get(alias, 0) > time.monotonic():
+        return False
+    try:
+        connections[alias].ensure_connection()
+    except DatabaseError:
+        _down_until[alias] = time.monotonic() + settings.REPLICA_RETRY_SECONDS
+        return False
+    return True
+
+
+def choose_replica():
+    """
+    Следующая по кругу доступная реплика или None (основная база)
+    """
+    replicas = settings.DATABASE_REPLICAS
+    for _ in range(len(replicas)):
+        alias = replicas[next(_counter) % len(replicas)]
+        if healthy(alias):
+            return alias
+    return None
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not getattr(_state, 'replicas', False) or _state.wrote:
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return choose_replica()
+
+    def db_for_write(self, model, **hints):
+        # после записи запрос дочитывает с основной базы
+        _state.wrote = True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+class ReplicaReadsMixin:
+    """
+    Безопасные запросы представления читают с реплик.
+    Аутентификация и проверка прав выполняются на основной базе
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and not is_pinned(request.user):
+            use_replicas()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        use_replicas(False)
+        return super().finalize_response(request, response, *args, **kwargs)
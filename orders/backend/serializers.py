@@ -1,10 +1,17 @@
 from rest_framework import serializers
 
+from .metrics import MeasuredSerializerMixin
 from .models import User, Category, Shop, ProductInfo, Product, \
-    ProductParameter, OrderItem, Order, Contact
+    ProductParameter, OrderItem, Order, Contact, ShopOrderLine
 
 
-class ContactSerializer(serializers.ModelSerializer):
+class ModelSerializer(MeasuredSerializerMixin, serializers.ModelSerializer):
+    """
+    ModelSerializer с учётом времени сериализации в метриках запроса
+    """
+
+
+class ContactSerializer(ModelSerializer):
     class Meta:
         model = Contact
         fields = ('id', 'city', 'street', 'house',
@@ -13,13 +20,13 @@ class ContactSerializer(serializers.ModelSerializer):
         extra_kwargs = {'user': {'write_only': True}}
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(ModelSerializer):
     contacts = ContactSerializer(read_only=True, many=True)
 
     class Meta:
         model = User
         fields = ('id', 'first_name', 'last_name', 'email',
-                  'company', 'position', 'contacts')
+                  'company', 'position', 'order_digest', 'contacts')
         read_only_fields = ('id',)
 
 
@@ -34,21 +41,21 @@ class LoginSerializer(serializers.Serializer):
     )
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(ModelSerializer):
     class Meta:
         model = Category
         fields = ('id', 'name',)
         read_only_fields = ('id',)
 
 
-class ShopSerializer(serializers.ModelSerializer):
+class ShopSerializer(ModelSerializer):
     class Meta:
         model = Shop
         fields = ('id', 'name', 'state',)
         read_only_fields = ('id',)
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(ModelSerializer):
     category = serializers.StringRelatedField()
 
     class Meta:
@@ -56,7 +63,7 @@ class ProductSerializer(serializers.ModelSerializer):
         fields = ('name', 'category',)
 
 
-class ProductParameterSerializer(serializers.ModelSerializer):
+class ProductParameterSerializer(ModelSerializer):
     parameter = serializers.StringRelatedField()
 
     class Meta:
@@ -64,7 +71,7 @@ class ProductParameterSerializer(serializers.ModelSerializer):
         fields = ('parameter', 'value',)
 
 
-class ProductInfoSerializer(serializers.ModelSerializer):
+class ProductInfoSerializer(ModelSerializer):
     product = ProductSerializer(read_only=True)
     product_parameters = ProductParameterSerializer(read_only=True, many=True)
 
@@ -75,7 +82,7 @@ class ProductInfoSerializer(serializers.ModelSerializer):
         read_only_fields = ('id',)
 
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(ModelSerializer):
     class Meta:
         model = OrderItem
         fields = ('id', 'product_info', 'quantity', 'order')
@@ -87,7 +94,7 @@ class OrderItemCreateSerializer(OrderItemSerializer):
     product_info = ProductInfoSerializer(read_only=True)
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(ModelSerializer):
     ordered_items = OrderItemCreateSerializer(read_only=True, many=True)
     total_sum = serializers.IntegerField()
     contact = ContactSerializer(read_only=True)
@@ -95,4 +102,33 @@ class OrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = ('id', 'ordered_items', 'state', 'dt', 'total_sum', 'contact')
-        read_only_fields = ('id',)
\ No newline at end of file
+        read_only_fields = ('id',)
+
+
+class ShopOrderLineSerializer(ModelSerializer):
+    product = serializers.CharField(source='product_name')
+
+    class Meta:
+        model = ShopOrderLine
+        fields = ('id', 'product_info', 'external_id', 'model', 'product',
+                  'quantity', 'price')
+        read_only_fields = ('id',)
+
+
+class PartnerOrderSerializer(ModelSerializer):
+    """
+    Заказ глазами поставщика: только позиции его магазина,
+    предварительно загруженные в атрибут partner_lines
+    """
+    ordered_items = ShopOrderLineSerializer(source='partner_lines',
+                                            read_only=True, many=True)
+    total_sum = serializers.SerializerMethodField()
+    contact = ContactSerializer(read_only=True)
+
+    class Meta:
+        model = Order
+        fields = ('id', 'ordered_items', 'state', 'dt', 'total_sum', 'contact')
+        read_only_fields = ('id',)
+
+    def get_total_sum(self, order):
+        return sum(line.quantity * line.price for line in order.partner_lines)
@@ -66,4 +66,46 @@
 #         # Кому:
 #         [user.email]
 #     )
-#     msg.send()
\ No newline at end of file
+#     msg.send()
+
+
+# Сброс кэша аутентификации по токену (backend.authentication)
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from rest_framework.authtoken.models import Token
+
+from .authentication import invalidate_tokens
+from . import cache as catalog_cache
+from .models import User, Category, Shop
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields, **kwargs):
+    """
+    Пользователь изменён (в том числе заблокирован или сменил пароль).
+    У нового пользователя токенов нет, вход (last_login) снимки не сбрасывает
+    """
+    if created or update_fields == frozenset(['last_login']):
+        return
+    invalidate_tokens(Token.objects.filter(
+        user_id=instance.pk).values_list('key', flat=True))
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    invalidate_tokens([instance.key])
+
+
+# Сброс кэша списков каталога (backend.cache): сохранение и удаление
+# категорий и магазинов, в том числе в админке
+
+@receiver([post_save, post_delete], sender=Category)
+def category_changed(sender, **kwargs):
+    catalog_cache.invalidate(catalog_cache.CATEGORIES)
+
+
+@receiver([post_save, post_delete], sender=Shop)
+def shop_changed(sender, **kwargs):
+    catalog_cache.invalidate(catalog_cache.SHOPS)
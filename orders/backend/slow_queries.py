@@ -0,0 +1,159 @@
+import logging
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+
+from celery.signals import task_prerun, task_postrun
+
+from django.conf import settings
+from django.db import connections
+
+# Журнал медленных запросов к базе: запросы дольше
+# SLOW_QUERY_THRESHOLD_MS записываются (с долей SLOW_QUERY_SAMPLE_RATE)
+# в логгер backend.slow_queries вместе с маршрутом или задачей Celery,
+# из которых выполнены. Для SLOW_QUERY_EXPLAIN_TOP запросов с наибольшим
+# суммарным временем один раз записывается план выполнения
+# (EXPLAIN / EXPLAIN QUERY PLAN для SQLite).
+# Запросы учитываются внутри блока caller(): запроса (middleware
+# SlowQueryCallerMiddleware) и задачи Celery
+
+logger = logging.getLogger(__name__)
+
+# сколько разных запросов помнить для выбора самых медленных
+MAX_OFFENDERS = 1000
+
+_local = threading.local()
+_lock = threading.Lock()
+_offenders = {}
+_explained = set()
+
+# строковые значения в плане PostgreSQL (Filter: (key = '...'::text))
+LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def get_caller():
+    return getattr(_local, 'caller', None)
+
+
+def set_caller(name):
+    _local.caller = name
+
+
+@contextmanager
+def caller(name):
+    """
+    Запросы внутри блока записываются в журнал от имени name
+    """
+    previous = get_caller()
+    _local.caller = name
+    try:
+        with ExitStack() as stack:
+            # обёртка снимается при выходе из блока, в котором добавлена:
+            # соединение, открытое внутри запроса, не должно оставить
+            # в execute_wrappers обёрток других middleware
+            for connection in connections.all():
+                if slow_query_wrapper not in connection.execute_wrappers:
+                    stack.enter_context(
+                        connection.execute_wrapper(slow_query_wrapper))
+            yield
+    finally:
+        _local.caller = previous
+
+
+def slow_query_wrapper(execute, sql, params, many, context):
+    """
+    Обёртка для connection.execute_wrapper(), пишет медленные запросы
+    в журнал
+    """
+    threshold = settings.SLOW_QUERY_THRESHOLD_MS
+    if threshold is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    result = execute(sql, params, many, context)
+    duration = (time.perf_counter() - started) * 1000
+    if (duration >= threshold
+            and random.random() < settings.SLOW_QUERY_SAMPLE_RATE):
+        plan = None
+        if not many and top_offender(sql, duration):
+            plan = explain(context['connection'], sql, params)
+        log_query(sql, duration, plan)
+    return result
+
+
+def top_offender(sql, duration):
+    """
+    Учитывает время запроса, возвращает True, если его план ещё
+    не записан, а запрос входит в SLOW_QUERY_EXPLAIN_TOP самых медленных
+    по суммарному времени
+    """
+    with _lock:
+        total = _offenders.get(sql, 0) + duration
+        if sql not in _offenders and len(_offenders) >= MAX_OFFENDERS:
+            fastest = min(_offenders, key=_offenders.get)
+            if _offenders[fastest] > total:
+                return False
+            del _offenders[fastest]
+        _offenders[sql] = total
+        if sql in _explained:
+            return False
+        slower = sum(1 for value in _offenders.values() if value > total)
+        if slower >= settings.SLOW_QUERY_EXPLAIN_TOP:
+            return False
+        _explained.add(sql)
+        return True
+
+
+def explain(connection, sql, params):
+    """
+    План выполнения запроса на чтение, None для прочих запросов
+    """
+    if not sql.lstrip().upper().startswith('SELECT'):
+        return None
+    prefix = ('EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite'
+              else 'EXPLAIN ')
+    # курсор драйвера: EXPLAIN не проходит через execute_wrapper
+    # и не попадает в метрики запроса
+    try:
+        with connection.cursor() as cursor:
+            cursor.cursor.execute(prefix + sql, params)
+            rows = cursor.cursor.fetchall()
+    except Exception as error:
+        return f'план не получен: {error}'
+    plan = '\n'.join(' '.join(str(value) for value in row) for row in rows)
+    return LITERAL.sub("'?'", plan)
+
+
+def log_query(sql, duration, plan=None):
+    """
+    Пишет шаблон запроса без параметров: в них бывают токены, хеши
+    паролей и адреса почты
+    """
+    message = '%.1f ms [%s] %s'
+    args = [duration, get_caller() or '-', sql]
+    if plan:
+        message += '\n%s'
+        args.append(plan)
+    logger.warning(message, *args)
+
+
+def reset():
+    with _lock:
+        _offenders.clear()
+        _explained.clear()
+
+
+@task_prerun.connect
+def task_started(task, **kwargs):
+    stack = ExitStack()
+    stack.enter_context(caller(f'task:{task.name}'))
+    # задача может выполняться внутри другой (CELERY_TASK_ALWAYS_EAGER)
+    _local.tasks = getattr(_local, 'tasks', []) + [stack]
+
+
+@task_postrun.connect
+def task_finished(**kwargs):
+    tasks = getattr(_local, 'tasks', None)
+    if tasks:
+        tasks.pop().close()
@@ -1,47 +1,209 @@
 # TODO: Отказ от django signals с дальнейшей интеграцией
 #  в проект Celery для асинхронных задач
 
+import json
+import time
+from datetime import timedelta
+from io import StringIO
+from itertools import groupby
+from operator import attrgetter
+from smtplib import SMTPException
+
 from celery.task import task
 from celery.utils.log import get_task_logger
 
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.cache import cache
+from django.db import transaction, OperationalError
+from django.db.models import Min, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 
-from .models import User
+from .exports import export_catalog, save_export, write_text, order_rows, \
+    ORDER_EXPORT_FORMATS
+from .invoices import invoice_rows, group_invoices, render_csv, render_html
+from .mail import send_messages
+from .models import OutgoingEmail, OrderDigestEntry, ExportJob, \
+    STATE_CHOICES
 
 from django.http import JsonResponse
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError
 
-from requests import get
+from requests import get, RequestException
 from yaml import load as load_yaml, Loader
 
 from .models import Shop, Category, Product, ProductInfo, Parameter, \
-    ProductParameter, ConfirmEmailToken
+    ProductParameter
+from . import cache as catalog_cache
+from .prometheus import IMPORT_ROWS
 
 
 logger = get_task_logger(__name__)
 
-@task(name="send_new_user_email")
-def send_new_user_email_task(user_id, **kwargs):
-    """
-    Отправляем письмо с подтверждением почтового ящика
-    """
-    token, _ = ConfirmEmailToken.objects.get_or_create(user_id=user_id)
-    msg = EmailMultiAlternatives(
-        # Заголовок письма
-        f'Токен для подтверждения почты {token.user.email}',
-        # Сообщение
-        token.key,
-        # От:
-        settings.EMAIL_HOST_USER,
-        # Кому:
-        [token.user.email]
-    )
-    msg.send()
+EMAIL_FLUSH_SCHEDULED_KEY = 'mail:flush-scheduled'
+
+# Отправка писем: повтор с экспоненциальной задержкой и разбросом
+# при сбоях SMTP и сети, жёсткие ограничения по времени
+EMAIL_TASK_OPTIONS = {
+    'autoretry_for': (SMTPException, OSError),
+    'retry_backoff': 5,
+    'retry_backoff_max': 10 * 60,
+    'retry_jitter': True,
+    'max_retries': 10,
+    'soft_time_limit': 5 * 60,
+    'time_limit': 6 * 60,
+}
+
+# Подготовка писем: только запросы к базе
+NOTIFICATION_TASK_OPTIONS = {
+    'autoretry_for': (OperationalError,),
+    'retry_backoff': True,
+    'retry_jitter': True,
+    'max_retries': 5,
+    'soft_time_limit': 30,
+    'time_limit': 60,
+}
+
+# Импорт прайса: повтор при сетевых сбоях загрузки файла
+IMPORT_TASK_OPTIONS = {
+    'autoretry_for': (RequestException,),
+    'retry_backoff': 10,
+    'retry_backoff_max': 10 * 60,
+    'retry_jitter': True,
+    'max_retries': 5,
+    'soft_time_limit': 10 * 60,
+    'time_limit': 11 * 60,
+}
+
+# Накладные: повтор при сбоях базы, запас времени на отрисовку
+INVOICE_TASK_OPTIONS = {
+    'autoretry_for': (OperationalError,),
+    'retry_backoff': 5,
+    'retry_backoff_max': 10 * 60,
+    'retry_jitter': True,
+    'max_retries': 10,
+    'soft_time_limit': 10 * 60,
+    'time_limit': 11 * 60,
+}
+
+# Выгрузки: долгие запросы к базе, повтор только при сбоях базы
+EXPORT_TASK_OPTIONS = {
+    'autoretry_for': (OperationalError,),
+    'retry_backoff': True,
+    'retry_jitter': True,
+    'max_retries': 3,
+    'soft_time_limit': 30 * 60,
+    'time_limit': 31 * 60,
+}
+
+INVOICE_FORMATS = (
+    ('csv', 'text/csv', render_csv),
+    ('html', 'text/html', render_html),
+)
+
+def queue_email(subject, body, recipients):
+    """
+    Ставит письмо в очередь исходящих и планирует её разбор
+    """
+    queue_emails([(subject, body, recipients)])
+
+def queue_emails(emails):
+    """
+    Ставит письма в очередь исходящих одним INSERT и планирует её разбор.
+    Разбор откладывается на EMAIL_FLUSH_DELAY секунд, чтобы письма,
+    поставленные за это время, ушли одной пачкой
+    принимает список (тема, текст, получатели)
+    """
+    OutgoingEmail.objects.bulk_create([
+        OutgoingEmail(subject=subject, body=body,
+                      recipients=','.join(recipients))
+        for subject, body, recipients in emails])
+    schedule_email_flush()
+
+def schedule_email_flush():
+    """
+    Планирует разбор очереди исходящих через EMAIL_FLUSH_DELAY секунд,
+    если он ещё не запланирован
+    """
+    if cache.add(EMAIL_FLUSH_SCHEDULED_KEY, True, settings.EMAIL_FLUSH_DELAY):
+        send_queued_emails_task.apply_async(
+            countdown=settings.EMAIL_FLUSH_DELAY)
+
+def claim_emails():
+    """
+    Берёт в отправку пачку из EMAIL_BATCH_SIZE писем очереди
+    в короткой транзакции. Вложения читаются при отправке письма,
+    поэтому в памяти находятся вложения только одного письма
+    возвращает список писем
+    """
+    now = timezone.now()
+    expired = now - timedelta(seconds=settings.EMAIL_CLAIM_TIMEOUT)
+    with transaction.atomic():
+        batch = list(OutgoingEmail.objects.select_for_update(
+            skip_locked=True
+        ).filter(
+            Q(claimed_at=None) | Q(claimed_at__lt=expired), sent_at=None
+        ).defer('attachments').order_by('id')[:settings.EMAIL_BATCH_SIZE])
+        OutgoingEmail.objects.filter(
+            id__in=[email.id for email in batch]
+        ).update(claimed_at=now)
+    return batch
+
+def release_emails(batch):
+    """
+    Возвращает в очередь неотправленные письма пачки
+    """
+    OutgoingEmail.objects.filter(
+        id__in=[email.id for email in batch], sent_at=None
+    ).update(claimed_at=None)
 
-@task(name="send_password_reset_token_email")
+@task(name="send_queued_emails", **EMAIL_TASK_OPTIONS)
+def send_queued_emails_task():
+    """
+    Разбираем очередь исходящих писем: пачки по EMAIL_BATCH_SIZE писем
+    отправляются вне транзакции через одно SMTP-соединение воркера.
+    Письмо отмечается отправленным сразу после отправки, поэтому
+    повтор задачи после сбоя не отправляет его ещё раз.
+    Запуск длится не дольше EMAIL_DRAIN_SECONDS (меньше ограничения
+    времени задачи), остаток очереди разбирает следующий запуск
+    """
+    cache.delete(EMAIL_FLUSH_SCHEDULED_KEY)
+    deadline = time.monotonic() + settings.EMAIL_DRAIN_SECONDS
+    sent = 0
+    while True:
+        batch = claim_emails()
+        if not batch:
+            return sent
+        try:
+            for email in batch:
+                if time.monotonic() >= deadline:
+                    break
+                send_messages([email.as_message()])
+                OutgoingEmail.objects.filter(id=email.id).update(
+                    sent_at=timezone.now())
+                sent += 1
+        except Exception:
+            # неотправленные письма пачки сразу возвращаются в очередь
+            release_emails(batch)
+            raise
+        if time.monotonic() >= deadline:
+            release_emails(batch)
+            schedule_email_flush()
+            return sent
+
+@task(name="send_email", **NOTIFICATION_TASK_OPTIONS)
+def send_email_task(payload, **kwargs):
+    """
+    Отправляем заранее подготовленное письмо.
+    Письмо формируется на стороне веб-приложения (backend.notifications),
+    поэтому задача не читает базу и только ставит письмо в очередь
+    :param payload: словарь с ключами 'to', 'subject', 'body'
+    """
+    queue_email(payload['subject'], payload['body'], payload['to'])
+
+@task(name="send_password_reset_token_email", **NOTIFICATION_TASK_OPTIONS)
 def send_password_reset_token_email_task(sender, instance,
                                          reset_password_token, **kwargs):
     """
@@ -50,37 +212,135 @@ def send_password_reset_token_email_task(sender, instance,
     :param instance: Зависит от инстанса-источника сигнала
     :param reset_password_token: объект модели Token
     """
-    msg = EmailMultiAlternatives(
+    queue_email(
         # title
-        f'Токен сброса пароля для пользователя {reset_password_token.user}'
+        f'Токен сброса пароля для пользователя {reset_password_token.user}',
         # message
         f'Токен: "{reset_password_token.key}"',
-        # from
-        settings.EMAIL_HOST_USER,
         # to
         [reset_password_token.user.email]
     )
-    msg.send()
-
-@task(name="send_new_order_email")
-def send_new_order_email_task(user_id, **kwargs):
-    """
-    Отправляем письмо об изменении статуса заказа
-    """
-    user =User.objects.get(id=user_id)
-    msg = EmailMultiAlternatives(
-        # Заголовок
-        f'Обновление статуса заказа',
-        # Сообщение
-        f'Заказ сформирован',
-        # От:
-        settings.EMAIL_HOST_USER,
-        # Кому:
-        [user.email]
-    )
-    msg.send()
 
-@task(name="do_import")
+@task(name="send_order_digests", **NOTIFICATION_TASK_OPTIONS)
+def send_order_digests_task():
+    """
+    Отправляем сводки по заказам: пользователям, у которых самое раннее
+    неотправленное событие старше ORDER_DIGEST_WINDOW секунд,
+    уходит одно письмо со всеми накопленными событиями
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.ORDER_DIGEST_WINDOW)
+    states = dict(STATE_CHOICES)
+    with transaction.atomic():
+        due_users = OrderDigestEntry.objects.values(
+            'user_id'
+        ).annotate(
+            first_event=Min('created_at')
+        ).filter(
+            first_event__lte=cutoff
+        ).values('user_id')
+        entries = list(OrderDigestEntry.objects.filter(
+            user_id__in=due_users
+        ).select_for_update(of=('self',)).select_related('user').order_by(
+            'user_id', 'id'))
+        if not entries:
+            return 0
+
+        emails = []
+        for user, user_entries in groupby(entries, key=attrgetter('user')):
+            lines = [f'Заказ №{entry.order_id}: {states[entry.state]}'
+                     for entry in user_entries]
+            emails.append((
+                # Заголовок
+                f'Сводка по заказам ({len(lines)})',
+                # Сообщение
+                '\n'.join(lines),
+                # Кому:
+                [user.email]
+            ))
+        queue_emails(emails)
+        OrderDigestEntry.objects.filter(
+            id__in=[entry.id for entry in entries]).delete()
+    return len(emails)
+
+@task(name="render_invoices", **INVOICE_TASK_OPTIONS)
+def render_invoices_task(order_ids):
+    """
+    Ставим в очередь исходящих накладные по оформленным заказам
+    для администратора: одно письмо на заказ, во вложениях накладные
+    каждого магазина в CSV и HTML. Строки всех заказов читаются одним
+    запросом, письмо заказа записывается в очередь сразу после отрисовки.
+    Письмо ставится с ключом заказа, поэтому повтор задачи не ставит
+    в очередь уже поставленные письма
+    :param order_ids: список id заказов
+    возвращает количество заказов
+    """
+    count = 0
+    invoices = group_invoices(invoice_rows(order_ids))
+    for order_id, order_invoices in groupby(invoices,
+                                            key=attrgetter('order_id')):
+        attachments = []
+        for invoice in order_invoices:
+            for extension, mimetype, render in INVOICE_FORMATS:
+                out = StringIO()
+                render(invoice, out)
+                attachments.append((f'{invoice.filename}.{extension}',
+                                    out.getvalue(), mimetype))
+        OutgoingEmail.objects.bulk_create([OutgoingEmail(
+            key=f'invoice:{order_id}',
+            # title:
+            subject=f'Накладная по заказу №{order_id}',
+            # message:
+            body=f'Заказ №{order_id} сформирован, накладные во вложении',
+            # to:
+            recipients=','.join(settings.INVOICE_RECIPIENTS),
+            attachments=json.dumps(attachments, ensure_ascii=False)
+        )], ignore_conflicts=True)
+        count += 1
+    if count:
+        schedule_email_flush()
+    return count
+
+def run_export(job_id, build):
+    """
+    Формирует файл выгрузки: build(job) возвращает функцию записи файла.
+    При ошибке выгрузка помечается как неудавшаяся
+    """
+    ExportJob.objects.filter(id=job_id).update(state='running')
+    job = ExportJob.objects.get(id=job_id)
+    try:
+        save_export(job, build(job))
+    except Exception as e:
+        ExportJob.objects.filter(id=job_id).update(
+            state='failed', error=str(e), finished_at=timezone.now())
+        raise
+    return job.file.name
+
+@task(name="export_catalog", **EXPORT_TASK_OPTIONS)
+def export_catalog_task(job_id):
+    """
+    Выгружаем каталог магазина в файл
+    :param job_id: id выгрузки ExportJob, параметры: {'shop': id магазина}
+    """
+    def build(job):
+        shop = Shop.objects.get(id=job.get_params()['shop'])
+        return write_text(export_catalog(shop, job.file_format))
+    return run_export(job_id, build)
+
+@task(name="export_orders", **EXPORT_TASK_OPTIONS)
+def export_orders_task(job_id):
+    """
+    Выгружаем позиции заказов за период для бухгалтерии
+    :param job_id: id выгрузки ExportJob, параметры: {'date_from',
+    'date_to' - даты в формате ISO, 'shop' - id магазина или None}
+    """
+    def build(job):
+        params = job.get_params()
+        rows = order_rows(parse_date(params['date_from']),
+                          parse_date(params['date_to']), params.get('shop'))
+        return ORDER_EXPORT_FORMATS[job.file_format](rows)
+    return run_export(job_id, build)
+
+@task(name="do_import", **IMPORT_TASK_OPTIONS)
 def do_import_task(partner, url):
     # url = request.data.get('url')
     if url:
@@ -90,7 +350,7 @@ def do_import_task(partner, url):
         except ValidationError as e:
             return {'Status': False, 'Error': str(e)}
         else:
-            stream = get(url).content
+            stream = get(url, timeout=settings.IMPORT_HTTP_TIMEOUT).content
 
         data = load_yaml(stream, Loader=Loader)
         try:
@@ -105,9 +365,12 @@ def do_import_task(partner, url):
             category_object.shops.add(shop.id)
             category_object.save()
 
-        ProductInfo.objects.filter(shop_id=shop.id).delete()
+        # delete() считает и каскадно удалённые строки других таблиц
+        _, deleted = ProductInfo.objects.filter(shop_id=shop.id).delete()
+        IMPORT_ROWS.labels('deleted').inc(
+            deleted.get(ProductInfo._meta.label, 0))
         for item in data['goods']:
-            product, _ = Product.objects.get_or_create(
+            product, created = Product.objects.get_or_create(
                 name=item['name'], category_id=item['category']
             )
             product_info = ProductInfo.objects.create(
@@ -116,6 +379,7 @@ def do_import_task(partner, url):
                 price_rrc=item['price_rrc'], quantity=item['quantity'],
                 shop_id=shop.id
             )
+            IMPORT_ROWS.labels('inserted').inc()
             for name, value in item['parameters'].items():
                 parameter_object, _ = Parameter.objects.get_or_create(
                     name=name
@@ -124,6 +388,7 @@ def do_import_task(partner, url):
                     product_info_id=product_info.id,
                     parameter_id=parameter_object.id, value=value
                 )
+        catalog_cache.invalidate(catalog_cache.CATEGORIES, catalog_cache.SHOPS)
         return {'Status': True}
     return {'Status': False, 'Errors': 'url is false'}
 
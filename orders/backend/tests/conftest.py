@@ -11,6 +11,15 @@ def django_db_setup(django_db_setup, django_db_blocker):
         call_command('loaddata', fixture_file)
 
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """
+    Счётчики throttling и прочие кэши не должны переходить между тестами
+    """
+    from django.core.cache import cache
+    cache.clear()
+
+
 # @pytest.fixture(scope='session')
 # def celery_config():
 #     return {
@@ -0,0 +1,150 @@
+import asyncio
+import json
+
+import pytest
+
+from orders.asgi import WSGIBridge, application
+
+
+def call(app, method, path, body=b'', query=b'', headers=(),
+         requests=None, fail_after=None):
+    """
+    Выполняет запрос к ASGI-приложению, возвращает сообщения ответа.
+    fail_after - число сообщений, после которого клиент отключается
+    """
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query, 'headers': list(headers),
+             'client': ('127.0.0.1', 50000), 'server': ('testserver', 80)}
+    if requests is None:
+        requests = [{'type': 'http.request', 'body': body[:3],
+                     'more_body': True},
+                    {'type': 'http.request', 'body': body[3:]}]
+    sent = []
+
+    async def receive():
+        return requests.pop(0)
+
+    async def send(message):
+        if fail_after is not None and len(sent) >= fail_after:
+            raise OSError('Соединение закрыто клиентом')
+        sent.append(message)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(app(scope, receive, send))
+    finally:
+        loop.close()
+    return sent
+
+
+def response_json(sent):
+    return json.loads(b''.join(message.get('body', b'')
+                               for message in sent[1:]))
+
+
+@pytest.mark.django_db
+def test_read_endpoint_through_bridge():
+    sent = call(application, 'GET', '/api/shops')
+    assert sent[0]['status'] == 200
+    assert (b'content-type', b'application/json') in sent[0]['headers']
+    assert response_json(sent)['count'] >= 1
+
+
+@pytest.mark.django_db
+def test_request_body_passed_to_django():
+    sent = call(application, 'POST', '/api/user/login',
+                body=json.dumps({'email': 'nobody@example.com',
+                                 'password': 'wrong'}).encode(),
+                headers=[(b'content-type', b'application/json')])
+    assert sent[0]['status'] == 200
+    assert response_json(sent)['Status'] is False
+
+
+def test_hot_reads_use_separate_pool():
+    assert application.choose_pool(
+        {'method': 'GET', 'path': '/api/products'}) is application.read_pool
+    assert application.choose_pool(
+        {'method': 'POST', 'path': '/api/basket'}) is application.pool
+    assert application.choose_pool(
+        {'method': 'GET', 'path': '/api/partner/orders'}) is application.pool
+
+
+class Streaming(list):
+    streaming = True
+
+    def close(self):
+        pass
+
+
+def streaming_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/csv')])
+    return Streaming([b'a,b\n', b'', b'1,2\n'])
+
+
+def test_streaming_response():
+    bridge = WSGIBridge(streaming_app, 1, 1, [], queue_timeout=1)
+    sent = call(bridge, 'GET', '/api/export')
+    assert [message.get('body') for message in sent[1:]] == [
+        b'a,b\n', b'1,2\n', None]
+    assert sent[1]['more_body'] and not sent[-1].get('more_body')
+
+
+def test_disconnect_while_reading_body_skips_django():
+    calls = []
+
+    def app(environ, start_response):
+        calls.append(environ)
+        return streaming_app(environ, start_response)
+
+    bridge = WSGIBridge(app, 1, 1, [], queue_timeout=1)
+    sent = call(bridge, 'POST', '/api/basket', requests=[
+        {'type': 'http.request', 'body': b'{"ite', 'more_body': True},
+        {'type': 'http.disconnect'}])
+    assert sent == []
+    assert calls == []
+
+
+class Endless:
+    """
+    Бесконечная потоковая выгрузка
+    """
+    streaming = True
+
+    def __init__(self):
+        self.produced = 0
+        self.closed = False
+
+    def __iter__(self):
+        while not self.closed:
+            self.produced += 1
+            yield b'row\n'
+
+    def close(self):
+        self.closed = True
+
+
+def test_streaming_stops_when_client_disconnects():
+    result = Endless()
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/csv')])
+        return result
+
+    bridge = WSGIBridge(app, 1, 1, [], queue_timeout=1, buffer=1)
+    sent = call(bridge, 'GET', '/api/export', fail_after=3)
+    assert len(sent) == 3
+    assert result.closed
+    # после ошибки отправки дочитывается не больше буфера
+    assert result.produced < 10
+
+
+def test_busy_pool_returns_503():
+    bridge = WSGIBridge(streaming_app, 1, 1, [], queue_timeout=0.01)
+
+    async def occupied(scope, receive, send):
+        await bridge.pool.acquire(1)
+        await WSGIBridge.__call__(bridge, scope, receive, send)
+
+    sent = call(occupied, 'GET', '/api/export')
+    assert sent[0]['status'] == 503
+    assert response_json(sent)['Status'] is False
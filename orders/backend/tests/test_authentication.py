@@ -0,0 +1,146 @@
+from collections import OrderedDict
+
+import pytest
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+
+from .. import authentication
+from ..models import User
+
+
+@pytest.fixture
+def token():
+    authentication._local.clear()
+    authentication._synced['at'] = None
+    token, _ = Token.objects.get_or_create(user_id=3)
+    yield token
+    authentication._local.clear()
+
+
+@pytest.fixture
+def token_client(token):
+    from rest_framework.test import APIClient
+    api_client = APIClient()
+    api_client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+    return api_client
+
+
+@pytest.mark.django_db
+def test_cache_hit_skips_token_query(token_client, django_assert_num_queries):
+    url = reverse('backend:user-contact')
+    with django_assert_num_queries(2):
+        assert token_client.get(url).status_code == 200
+    # остаётся только запрос контактов
+    with django_assert_num_queries(1):
+        assert token_client.get(url).status_code == 200
+
+    # после истечения локального TTL снимок берётся из общего кэша
+    authentication._local.clear()
+    with django_assert_num_queries(1):
+        assert token_client.get(url).status_code == 200
+
+
+@pytest.mark.django_db
+def test_deactivation_and_password_change_invalidate(token_client):
+    url = reverse('backend:user-contact')
+    assert token_client.get(url).status_code == 200
+
+    user = User.objects.get(pk=3)
+    user.is_active = False
+    user.save()
+    assert token_client.get(url).status_code == 401
+
+    user.is_active = True
+    user.save()
+    response = token_client.post(reverse('backend:user-details'),
+                                 {'password': 'Another-strong-password-1'})
+    assert response.json()['Status'] is True
+    user.refresh_from_db()
+    assert user.check_password('Another-strong-password-1')
+
+
+@pytest.mark.django_db
+def test_token_delete_invalidates(token, token_client):
+    url = reverse('backend:user-contact')
+    assert token_client.get(url).status_code == 200
+    token.delete()
+    assert token_client.get(url).status_code == 401
+
+
+def other_process(monkeypatch, action):
+    """
+    Выполняет action так, будто это другой процесс со своим локальным LRU
+    """
+    local = authentication._local
+    monkeypatch.setattr(authentication, '_local', OrderedDict())
+    action()
+    monkeypatch.setattr(authentication, '_local', local)
+
+
+@pytest.mark.django_db
+def test_invalidation_in_other_process_drops_local_snapshot(
+        token, token_client, settings, monkeypatch):
+    url = reverse('backend:user-contact')
+    assert token_client.get(url).status_code == 200
+    assert token.key in authentication._local
+
+    # другой процесс блокирует пользователя: его локальный LRU - свой
+    User.objects.filter(pk=3).update(is_active=False)
+    other_process(monkeypatch,
+                  lambda: authentication.invalidate_tokens([token.key]))
+    assert token.key in authentication._local
+
+    # до сверки с общим кэшем действует локальный снимок
+    assert token_client.get(url).status_code == 200
+    settings.AUTH_TOKEN_REVOCATION_CHECK = 0
+    assert token_client.get(url).status_code == 401
+
+
+@pytest.mark.django_db
+def test_invalidation_keeps_other_local_snapshots(
+        token, token_client, settings, monkeypatch,
+        django_assert_num_queries):
+    from rest_framework.test import APIClient
+    url = reverse('backend:user-contact')
+    other, _ = Token.objects.get_or_create(user_id=2)
+    other_client = APIClient()
+    other_client.credentials(HTTP_AUTHORIZATION=f'Token {other.key}')
+    assert token_client.get(url).status_code == 200
+    assert other_client.get(url).status_code == 200
+
+    settings.AUTH_TOKEN_REVOCATION_CHECK = 0
+    other_process(monkeypatch,
+                  lambda: authentication.invalidate_tokens([other.key]))
+    assert other.key in authentication._local
+    # сверка удаляет только отозванный ключ
+    with django_assert_num_queries(1):
+        assert token_client.get(url).status_code == 200
+    assert token.key in authentication._local
+    assert other.key not in authentication._local
+
+
+@pytest.mark.django_db
+def test_login_and_new_user_keep_snapshots(token, token_client):
+    url = reverse('backend:user-contact')
+    assert token_client.get(url).status_code == 200
+    revoked = authentication.get_versions(
+        authentication.caches['default'])[0]
+
+    User.objects.create_user(email='new@example.com', password='x')
+    user = User.objects.get(pk=3)
+    user.last_login = user.date_joined
+    user.save(update_fields=['last_login'])
+    assert authentication.get_versions(
+        authentication.caches['default'])[0] == revoked
+    assert token.key in authentication._local
+
+
+@pytest.mark.django_db
+def test_bulk_update_needs_invalidate_all(token_client):
+    url = reverse('backend:user-contact')
+    assert token_client.get(url).status_code == 200
+
+    User.objects.filter(pk=3).update(is_active=False)
+    assert token_client.get(url).status_code == 200
+    authentication.invalidate_all_tokens()
+    assert token_client.get(url).status_code == 401
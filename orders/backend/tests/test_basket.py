@@ -0,0 +1,94 @@
+import pytest
+from django.urls import reverse
+
+from ..models import User, OrderItem
+
+
+@pytest.fixture
+def buyer_client():
+    from rest_framework.test import APIClient
+    api_client = APIClient()
+    api_client.force_authenticate(user=User.objects.get(pk=3))
+    yield api_client
+    api_client.force_authenticate(user=None)
+
+
+@pytest.fixture
+def test_basket():
+    return {'items': '[{"quantity": 2, "product_info": 1}]'}
+
+
+@pytest.mark.django_db
+def test_basket_post_idempotency_key_replays(buyer_client, test_basket):
+    url = reverse('backend:basket')
+    first = buyer_client.post(url, test_basket, HTTP_IDEMPOTENCY_KEY='k-1')
+    assert first.json()['Status'] is True
+    assert 'Idempotent-Replayed' not in first
+
+    repeat = buyer_client.post(url, test_basket, HTTP_IDEMPOTENCY_KEY='k-1')
+    assert repeat.status_code == first.status_code
+    assert repeat.json() == first.json()
+    assert repeat['Idempotent-Replayed'] == 'true'
+    assert OrderItem.objects.filter(order__user_id=3,
+                                    product_info_id=1).count() == 1
+
+
+@pytest.mark.django_db
+def test_idempotency_key_reused_for_other_payload(buyer_client, test_basket):
+    url = reverse('backend:basket')
+    buyer_client.post(url, test_basket, HTTP_IDEMPOTENCY_KEY='k-2')
+    response = buyer_client.post(
+        url, {'items': '[{"quantity": 1, "product_info": 2}]'},
+        HTTP_IDEMPOTENCY_KEY='k-2')
+    assert response.status_code == 422
+
+
+@pytest.fixture(params=[True, False], ids=['upsert', 'fallback'])
+def merge_strategy(request, monkeypatch):
+    monkeypatch.setattr(OrderItem.objects.__class__, 'supports_upsert',
+                        lambda manager: request.param)
+    return request.param
+
+
+@pytest.mark.django_db
+def test_basket_post_merges_quantities(buyer_client, merge_strategy):
+    url = reverse('backend:basket')
+    response = buyer_client.post(url, {
+        'items': '[{"quantity": 1, "product_info": 4},'
+                 '{"quantity": 2, "product_info": 4},'
+                 '{"quantity": 1, "product_info": 5}]'})
+    assert response.json() == {'Status': True, 'Создано объектов': 2}
+
+    response = buyer_client.post(url, {
+        'items': '[{"quantity": 5, "product_info": 4},'
+                 '{"quantity": 1, "product_info": 8}]'})
+    assert response.json()['Status'] is True
+    assert dict(OrderItem.objects.filter(
+        order__user_id=3, order__state='basket'
+    ).values_list('product_info_id', 'quantity')) == {4: 8, 5: 1, 8: 1}
+
+
+@pytest.mark.django_db
+def test_basket_post_rejects_unknown_product(buyer_client):
+    url = reverse('backend:basket')
+    response = buyer_client.post(
+        url, {'items': '[{"quantity": 1, "product_info": 100500}]'})
+    assert response.json()['Status'] is False
+
+
+@pytest.mark.django_db
+def test_basket_post_accepts_string_numbers(buyer_client):
+    url = reverse('backend:basket')
+    response = buyer_client.post(
+        url, {'items': '[{"quantity": "5", "product_info": "4"}]'})
+    assert response.json() == {'Status': True, 'Создано объектов': 1}
+    assert dict(OrderItem.objects.filter(
+        order__user_id=3, order__state='basket'
+    ).values_list('product_info_id', 'quantity')) == {4: 5}
+
+    for items in ('[{"quantity": "пять", "product_info": 4}]',
+                  '[{"quantity": 0, "product_info": 4}]',
+                  '[{"product_info": 4}]', '[4]'):
+        response = buyer_client.post(url, {'items': items})
+        assert response.status_code == 400
+        assert response.json()['Status'] is False
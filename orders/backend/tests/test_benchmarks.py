@@ -0,0 +1,61 @@
+import io
+
+import pytest
+from yaml import load as load_yaml, Loader
+
+from benchmarks.catalog import write_catalog, shop_name
+from benchmarks.common import percentile, summarize
+
+from .. import tasks
+from ..models import ProductInfo, Shop, User
+
+
+def generated_catalog(goods=20, seed=0):
+    out = io.StringIO()
+    write_catalog(out, 1, goods, categories=5, parameters=6, seed=seed)
+    return out.getvalue()
+
+
+def test_catalog_matches_price_format():
+    data = load_yaml(generated_catalog(), Loader=Loader)
+    assert data['shop'] == shop_name(1)
+    assert len(data['categories']) == 5
+    assert len(data['goods']) == 20
+    category_ids = {category['id'] for category in data['categories']}
+    for item in data['goods']:
+        assert item['category'] in category_ids
+        assert item['price_rrc'] >= item['price']
+        assert len(item['parameters']) == 4
+    assert len({item['id'] for item in data['goods']}) == 20
+
+
+def test_catalog_is_repeatable():
+    assert generated_catalog(seed=1) == generated_catalog(seed=1)
+    assert generated_catalog(seed=1) != generated_catalog(seed=2)
+
+
+@pytest.mark.django_db
+def test_generated_catalog_imports(monkeypatch):
+    class Response:
+        content = generated_catalog().encode()
+
+    monkeypatch.setattr(tasks, 'get', lambda url, timeout: Response)
+    partner = User.objects.create(email='bench-partner-1@example.com',
+                                  username='bench-partner-1@example.com',
+                                  type='shop', is_active=True)
+    assert tasks.do_import_task(
+        partner.id, 'http://127.0.0.1/shop-1.yaml') == {'Status': True}
+    shop = Shop.objects.get(user=partner)
+    assert ProductInfo.objects.filter(shop=shop).count() == 20
+
+
+def test_summarize():
+    samples = [(200, 0.01 * number, number % 3) for number in range(1, 101)]
+    samples.append((0, 5.0, None))
+    result = summarize(samples, 2.0)
+    assert result['requests'] == 101
+    assert result['statuses'] == {'0': 1, '200': 100}
+    assert result['p50'] == 500.0
+    assert result['p99'] == 990.0
+    assert result['queries_max'] == 2
+    assert percentile([], 50) is None
@@ -0,0 +1,113 @@
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from .. import cache as catalog_cache, tasks
+from ..models import Category, Shop, User
+
+PRICE = '''
+shop: Связной
+categories:
+  - id: 777
+    name: Новая категория
+goods: []
+'''.encode()
+
+
+def names(client, route):
+    response = client.get(reverse(route))
+    assert response.status_code == 200
+    return [item['name'] for item in response.json()['results']]
+
+
+def queries(client, route):
+    with CaptureQueriesContext(connection) as context:
+        client.get(reverse(route))
+    return len(context)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('route', ['backend:categories', 'backend:shops'])
+def test_listing_served_from_cache(client, route):
+    assert queries(client, route) > 0
+    assert queries(client, route) == 0
+    client.get(reverse(route), {'page': 2})
+    assert queries(client, route) == 0
+
+
+@pytest.mark.django_db
+def test_admin_edits_invalidate_categories(client):
+    category = Category.objects.order_by('id').first()
+    assert category.name in names(client, 'backend:categories')
+
+    category.name = 'Переименованная категория'
+    category.save()
+    assert 'Переименованная категория' in names(client, 'backend:categories')
+
+    category.delete()
+    assert 'Переименованная категория' not in names(client,
+                                                    'backend:categories')
+
+
+@pytest.mark.django_db
+def test_partner_state_invalidates_shops(client):
+    shop = Shop.objects.get(user__email='andrew@smith.com')
+    assert shop.name in names(client, 'backend:shops')
+
+    partner = APIClient()
+    partner.force_authenticate(user=shop.user)
+    response = partner.post(reverse('backend:partner-state'),
+                            {'state': 'off'})
+    assert response.json()['Status'] is True
+    assert shop.name not in names(client, 'backend:shops')
+
+
+@pytest.mark.django_db
+def test_import_invalidates_categories(client, monkeypatch):
+    class Response:
+        content = PRICE
+
+    assert 'Новая категория' not in names(client, 'backend:categories')
+    monkeypatch.setattr(tasks, 'get', lambda url, timeout: Response)
+    partner = User.objects.get(email='andrew@smith.com')
+    tasks.do_import_task(partner.id, 'http://example.com/price.yaml')
+    assert 'Новая категория' in names(client, 'backend:categories')
+
+
+@pytest.mark.django_db
+def test_versions_change_on_invalidation_and_eviction():
+    version = catalog_cache.get_version(catalog_cache.SHOPS)
+    assert catalog_cache.get_version(catalog_cache.SHOPS) == version
+    catalog_cache.invalidate(catalog_cache.SHOPS)
+    changed = catalog_cache.get_version(catalog_cache.SHOPS)
+    assert changed != version
+
+    catalog_cache.get_cache().delete(
+        catalog_cache.version_key(catalog_cache.SHOPS))
+    assert catalog_cache.get_version(catalog_cache.SHOPS) not in (
+        version, changed)
+
+
+@pytest.mark.django_db
+def test_products_follow_shop_state_without_join(client):
+    shop = Shop.objects.get(user__email='andrew@smith.com')
+    with CaptureQueriesContext(connection) as context:
+        response = client.get(reverse('backend:products'))
+    assert {item['shop'] for item in response.json()} >= {shop.id}
+    assert not any('JOIN "backend_shop"' in query['sql']
+                   for query in context.captured_queries)
+    # множество активных магазинов закэшировано
+    with CaptureQueriesContext(connection) as context:
+        client.get(reverse('backend:products'))
+    assert not any('FROM "backend_shop"' in query['sql']
+                   for query in context.captured_queries)
+
+    partner = APIClient()
+    partner.force_authenticate(user=shop.user)
+    partner.post(reverse('backend:partner-state'), {'state': 'off'})
+    response = client.get(reverse('backend:products'))
+    assert shop.id not in {item['shop'] for item in response.json()}
+    response = client.get(reverse('backend:products'), {'shop_id': shop.id})
+    assert response.json() == []
@@ -0,0 +1,54 @@
+from django.db.utils import ConnectionHandler
+
+from .. import database
+
+
+def test_sqlite_file_uses_wal(tmp_path, django_db_blocker):
+    handler = ConnectionHandler({'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': str(tmp_path / 'db.sqlite3'),
+        'OPTIONS': {'timeout': 20},
+    }})
+    connection = handler['default']
+    try:
+        with django_db_blocker.unblock(), connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            assert cursor.fetchone()[0] == 'wal'
+            cursor.execute('PRAGMA synchronous')
+            assert cursor.fetchone()[0] == 1
+            cursor.execute('PRAGMA temp_store')
+            assert cursor.fetchone()[0] == 2
+    finally:
+        connection.close()
+
+
+class FakeConnection:
+    def __init__(self, usable, opened=True, in_atomic_block=False):
+        self.connection = object() if opened else None
+        self.usable = usable
+        self.in_atomic_block = in_atomic_block
+        self.closed = False
+
+    def is_usable(self):
+        return self.usable
+
+    def close(self):
+        self.closed = True
+
+
+def test_broken_connections_closed_before_request(monkeypatch, settings):
+    settings.DB_HEALTH_CHECKS = True
+    broken = FakeConnection(usable=False)
+    healthy = FakeConnection(usable=True)
+    idle = FakeConnection(usable=False, opened=False)
+    in_transaction = FakeConnection(usable=False, in_atomic_block=True)
+    fakes = [broken, healthy, idle, in_transaction]
+    monkeypatch.setattr(database.connections, 'all', lambda: fakes)
+
+    database.check_request_connections()
+    assert [fake.closed for fake in fakes] == [True, False, False, False]
+
+    broken.closed = False
+    settings.DB_HEALTH_CHECKS = False
+    database.check_task_connections()
+    assert not broken.closed
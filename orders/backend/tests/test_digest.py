@@ -0,0 +1,71 @@
+import pytest
+from django.urls import reverse
+
+from ..models import User, Order, OrderItem, Contact, OutboxMessage, \
+    OrderDigestEntry, OutgoingEmail
+from ..notifications import notify_order_state_changes
+from ..tasks import send_order_digests_task, send_queued_emails_task
+
+
+@pytest.fixture
+def digest_user():
+    user = User.objects.get(pk=3)
+    user.order_digest = True
+    user.save()
+    return user
+
+
+@pytest.fixture
+def scheduled_flushes(monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(send_queued_emails_task, 'apply_async',
+                        lambda **kwargs: scheduled.append(kwargs))
+    return scheduled
+
+
+def make_basket(user):
+    order = Order.objects.create(user=user, state='basket')
+    OrderItem.objects.create(order=order, product_info_id=1, quantity=1)
+    return order
+
+
+@pytest.mark.django_db
+def test_checkout_with_digest_buffers_event(digest_user):
+    from rest_framework.test import APIClient
+    api_client = APIClient()
+    api_client.force_authenticate(user=digest_user)
+    contact = Contact.objects.create(user=digest_user, city='Москва',
+                                     street='Школьная ул.', phone='1')
+    order = make_basket(digest_user)
+
+    response = api_client.post(reverse('backend:order'),
+                               {'id': str(order.id), 'contact': contact.id})
+    assert response.json()['Status'] is True
+    assert list(OutboxMessage.objects.values_list('task', flat=True)) == [
+        'render_invoices']
+    assert list(OrderDigestEntry.objects.values_list(
+        'order_id', 'state')) == [(order.id, 'new')]
+
+
+@pytest.mark.django_db
+def test_digest_flush_sends_one_email_per_user(digest_user, settings,
+                                               scheduled_flushes):
+    orders = [make_basket(digest_user) for _ in range(3)]
+    changes = Order.objects.filter(
+        id__in=[order.id for order in orders]).transition('new')
+    notify_order_state_changes(changes, 'new')
+    other_changes = Order.objects.filter(id=orders[0].id).transition(
+        'confirmed')
+    notify_order_state_changes(other_changes, 'confirmed')
+
+    settings.ORDER_DIGEST_WINDOW = 60
+    assert send_order_digests_task() == 0
+
+    settings.ORDER_DIGEST_WINDOW = 0
+    assert send_order_digests_task() == 1
+    email = OutgoingEmail.objects.get()
+    assert email.recipients == digest_user.email
+    assert email.body.count('Заказ №') == 4
+    assert not OrderDigestEntry.objects.exists()
+    assert not OutboxMessage.objects.exists()
+    assert len(scheduled_flushes) == 1
@@ -0,0 +1,158 @@
+import csv
+import json
+from io import StringIO
+
+import pytest
+from django.urls import reverse
+from yaml import load as load_yaml, Loader
+
+from ..models import User, ProductInfo, ExportJob, OutboxMessage
+from ..tasks import export_catalog_task
+
+
+@pytest.fixture
+def partner_client():
+    from rest_framework.test import APIClient
+    api_client = APIClient()
+    api_client.force_authenticate(user=User.objects.get(pk=2))
+    return api_client
+
+
+def stream(response):
+    return b''.join(response.streaming_content).decode()
+
+
+@pytest.mark.django_db
+def test_yaml_export_matches_import_schema(partner_client,
+                                           django_assert_num_queries):
+    shop = User.objects.get(pk=2).shop
+    response = partner_client.get(reverse('backend:partner-export'))
+    assert response.status_code == 200
+    # категории, товары и параметры - независимо от размера каталога
+    with django_assert_num_queries(3):
+        data = load_yaml(stream(response), Loader=Loader)
+
+    assert data['shop'] == shop.name
+    assert {category['id'] for category in data['categories']} == set(
+        shop.categories.values_list('id', flat=True))
+    infos = ProductInfo.objects.filter(shop=shop).order_by('id')
+    assert [good['id'] for good in data['goods']] == list(
+        infos.values_list('external_id', flat=True))
+    first = infos.prefetch_related('product_parameters__parameter')[0]
+    assert data['goods'][0]['parameters'] == {
+        parameter.parameter.name: parameter.value
+        for parameter in first.product_parameters.all()}
+    assert data['goods'][0]['category'] == first.product.category_id
+
+
+@pytest.mark.django_db
+def test_csv_and_jsonl_export(partner_client):
+    url = reverse('backend:partner-export')
+    goods = [json.loads(line) for line in stream(
+        partner_client.get(url, {'type': 'jsonl'})).splitlines()]
+    rows = list(csv.DictReader(StringIO(stream(
+        partner_client.get(url, {'type': 'csv'})))))
+    assert [row['id'] for row in rows] == [str(good['id']) for good in goods]
+    assert json.loads(rows[0]['parameters']) == goods[0]['parameters']
+
+    response = partner_client.get(url, {'type': 'xml'})
+    assert response.json()['Status'] is False
+
+
+@pytest.mark.django_db
+def test_export_job_download(partner_client, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    response = partner_client.post(reverse('backend:partner-export'),
+                                   {'type': 'jsonl'})
+    job_id = response.json()['Job']
+    assert OutboxMessage.objects.get().task == 'export_catalog'
+
+    url = reverse('backend:export-job', kwargs={'pk': job_id})
+    response = partner_client.get(url)
+    assert response.status_code == 202
+    assert response.json()['State'] == 'pending'
+
+    export_catalog_task(job_id)
+    assert ExportJob.objects.get(id=job_id).state == 'done'
+    response = partner_client.get(url)
+    assert response.status_code == 200
+    assert stream(response) == stream(partner_client.get(
+        reverse('backend:partner-export'), {'type': 'jsonl'}))
+
+
+@pytest.fixture
+def accounting_orders():
+    from datetime import datetime
+    from django.utils import timezone
+    from ..models import Order, OrderItem, ShopOrderLine
+
+    orders = []
+    for day, items in ((1, [(3, 1), (6, 2)]), (2, [(1, 1)]), (5, [(3, 4)])):
+        order = Order.objects.create(user_id=3, state='new')
+        for product_info_id, quantity in items:
+            OrderItem.objects.create(order=order, quantity=quantity,
+                                     product_info_id=product_info_id)
+        Order.objects.filter(id=order.id).update(dt=timezone.make_aware(
+            datetime(2020, 3, day, 23, 30)))
+        orders.append(order)
+    ShopOrderLine.objects.fan_out([order.id for order in orders])
+    return orders
+
+
+def run_order_export(client, data):
+    from ..tasks import export_orders_task
+
+    job_id = client.post(reverse('backend:order-export'), data).json()['Job']
+    export_orders_task(job_id)
+    return client.get(reverse('backend:export-job', kwargs={'pk': job_id}))
+
+
+@pytest.mark.django_db
+def test_order_export_by_date_range(settings, tmp_path, accounting_orders,
+                                    django_assert_max_num_queries):
+    from rest_framework.test import APIClient
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.EXPORT_CHUNK_SIZE = 1
+    admin_client = APIClient()
+    admin_client.force_authenticate(user=User.objects.get(pk=1))
+
+    # порции по одной строке не увеличивают число запросов
+    with django_assert_max_num_queries(9):
+        response = run_order_export(admin_client, {
+            'date_from': '2020-03-01', 'date_to': '2020-03-02'})
+    rows = list(csv.DictReader(StringIO(stream(response))))
+    assert [(int(row['order_id']), int(row['quantity'])) for row in rows] == [
+        (accounting_orders[0].id, 1), (accounting_orders[0].id, 2),
+        (accounting_orders[1].id, 1)]
+
+    partner_client = APIClient()
+    partner_client.force_authenticate(user=User.objects.get(pk=2))
+    rows = list(csv.DictReader(StringIO(stream(run_order_export(
+        partner_client, {'date_from': '2020-03-01',
+                         'date_to': '2020-03-31'})))))
+    shop_id = User.objects.get(pk=2).shop.id
+    assert {row['shop_id'] for row in rows} == {str(shop_id)}
+
+
+@pytest.mark.django_db
+def test_order_export_parquet(settings, tmp_path, accounting_orders,
+                              partner_client):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    settings.MEDIA_ROOT = str(tmp_path)
+    response = run_order_export(partner_client, {
+        'date_from': '2020-03-01', 'date_to': '2020-03-31',
+        'type': 'parquet'})
+    table = parquet.read_table(response.file_to_stream.name)
+    assert table.num_rows == 2
+
+
+@pytest.mark.django_db
+def test_order_export_validation(partner_client):
+    url = reverse('backend:order-export')
+    response = partner_client.post(url, {'date_from': '2020-03-05',
+                                         'date_to': '2020-03-01'})
+    assert response.json()['Status'] is False
+    response = partner_client.post(url, {'date_from': '2020-03-01',
+                                         'date_to': '2020-03-05',
+                                         'type': 'xlsx'})
+    assert response.json()['Status'] is False
@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+from django.contrib.auth.hashers import make_password
+from django.urls import reverse
+
+from .. import hashing
+from ..hashing import HashingPool, HashingBusy
+from ..models import User
+
+
+def test_pool_rejects_when_saturated():
+    pool = HashingPool(workers=1, queue=1, timeout=5)
+    release = threading.Event()
+    running = [threading.Thread(target=pool.run, args=(release.wait,))
+               for _ in range(2)]
+    for thread in running:
+        thread.start()
+    while pool.slots._value:
+        time.sleep(0.001)
+    with pytest.raises(HashingBusy):
+        pool.run(lambda: None)
+    release.set()
+    for thread in running:
+        thread.join()
+    assert pool.run(lambda: 42) == 42
+
+
+def test_pool_times_out_queued_request():
+    pool = HashingPool(workers=1, queue=1, timeout=0.05)
+    release = threading.Event()
+    errors = []
+
+    def run_long():
+        try:
+            pool.run(release.wait)
+        except HashingBusy as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=run_long)
+    thread.start()
+    while pool.slots._value > 1:
+        time.sleep(0.001)
+    with pytest.raises(HashingBusy):
+        pool.run(lambda: None)
+    release.set()
+    thread.join()
+    # долгий хеш тоже не уложился в таймаут, но занимал место до конца
+    assert len(errors) == 1
+    assert pool.run(lambda: 42) == 42
+
+
+@pytest.mark.django_db
+def test_login_returns_503_when_hashing_busy(monkeypatch):
+    from rest_framework.test import APIClient
+    user = User.objects.get(pk=3)
+    user.set_password('strong_password')
+    user.save()
+    busy = HashingPool(workers=1, queue=0, timeout=1)
+    busy.slots.acquire()
+    monkeypatch.setattr(hashing, '_pool', busy)
+
+    response = APIClient().post(reverse('backend:user-login'),
+                                {'email': 'max@plankett.com',
+                                 'password': 'strong_password'})
+    assert response.status_code == 503
+    assert response['Retry-After'] == '1'
+
+    monkeypatch.setattr(hashing, '_pool', None)
+    response = APIClient().post(reverse('backend:user-login'),
+                                {'email': 'max@plankett.com',
+                                 'password': 'strong_password'})
+    assert response.json()['Status'] is True
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('algorithm', ['argon2', 'bcrypt_sha256'])
+def test_legacy_hash_upgraded_on_login(settings, algorithm):
+    pytest.importorskip({'argon2': 'argon2',
+                         'bcrypt_sha256': 'bcrypt'}[algorithm])
+    preferred = {'argon2': 'argon2', 'bcrypt_sha256': 'bcrypt'}[algorithm]
+    settings.PASSWORD_HASHERS = [
+        settings.POOLED_PASSWORD_HASHERS[preferred],
+        settings.POOLED_PASSWORD_HASHERS['pbkdf2']]
+    user = User.objects.get(pk=3)
+    user.password = make_password('strong_password', hasher='pbkdf2_sha256')
+    user.save()
+
+    assert user.check_password('strong_password')
+    user.refresh_from_db()
+    assert user.password.startswith(algorithm + '$')
+    assert user.check_password('strong_password')
@@ -0,0 +1,77 @@
+from datetime import datetime
+from decimal import Decimal
+from io import StringIO
+
+import pytest
+
+from ..invoices import group_invoices, render_csv, render_html
+from ..models import Order, OrderItem, OutgoingEmail, ShopOrderLine
+from ..tasks import render_invoices_task, send_queued_emails_task
+
+
+def synthetic_rows(orders, shops, lines):
+    """
+    Строки INVOICE_COLUMNS без обращения к базе
+    """
+    dt = datetime(2020, 5, 1, 12, 0)
+    for order_id in range(1, orders + 1):
+        for shop_id in range(1, shops + 1):
+            for line in range(lines):
+                yield (order_id, shop_id, f'Магазин {shop_id}', dt,
+                       'client@example.com', 'Москва', 'Школьная ул.', '1',
+                       '', '2', '+70000000000', f'Товар {line}',
+                       'model/<b>', 1000 + line, 2, Decimal('99.90'))
+
+
+def test_group_invoices_per_order_and_shop():
+    invoices = list(group_invoices(synthetic_rows(2, 2, 3)))
+    assert [(invoice.order_id, invoice.shop_id) for invoice in invoices] == [
+        (1, 1), (1, 2), (2, 1), (2, 2)]
+    assert invoices[0].total == Decimal('599.40')
+    assert invoices[0].contact == 'Москва, Школьная ул., 1, 2, +70000000000'
+
+    out = StringIO()
+    render_html(invoices[0], out)
+    assert 'model/&lt;b&gt;' in out.getvalue()
+
+
+def test_invoice_rendering_throughput():
+    csv_out, html_out = StringIO(), StringIO()
+    count = 0
+    for invoice in group_invoices(synthetic_rows(5000, 2, 5)):
+        for render, out in ((render_csv, csv_out), (render_html, html_out)):
+            out.seek(0)
+            out.truncate()
+            render(invoice, out)
+        count += 1
+    assert count == 10000
+
+
+@pytest.mark.django_db
+def test_render_invoices_task_queues_invoice_per_shop(
+        settings, monkeypatch, django_assert_num_queries):
+    settings.INVOICE_RECIPIENTS = ['admin@example.com']
+    monkeypatch.setattr(send_queued_emails_task, 'apply_async',
+                        lambda **kwargs: None)
+    order = Order.objects.create(user_id=3, state='new')
+    for product_info_id, quantity in ((3, 1), (6, 2)):
+        OrderItem.objects.create(order=order, quantity=quantity,
+                                 product_info_id=product_info_id)
+    ShopOrderLine.objects.fan_out([order.id])
+
+    # строки накладных и одна запись в очередь исходящих
+    with django_assert_num_queries(2):
+        assert render_invoices_task([order.id]) == 1
+    # повтор задачи не ставит письмо в очередь ещё раз
+    assert render_invoices_task([order.id]) == 1
+    [email] = OutgoingEmail.objects.filter(key=f'invoice:{order.id}')
+
+    message = email.as_message()
+    assert message.to == ['admin@example.com']
+    names = sorted(name for name, _, _ in message.attachments)
+    shops = sorted(set(ShopOrderLine.objects.filter(
+        order=order).values_list('shop_id', flat=True)))
+    assert len(shops) == 2
+    assert names == sorted(f'invoice-{order.id}-{shop_id}.{extension}'
+                           for shop_id in shops
+                           for extension in ('csv', 'html'))
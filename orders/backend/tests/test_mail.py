@@ -0,0 +1,198 @@
+import asyncore
+import smtpd
+import threading
+import time
+from smtplib import SMTPServerDisconnected
+from types import SimpleNamespace
+
+import pytest
+
+from orders.celery import app as celery_app
+
+from .. import tasks
+from .. import mail
+from ..mail import close_pooled_connection, wait_for_quota
+from ..models import OutgoingEmail
+from ..tasks import send_queued_emails_task
+
+
+class FakeSMTPServer(smtpd.SMTPServer):
+    """
+    Локальный SMTP-сервер, считающий соединения и принятые письма
+    """
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), None, decode_data=True)
+        self.connections = 0
+        self.messages = []
+
+    def handle_accepted(self, conn, addr):
+        self.connections += 1
+        super().handle_accepted(conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        self.messages.append((rcpttos, data))
+
+
+@pytest.fixture
+def smtp_server(settings):
+    server = FakeSMTPServer()
+    thread = threading.Thread(target=asyncore.loop,
+                              kwargs={'timeout': 0.01}, daemon=True)
+    thread.start()
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+    settings.EMAIL_HOST = '127.0.0.1'
+    settings.EMAIL_PORT = server.socket.getsockname()[1]
+    settings.EMAIL_USE_SSL = False
+    settings.EMAIL_HOST_USER = 'shop@localhost'
+    settings.EMAIL_HOST_PASSWORD = ''
+    settings.EMAIL_RATE_LIMIT = None
+    close_pooled_connection()
+    yield server
+    close_pooled_connection()
+    asyncore.close_all()
+    thread.join()
+
+
+def queue_emails(count):
+    OutgoingEmail.objects.bulk_create([
+        OutgoingEmail(subject=f'Заказ {number}', body='Заказ сформирован',
+                      recipients=f'buyer{number}@localhost')
+        for number in range(count)])
+
+
+def wait_for(server, count, timeout=10):
+    deadline = time.monotonic() + timeout
+    while len(server.messages) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+@pytest.mark.django_db
+def test_queued_emails_sent_over_one_connection(smtp_server, settings):
+    settings.EMAIL_BATCH_SIZE = 50
+    queue_emails(500)
+
+    assert send_queued_emails_task() == 500
+    wait_for(smtp_server, 500)
+
+    assert len(smtp_server.messages) == 500
+    assert smtp_server.connections == 1
+    assert not OutgoingEmail.objects.filter(sent_at=None).exists()
+
+
+@pytest.mark.django_db
+def test_failed_batch_resumes_without_resending(monkeypatch, settings):
+    settings.EMAIL_BATCH_SIZE = 5
+    queue_emails(5)
+    delivered = []
+
+    def send_messages(messages):
+        if len(delivered) == 2:
+            raise SMTPServerDisconnected('соединение разорвано')
+        delivered.extend(message.to[0] for message in messages)
+        return len(messages)
+
+    monkeypatch.setattr(tasks, 'send_messages', send_messages)
+    with pytest.raises(SMTPServerDisconnected):
+        send_queued_emails_task()
+    assert OutgoingEmail.objects.filter(sent_at=None).count() == 3
+    assert not OutgoingEmail.objects.filter(
+        sent_at=None).exclude(claimed_at=None).exists()
+
+    monkeypatch.setattr(tasks, 'send_messages',
+                        lambda messages: delivered.extend(
+                            message.to[0] for message in messages))
+    send_queued_emails_task()
+    assert sorted(delivered) == [f'buyer{number}@localhost'
+                                 for number in range(5)]
+
+
+@pytest.mark.django_db
+def test_pooled_connection_reconnects(smtp_server, settings):
+    settings.EMAIL_KEEPALIVE = 0
+    queue_emails(1)
+    send_queued_emails_task()
+
+    # сервер разрывает соединение, следующая пачка открывает новое
+    for channel in list(asyncore.socket_map.values()):
+        if channel is not smtp_server:
+            channel.close()
+    queue_emails(2)
+    assert send_queued_emails_task() == 2
+    wait_for(smtp_server, 3)
+
+    assert len(smtp_server.messages) == 3
+    assert smtp_server.connections == 2
+
+
+
+@pytest.mark.django_db
+def test_drain_stops_at_budget_and_reschedules(monkeypatch, settings):
+    settings.EMAIL_BATCH_SIZE = 5
+    settings.EMAIL_DRAIN_SECONDS = 3
+    queue_emails(8)
+    clock = [0]
+    scheduled = []
+
+    def send_messages(messages):
+        # каждое письмо ждёт квоту одну секунду
+        clock[0] += 1
+        return len(messages)
+
+    monkeypatch.setattr(tasks, 'send_messages', send_messages)
+    monkeypatch.setattr(tasks.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(tasks.send_queued_emails_task, 'apply_async',
+                        lambda **kwargs: scheduled.append(kwargs))
+
+    assert send_queued_emails_task() == 3
+    assert len(scheduled) == 1
+    assert OutgoingEmail.objects.filter(sent_at=None).count() == 5
+    assert not OutgoingEmail.objects.filter(
+        sent_at=None).exclude(claimed_at=None).exists()
+
+def test_wait_for_quota_limits_rate(settings):
+    settings.EMAIL_RATE_LIMIT = '50/s'
+    settings.EMAIL_RATE_BURST = 5
+
+    started = time.monotonic()
+    wait_for_quota(15)
+    # 5 писем всплеском, ещё 10 - со скоростью 50 в секунду
+    assert time.monotonic() - started >= 0.18
+
+
+def test_quota_shared_between_worker_processes(settings, monkeypatch):
+    settings.EMAIL_RATE_LIMIT = '40/s'
+    settings.EMAIL_RATE_BURST = 4
+
+    class Worker:
+        # celery -A orders worker -Q email -c 2
+        app = SimpleNamespace(amqp=SimpleNamespace(queues=SimpleNamespace(
+            consume_from={'email': None})))
+        concurrency = 2
+
+    monkeypatch.setattr(mail, '_processes', 1)
+    mail.share_quota_between_processes(sender=Worker)
+    assert mail._processes == 2
+
+    waiter = threading.Thread(target=wait_for_quota, args=(6,))
+    started = time.monotonic()
+    waiter.start()
+    time.sleep(0.02)
+    # ожидающий поток не держит блокировку
+    assert mail._rate_lock.acquire(timeout=0.01)
+    mail._rate_lock.release()
+    waiter.join()
+    # 2 письма всплеском, ещё 4 - со скоростью 20 в секунду
+    assert time.monotonic() - started >= 0.18
+
+
+@pytest.mark.parametrize('task_name, queue', [
+    ('send_queued_emails', 'email'),
+    ('send_email', 'email'),
+    ('send_order_digests', 'email'),
+    ('do_import', 'import'),
+    ('mul', 'celery'),
+])
+def test_task_routing(task_name, queue):
+    assert task_name in celery_app.tasks
+    route = celery_app.amqp.router.route({}, task_name)
+    assert route['queue'].name == queue
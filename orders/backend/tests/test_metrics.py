@@ -0,0 +1,50 @@
+import pytest
+from django.urls import reverse
+
+from .. import metrics
+from ..models import User
+
+
+@pytest.fixture
+def admin_client():
+    from rest_framework.test import APIClient
+    api_client = APIClient()
+    api_client.force_authenticate(user=User.objects.get(pk=1))
+    return api_client
+
+
+@pytest.mark.django_db
+def test_metrics_per_url_name(admin_client):
+    metrics.reset()
+    for _ in range(2):
+        admin_client.get(reverse('backend:products'), {'shop_id': 1})
+    admin_client.get(reverse('backend:categories'))
+
+    stats = admin_client.get(reverse('backend:request-metrics')).json()
+    products = stats['backend:products']
+    assert products['requests'] == 2
+    assert products['queries_max'] >= 2
+    assert products['serializer_ms_avg'] > 0
+    assert products['total_ms_avg'] >= products['sql_ms_avg']
+    assert stats['backend:categories']['requests'] == 1
+
+    admin_client.delete(reverse('backend:request-metrics'))
+    assert list(admin_client.get(
+        reverse('backend:request-metrics')).json()) == [
+        'backend:request-metrics']
+
+
+@pytest.mark.django_db
+def test_metrics_staff_only():
+    from rest_framework.test import APIClient
+    api_client = APIClient()
+    api_client.force_authenticate(user=User.objects.get(pk=2))
+    assert api_client.get(
+        reverse('backend:request-metrics')).status_code == 403
+
+
+@pytest.mark.django_db
+@pytest.mark.query_budget({'backend:categories': 0})
+@pytest.mark.xfail(strict=True, raises=pytest.fail.Exception)
+def test_query_budget_exceeded(admin_client):
+    admin_client.get(reverse('backend:categories'))
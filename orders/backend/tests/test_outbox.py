@@ -0,0 +1,71 @@
+import json
+from contextlib import contextmanager
+
+import pytest
+from celery import current_app
+from django.urls import reverse
+
+from ..models import ConfirmEmailToken, OutboxMessage
+from ..outbox import publish_pending
+from ..tasks import send_email_task, send_queued_emails_task
+
+
+@pytest.fixture
+def published(monkeypatch):
+    """
+    Перехватывает публикацию задач в брокер
+    """
+    sent = []
+
+    @contextmanager
+    def producer_or_acquire(producer=None):
+        yield 'producer'
+
+    monkeypatch.setattr(current_app, 'producer_or_acquire',
+                        producer_or_acquire)
+    monkeypatch.setattr(current_app, 'send_task',
+                        lambda name, args, kwargs, producer:
+                        sent.append((name, args, producer)))
+    return sent
+
+
+@pytest.mark.django_db
+def test_register_writes_outbox_instead_of_broker():
+    from rest_framework.test import APIClient
+    response = APIClient().post(reverse('backend:user-register'), {
+        'first_name': 'Ivan', 'last_name': 'Petrov',
+        'email': 'ivan@petrov.ru', 'password': 'v3ry-str0ng-passw0rd',
+        'company': 'Shop', 'position': 'Manager'})
+    assert response.json()['Status'] is True
+
+    token = ConfirmEmailToken.objects.get(user__email='ivan@petrov.ru')
+    message = OutboxMessage.objects.get()
+    assert message.task == 'send_email'
+    assert json.loads(message.payload)['args'] == [{
+        'to': ['ivan@petrov.ru'], 'body': token.key,
+        'subject': 'Токен для подтверждения почты ivan@petrov.ru'}]
+    assert message.published_at is None
+
+
+@pytest.mark.django_db
+def test_send_email_task_does_not_read_database(django_assert_num_queries,
+                                                monkeypatch):
+    monkeypatch.setattr(send_queued_emails_task, 'apply_async',
+                        lambda **kwargs: None)
+    payload = {'to': ['ivan@petrov.ru'], 'subject': 'Тема', 'body': 'Текст'}
+    # единственный запрос - постановка письма в очередь исходящих
+    with django_assert_num_queries(1):
+        send_email_task(payload)
+
+
+@pytest.mark.django_db
+def test_publish_pending_in_batches(published):
+    OutboxMessage.objects.enqueue_many('mul', [(number, 2)
+                                               for number in range(5)])
+
+    assert publish_pending(batch_size=3) == 3
+    assert publish_pending(batch_size=3) == 2
+    assert publish_pending(batch_size=3) == 0
+    assert published == [('mul', [number, 2], 'producer')
+                         for number in range(5)]
+    assert not OutboxMessage.objects.filter(published_at=None).exists()
@@ -0,0 +1,321 @@
+import json
+
+import pytest
+from django.urls import reverse
+
+from ..models import User, Order, OrderItem, OrderChange, ShopOrderLine, \
+    OrderStateChange, OutboxMessage, ProductInfo, ORDER_CHANGE_LOCK
+from .. import tasks
+from ..throttling import PartnerResyncThrottle
+
+
+@pytest.fixture
+def api_client():
+    from rest_framework.test import APIClient
+    return APIClient()
+
+
+@pytest.fixture
+def partner_client(api_client):
+    """
+    Клиент поставщика магазина 'Связной' (id=1)
+    """
+    api_client.force_authenticate(user=User.objects.get(pk=2))
+    yield api_client
+    api_client.force_authenticate(user=None)
+
+
+@pytest.fixture
+def make_order():
+    def make(items, state='new'):
+        order = Order.objects.create(user_id=3, state=state)
+        for product_info_id, quantity in items:
+            OrderItem.objects.create(order=order, quantity=quantity,
+                                     product_info_id=product_info_id)
+        ShopOrderLine.objects.fan_out([order.id])
+        OrderChange.objects.log_changes([order.id])
+        return order
+    return make
+
+
+@pytest.mark.django_db
+def test_partner_feed_since_cursor(partner_client, make_order):
+    url = reverse('backend:partner-orders')
+    first = make_order([(3, 1), (6, 2)])
+    other_shop = make_order([(6, 1)])
+
+    response = partner_client.get(url, {'since': 0})
+    assert response.status_code == 200
+    feed = response.json()
+    assert [order['id'] for order in feed['results']] == [first.id]
+    assert feed['has_more'] is False
+
+    second = make_order([(1, 1)])
+    OrderChange.objects.log_changes([first.id])
+    response = partner_client.get(url, {'since': feed['cursor'], 'limit': 1})
+    feed = response.json()
+    assert [order['id'] for order in feed['results']] == [second.id]
+    assert feed['has_more'] is True
+
+    response = partner_client.get(url, {'since': feed['cursor']})
+    feed = response.json()
+    assert [order['id'] for order in feed['results']] == [first.id]
+    assert other_shop.id not in [order['id'] for order in feed['results']]
+
+    response = partner_client.get(url, {'since': feed['cursor']})
+    assert response.json()['results'] == []
+
+
+@pytest.mark.django_db
+def test_partner_full_resync_throttled(partner_client, make_order,
+                                       monkeypatch):
+    monkeypatch.setattr(PartnerResyncThrottle, 'rate', '1/hour',
+                        raising=False)
+    url = reverse('backend:partner-orders')
+    make_order([(3, 1)])
+
+    assert partner_client.get(url).status_code == 200
+    assert partner_client.get(url).status_code == 429
+    assert partner_client.get(url, {'since': 0}).status_code == 200
+
+
+@pytest.mark.django_db
+def test_partner_receives_only_own_lines(partner_client, make_order):
+    url = reverse('backend:partner-orders')
+    order = make_order([(3, 2), (6, 1), (7, 3)])
+
+    response = partner_client.get(url)
+    assert response.status_code == 200
+    [partner_order] = response.json()
+    assert partner_order['id'] == order.id
+    assert [line['product_info'] for line in partner_order['ordered_items']] \
+        == [3]
+    assert partner_order['total_sum'] == 2 * 65000
+
+
+@pytest.mark.django_db
+def test_partner_lines_survive_catalog_import(partner_client, make_order):
+    """
+    Импорт прайса удаляет информацию о продуктах магазина
+    """
+    url = reverse('backend:partner-orders')
+    order = make_order([(3, 2)])
+    [before] = partner_client.get(url).json()
+    ProductInfo.objects.filter(shop_id=1).delete()
+
+    [after] = partner_client.get(url).json()
+    assert after['id'] == order.id
+    [line] = after['ordered_items']
+    assert line['product_info'] is None
+    assert {key: line[key] for key in ('product', 'model', 'external_id',
+                                       'quantity', 'price')} == {
+        key: before['ordered_items'][0][key] for key in (
+            'product', 'model', 'external_id', 'quantity', 'price')}
+    assert after['total_sum'] == before['total_sum']
+
+
+@pytest.mark.django_db
+def test_admin_save_keeps_lines_after_import(client, partner_client,
+                                             make_order, monkeypatch):
+    class Response:
+        content = 'shop: Связной\ncategories: []\ngoods: []\n'.encode()
+
+    order = make_order([(3, 2), (1, 1)])
+    before = list(ShopOrderLine.objects.filter(order=order).values_list(
+        'product_name', 'model', 'external_id', 'quantity', 'price'))
+    monkeypatch.setattr(tasks, 'get', lambda url, timeout: Response)
+    assert tasks.do_import_task(2, 'http://example.com/price.yaml') == {
+        'Status': True}
+    assert not OrderItem.objects.filter(order=order).exists()
+
+    client.force_login(User.objects.get(pk=1))
+    management = {f'{prefix}-{name}': value
+                  for prefix in ('ordered_items', 'state_changes')
+                  for name, value in (('TOTAL_FORMS', 0), ('INITIAL_FORMS', 0),
+                                      ('MIN_NUM_FORMS', 0),
+                                      ('MAX_NUM_FORMS', 1000))}
+    response = client.post(
+        reverse('admin:backend_order_change', args=[order.id]),
+        {'user': order.user_id, 'contact': '', **management})
+    assert response.status_code == 302
+    assert list(ShopOrderLine.objects.filter(order=order).values_list(
+        'product_name', 'model', 'external_id', 'quantity', 'price')) == before
+
+
+@pytest.fixture
+def sent_notifications():
+    def sent():
+        return [json.loads(message.payload)['args'][0]
+                for message in OutboxMessage.objects.filter(
+                    task='send_email')]
+    return sent
+
+
+@pytest.mark.django_db
+def test_partner_bulk_state_transition(partner_client, make_order,
+                                       sent_notifications):
+    url = reverse('backend:partner-orders')
+    orders = [make_order([(3, 1)]) for _ in range(3)]
+    canceled = make_order([(3, 1)], state='canceled')
+    foreign = make_order([(6, 1)])
+    order_ids = [order.id for order in orders + [canceled, foreign]]
+
+    response = partner_client.post(url, {
+        'items': ','.join(map(str, order_ids)), 'state': 'confirmed'})
+    assert response.json() == {'Status': True, 'Обновлено объектов': 3}
+    assert set(Order.objects.filter(id__in=order_ids).values_list(
+        'id', 'state')) == {(orders[0].id, 'confirmed'),
+                            (orders[1].id, 'confirmed'),
+                            (orders[2].id, 'confirmed'),
+                            (canceled.id, 'canceled'),
+                            (foreign.id, 'new')}
+    assert OrderStateChange.objects.filter(
+        to_state='confirmed', changed_by_id=2).count() == 3
+    [notification] = sent_notifications()
+    assert notification['to'] == ['max@plankett.com']
+    assert notification['body'] == 'Заказы {}: Подтвержден'.format(
+        ', '.join(f'№{order.id}' for order in orders))
+
+    response = partner_client.post(url, {'items': str(orders[0].id),
+                                         'state': 'delivered'})
+    assert response.json() == {'Status': True, 'Обновлено объектов': 0}
+
+    response = partner_client.post(url, {'items': str(orders[0].id),
+                                         'state': 'new'})
+    assert response.json()['Status'] is False
+
+
+@pytest.mark.django_db
+def test_partner_cannot_change_shared_orders(partner_client, make_order):
+    url = reverse('backend:partner-orders')
+    own = make_order([(3, 1)])
+    shared = make_order([(3, 1), (6, 1)])
+
+    response = partner_client.post(url, {
+        'items': f'{own.id},{shared.id}', 'state': 'canceled'})
+    assert response.json() == {
+        'Status': False,
+        'Errors': f'Заказы с товарами других магазинов: {shared.id}'}
+    assert set(Order.objects.filter(id__in=[own.id, shared.id]).values_list(
+        'state', flat=True)) == {'new'}
+
+
+@pytest.mark.django_db
+def test_order_change_ids_follow_commit_order(monkeypatch):
+    """
+    В PostgreSQL запись в журнал берёт блокировку до конца транзакции
+    """
+    from django.db import connection
+    executed = []
+
+    class Cursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def execute(self, sql, params):
+            executed.append((sql, params))
+
+    monkeypatch.setattr(connection, 'vendor', 'postgresql')
+    monkeypatch.setattr(connection, 'cursor', Cursor)
+    OrderChange.objects.lock_sequence()
+    assert executed == [('SELECT pg_advisory_xact_lock(%s)',
+                         [ORDER_CHANGE_LOCK])]
+
+
+@pytest.mark.django_db
+def test_order_change_logged_after_notifications(partner_client, make_order):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    order = make_order([(3, 1)])
+    with CaptureQueriesContext(connection) as queries:
+        response = partner_client.post(reverse('backend:partner-orders'), {
+            'items': str(order.id), 'state': 'confirmed'})
+    assert response.json()['Status'] is True
+    writes = [query['sql'] for query in queries.captured_queries
+              if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+    assert 'backend_outboxmessage' in ' '.join(writes)
+    # после записи в журнал транзакция фиксируется сразу
+    assert '"backend_orderchange"' in writes[-1]
+
+
+@pytest.fixture
+def journal_db(tmp_path):
+    """
+    Файл SQLite с таблицами журнала: к нему можно открыть
+    несколько соединений из разных потоков
+    """
+    from ..models import Shop
+    from .test_routers import add_database, remove_database
+    connection = add_database('journal', str(tmp_path / 'journal.sqlite3'))
+    with connection.schema_editor() as editor:
+        for model in (Shop, Order, OrderChange, ShopOrderLine):
+            editor.create_model(model)
+    # таблиц пользователей и товаров нет
+    connection.disable_constraint_checking()
+    yield connection
+    remove_database('journal')
+
+
+@pytest.mark.django_db
+def test_feed_cursor_never_skips_late_commit(journal_db):
+    """
+    Транзакция, которая пишет в журнал позже, получает id только после
+    фиксации первой, поэтому читатель с курсором не теряет записей
+    """
+    import threading
+    from django.db import connections, transaction
+
+    Order.objects.using('journal').bulk_create([
+        Order(id=order_id, user_id=3, state='new') for order_id in (1, 2)])
+    ShopOrderLine.objects.using('journal').bulk_create([
+        ShopOrderLine(order_id=order_id, shop_id=1, product_name='Товар',
+                      external_id=order_id, quantity=1, price=1)
+        for order_id in (1, 2)])
+    journal = OrderChange.objects.db_manager('journal')
+
+    logged, release = threading.Event(), threading.Event()
+
+    def write(order_id, hold):
+        connections['journal'].disable_constraint_checking()
+        try:
+            with transaction.atomic(using='journal'):
+                # как в Order.objects.transition(): смена статуса, затем журнал
+                Order.objects.using('journal').filter(
+                    id=order_id).update(state='confirmed')
+                journal.log_changes([order_id])
+                if hold:
+                    logged.set()
+                    release.wait(5)
+        finally:
+            connections['journal'].close()
+
+    cursor, seen = 0, []
+
+    def read():
+        nonlocal cursor
+        rows = list(journal.filter(id__gt=cursor).order_by(
+            'id').values_list('id', 'order_id'))
+        if rows:
+            cursor = rows[-1][0]
+        seen.extend(order_id for _, order_id in rows)
+
+    first = threading.Thread(target=write, args=(1, True))
+    first.start()
+    assert logged.wait(5)
+    second = threading.Thread(target=write, args=(2, False))
+    second.start()
+    second.join(0.2)
+    # вторая транзакция ждёт фиксации первой
+    assert second.is_alive()
+    read()
+    assert seen == []
+
+    release.set()
+    first.join()
+    read()
+    second.join()
+    read()
+    assert seen == [1, 2]
@@ -0,0 +1,104 @@
+import pytest
+from django.core import mail
+from django.urls import reverse
+from prometheus_client import REGISTRY
+
+from .. import tasks
+from ..mail import send_messages
+from ..models import ProductInfo, ProductParameter, User
+
+PRICE = '''
+shop: Связной
+categories:
+  - id: 224
+    name: Смартфоны
+goods:
+  - id: 4216292
+    category: 224
+    model: apple/iphone/xs-max
+    name: Prometheus Phone
+    price: 110000
+    price_rrc: 116990
+    quantity: 14
+    parameters:
+      "Цвет": золотистый
+'''.encode()
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.fixture
+def scrape(client, settings):
+    settings.METRICS_QUEUE_DEPTH = False
+
+    def get():
+        response = client.get(reverse('metrics'))
+        assert response.status_code == 200
+        return response.content.decode()
+    return get
+
+
+@pytest.mark.django_db
+def test_request_metrics_by_url_name(client, scrape):
+    labels = {'url_name': 'backend:shops', 'method': 'GET', 'status': '200'}
+    before = sample('http_request_duration_seconds_count', **labels)
+    client.get(reverse('backend:shops'))
+    assert sample('http_request_duration_seconds_count',
+                  **labels) == before + 1
+    assert sample('http_request_db_queries_count',
+                  url_name='backend:shops') >= 1
+
+    body = scrape()
+    assert 'http_request_duration_seconds_bucket{' in body
+    assert 'url_name="backend:shops"' in body
+    assert 'outbox_pending_messages' in body
+
+
+@pytest.mark.django_db
+def test_metrics_forbidden_for_other_addresses(client, settings):
+    settings.METRICS_ALLOWED_IPS = ['10.0.0.1']
+    assert client.get(reverse('metrics')).status_code == 403
+
+
+@pytest.mark.django_db
+def test_import_rows(monkeypatch):
+    class Response:
+        content = PRICE
+
+    monkeypatch.setattr(tasks, 'get', lambda url, timeout: Response)
+    before = {operation: sample('import_rows_total', operation=operation)
+              for operation in ('inserted', 'deleted')}
+
+    partner = User.objects.get(email='andrew@smith.com')
+    product_infos = ProductInfo.objects.filter(shop__user=partner).count()
+    assert ProductParameter.objects.filter(
+        product_info__shop__user=partner).exists()
+    assert tasks.do_import_task(
+        partner.id, 'http://example.com/price.yaml') == {'Status': True}
+    assert sample('import_rows_total', operation='inserted') == \
+        before['inserted'] + 1
+    # каскадно удалённые параметры не учитываются
+    assert sample('import_rows_total', operation='deleted') == \
+        before['deleted'] + product_infos
+
+
+@pytest.mark.django_db
+def test_catalog_cache_metrics(client):
+    hits = sample('cache_requests_total', cache='catalog', result='hit')
+    misses = sample('cache_requests_total', cache='catalog', result='miss')
+    client.get(reverse('backend:categories'))
+    client.get(reverse('backend:categories'))
+    assert sample('cache_requests_total', cache='catalog',
+                  result='miss') == misses + 1
+    assert sample('cache_requests_total', cache='catalog',
+                  result='hit') == hits + 1
+
+
+def test_smtp_metrics():
+    before = sample('smtp_messages_total', result='sent')
+    count = sample('smtp_send_duration_seconds_count')
+    send_messages([mail.EmailMessage('Тема', 'Текст', to=['a@example.com'])])
+    assert sample('smtp_messages_total', result='sent') == before + 1
+    assert sample('smtp_send_duration_seconds_count') == count + 1
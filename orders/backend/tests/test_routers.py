@@ -0,0 +1,109 @@
+import pytest
+from django.db import connections
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from .. import routers
+from ..models import (Category, Parameter, Product, ProductInfo,
+                      ProductParameter, Shop, User)
+
+REPLICA_MODEL = 'Модель на реплике'
+
+
+def add_database(alias, name):
+    connections.databases[alias] = {
+        'ENGINE': 'django.db.backends.sqlite3', 'NAME': name}
+    connections.ensure_defaults(alias)
+    connections.prepare_test_settings(alias)
+    return connections[alias]
+
+
+def remove_database(alias):
+    connections[alias].close()
+    del connections.databases[alias]
+    delattr(connections._connections, alias)
+
+
+@pytest.fixture
+def replica(tmp_path, settings, monkeypatch):
+    """
+    Файл SQLite вместо реплики: таблицы каталога с другими товарами,
+    чем в основной базе
+    """
+    connection = add_database('replica', str(tmp_path / 'replica.sqlite3'))
+    with connection.schema_editor() as editor:
+        for model in (Shop, Category, Product, ProductInfo, Parameter,
+                      ProductParameter):
+            editor.create_model(model)
+    # таблицы пользователей на реплике нет
+    connection.disable_constraint_checking()
+    Shop.objects.using('replica').create(id=1, name='Магазин на реплике')
+    Category.objects.using('replica').create(id=999, name='Категория')
+    Product.objects.using('replica').create(id=999, name='Товар',
+                                            category_id=999)
+    ProductInfo.objects.using('replica').create(
+        model=REPLICA_MODEL, external_id=1, product_id=999, shop_id=1,
+        quantity=1, price=100, price_rrc=100)
+    settings.DATABASE_REPLICAS = ['replica']
+    monkeypatch.setattr(routers, '_down_until', {})
+    yield connection
+    remove_database('replica')
+
+
+def product_models(client):
+    response = client.get(reverse('backend:products'), {'shop_id': 1})
+    assert response.status_code == 200
+    return [product['model'] for product in response.json()]
+
+
+@pytest.mark.django_db
+def test_catalog_reads_from_replica(replica):
+    assert product_models(APIClient()) == [REPLICA_MODEL]
+
+
+@pytest.mark.django_db
+def test_reads_pinned_to_primary_after_own_write(replica):
+    client = APIClient()
+    client.force_authenticate(user=User.objects.get(pk=1))
+    assert product_models(client) == [REPLICA_MODEL]
+
+    client.post(reverse('backend:basket'))
+    assert REPLICA_MODEL not in product_models(client)
+
+    # прочие пользователи по-прежнему читают с реплики
+    other = APIClient()
+    other.force_authenticate(user=User.objects.get(pk=2))
+    assert product_models(other) == [REPLICA_MODEL]
+
+
+@pytest.mark.django_db
+def test_unavailable_replica_skipped(replica, tmp_path, settings):
+    add_database('broken', str(tmp_path / 'missing' / 'replica.sqlite3'))
+    try:
+        settings.DATABASE_REPLICAS = ['broken', 'replica']
+        assert {routers.choose_replica() for _ in range(4)} == {'replica'}
+        assert 'broken' in routers._down_until
+
+        settings.DATABASE_REPLICAS = ['broken']
+        assert routers.choose_replica() is None
+        assert REPLICA_MODEL not in product_models(APIClient())
+    finally:
+        remove_database('broken')
+
+
+def test_round_robin_and_writes(settings, monkeypatch):
+    settings.DATABASE_REPLICAS = ['replica1', 'replica2']
+    monkeypatch.setattr(routers, 'healthy', lambda alias: True)
+    router = routers.ReplicaRouter()
+    assert router.db_for_read(Category) is None
+
+    routers.use_replicas()
+    try:
+        assert {router.db_for_read(Category) for _ in range(4)} == {
+            'replica1', 'replica2'}
+        router.db_for_write(Category)
+        assert router.db_for_read(Category) is None
+    finally:
+        routers.use_replicas(False)
+    assert router.allow_migrate('replica1', 'backend') is False
+    assert router.allow_migrate('default', 'backend') is None
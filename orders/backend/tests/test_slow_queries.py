@@ -0,0 +1,137 @@
+import logging
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection, connections
+from django.http import HttpResponse
+from django.urls import path, reverse
+
+from .. import slow_queries
+from ..models import ProductInfo
+from .test_routers import add_database, remove_database
+
+
+def query_view(request):
+    with connections['wsgi'].cursor() as cursor:
+        cursor.execute('SELECT 1')
+    return HttpResponse()
+
+
+urlpatterns = [path('query', query_view)]
+
+
+@pytest.fixture
+def slow_log(settings, caplog, monkeypatch):
+    settings.SLOW_QUERY_THRESHOLD_MS = 0
+    settings.SLOW_QUERY_SAMPLE_RATE = 1
+    settings.SLOW_QUERY_EXPLAIN_TOP = 20
+    slow_queries.reset()
+    # записи журнала попадают в caplog, а не в файл
+    monkeypatch.setattr(slow_queries.logger, 'handlers', [])
+    monkeypatch.setattr(slow_queries.logger, 'propagate', True)
+    caplog.set_level(logging.WARNING, logger=slow_queries.logger.name)
+    yield caplog
+    slow_queries.reset()
+
+
+@pytest.mark.django_db
+def test_slow_queries_logged_with_route_and_plan(client, slow_log):
+    response = client.get(reverse('backend:products'), {'shop_id': 1})
+    assert response.status_code == 200
+
+    messages = [record.getMessage() for record in slow_log.records]
+    product_queries = [message for message in messages
+                       if 'backend_productinfo' in message]
+    assert product_queries
+    assert all('[backend:products]' in message
+               for message in product_queries)
+    # план выполнения записывается один раз для каждого запроса
+    assert any('\n' in message for message in product_queries)
+
+    slow_log.clear()
+    client.get(reverse('backend:products'), {'shop_id': 1})
+    repeated = [record.getMessage() for record in slow_log.records
+                if 'backend_productinfo' in record.getMessage()]
+    assert repeated and not any('\n' in message for message in repeated)
+
+
+@pytest.mark.django_db
+def test_explain_not_counted_in_request_metrics(client, slow_log, settings):
+    from .. import cache as catalog_cache, metrics
+
+    def queries():
+        metrics.reset()
+        client.get(reverse('backend:products'), {'shop_id': 1})
+        return metrics.snapshot()['backend:products']['queries_max']
+
+    # множество активных магазинов - в кэше для обоих запросов
+    catalog_cache.get_active_shop_ids()
+    with_plans = queries()
+    assert any('\n' in record.getMessage() for record in slow_log.records)
+    settings.SLOW_QUERY_THRESHOLD_MS = None
+    assert queries() == with_plans
+
+
+@pytest.mark.django_db
+def test_sampling_and_threshold(slow_log, settings):
+    list(ProductInfo.objects.all()[:1])
+    assert not slow_log.records
+
+    with slow_queries.caller('test'):
+        settings.SLOW_QUERY_SAMPLE_RATE = 0
+        list(ProductInfo.objects.all()[:1])
+        assert not slow_log.records
+
+        settings.SLOW_QUERY_SAMPLE_RATE = 1
+        settings.SLOW_QUERY_THRESHOLD_MS = 60 * 1000
+        list(ProductInfo.objects.all()[:1])
+        assert not slow_log.records
+
+
+@pytest.mark.django_db
+def test_caller_and_explain_top(slow_log, settings):
+    settings.SLOW_QUERY_EXPLAIN_TOP = 0
+    with slow_queries.caller('task:do_import'):
+        list(ProductInfo.objects.filter(shop_id=1)[:1])
+    message = slow_log.records[-1].getMessage()
+    assert '[task:do_import]' in message
+    assert '\n' not in message
+    assert slow_queries.get_caller() is None
+    assert slow_queries.slow_query_wrapper not in connection.execute_wrappers
+
+
+@pytest.mark.django_db
+def test_params_not_logged(slow_log):
+    with slow_queries.caller('test'):
+        list(ProductInfo.objects.filter(model='секретное значение'))
+    message = slow_log.records[-1].getMessage()
+    assert 'backend_productinfo' in message
+    assert 'секретное значение' not in message
+    assert slow_queries.LITERAL.sub("'?'", "(key = 'a''b'::text)") == (
+        "(key = '?'::text)")
+
+
+@pytest.mark.urls(__name__)
+def test_wrappers_removed_when_request_opens_connection(
+        tmp_path, slow_log, django_db_blocker):
+    """
+    Соединение открывается внутри запроса и закрывается по его окончании
+    (CONN_MAX_AGE=0), обёртки middleware не должны накапливаться
+    """
+    wsgi = add_database('wsgi', str(tmp_path / 'wsgi.sqlite3'))
+    application = WSGIHandler()
+    try:
+        with django_db_blocker.unblock():
+            for _ in range(3):
+                environ = {'PATH_INFO': '/query'}
+                setup_testing_defaults(environ)
+                response = application(environ, lambda status, headers: None)
+                response.close()
+                assert response.status_code == 200
+                assert wsgi.connection is None
+                assert wsgi.execute_wrappers == []
+    finally:
+        remove_database('wsgi')
+    assert [record for record in slow_log.records
+            if 'SELECT 1' in record.getMessage()]
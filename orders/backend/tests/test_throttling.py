@@ -0,0 +1,70 @@
+import pytest
+from rest_framework.test import APIRequestFactory
+from rest_framework.views import APIView
+
+from .. import throttling
+from ..throttling import UserSlidingWindowThrottle, \
+    ScopedSlidingWindowThrottle
+from ..models import User
+
+
+class MinuteThrottle(UserSlidingWindowThrottle):
+    rate = '3/minute'
+
+
+class UploadsView(APIView):
+    throttle_scope = 'uploads'
+
+
+@pytest.fixture(params=['redis', 'locmem'])
+def throttle_cache(request, monkeypatch):
+    """
+    Счётчики в Redis (fakeredis вместо клиента django_redis)
+    и в LocMem без Redis
+    """
+    if request.param == 'redis':
+        import fakeredis
+        client = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr(throttling, 'get_redis_client',
+                            lambda cache: client)
+    return request.param
+
+
+@pytest.fixture
+def user_request():
+    request = APIRequestFactory().get('/')
+    request.user = User(pk=3)
+    return request
+
+
+def check(request, now, throttle_class=MinuteThrottle, view=None):
+    throttle = throttle_class()
+    throttle.timer = lambda: now
+    return throttle.allow_request(request, view)
+
+
+def test_limit_within_window(throttle_cache, user_request):
+    assert [check(user_request, 60 + second) for second in range(5)] == [
+        True, True, True, False, False]
+    # отклонённые запросы не занимают лимит: в следующем окне
+    # предыдущее учитывается с весом 3 * 0.5
+    assert check(user_request, 150) is True
+    assert check(user_request, 151) is False
+    assert check(user_request, 200) is True
+
+
+def test_previous_window_expires(throttle_cache, user_request):
+    for _ in range(3):
+        assert check(user_request, 60)
+    assert check(user_request, 180) is True
+
+
+def test_scoped_throttle_uses_view_scope(throttle_cache, user_request):
+    throttle = ScopedSlidingWindowThrottle()
+    throttle.THROTTLE_RATES = {'uploads': '2/minute'}
+    throttle.timer = lambda: 60
+    view = UploadsView()
+    assert [throttle.allow_request(user_request, view)
+            for _ in range(3)] == [True, True, False]
+    assert throttle.wait() == 60
+    assert throttle.allow_request(user_request, APIView()) is True
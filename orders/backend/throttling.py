@@ -0,0 +1,124 @@
+from django.conf import settings
+from django.core.cache import caches
+
+from rest_framework.throttling import AnonRateThrottle, UserRateThrottle, \
+    ScopedRateThrottle
+
+# Счётчики запросов хранятся в кэше THROTTLE_CACHE, общем для всех
+# процессов и серверов. Для кэша django_redis счётчики меняются
+# одной транзакцией MULTI/EXEC напрямую в Redis, для прочих кэшей -
+# атомарными cache.add()/cache.incr() (LocMem - только в пределах процесса)
+
+
+def get_redis_client(cache):
+    """
+    Клиент Redis для кэша django_redis или None для прочих кэшей
+    """
+    client = getattr(cache, 'client', None)
+    get_client = getattr(client, 'get_client', None)
+    return get_client(write=True) if get_client is not None else None
+
+
+class SlidingWindowMixin:
+    """
+    Скользящее окно на двух счётчиках: запросы текущего окна
+    плюс запросы предыдущего окна с весом, равным доле предыдущего
+    окна, попадающей в последние duration секунд.
+    Проверка - O(1) независимо от лимита, отклонённые запросы
+    в лимит не засчитываются
+    """
+
+    @property
+    def cache(self):
+        return caches[settings.THROTTLE_CACHE]
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.now = self.timer()
+        window = int(self.now // self.duration)
+        current_key = f'{self.key}:{window}'
+        count, previous = self.hit(current_key, f'{self.key}:{window - 1}')
+        weight = 1 - (self.now % self.duration) / self.duration
+        if count + previous * weight > self.num_requests:
+            self.undo(current_key)
+            return self.throttle_failure()
+        return self.throttle_success()
+
+    def hit(self, current_key, previous_key):
+        """
+        Засчитывает запрос в текущем окне
+        возвращает количество запросов в текущем и предыдущем окнах
+        """
+        timeout = 2 * self.duration
+        client = get_redis_client(self.cache)
+        if client is not None:
+            pipe = client.pipeline()
+            pipe.incr(current_key)
+            pipe.expire(current_key, timeout)
+            pipe.get(previous_key)
+            count, _, previous = pipe.execute()
+            return count, int(previous or 0)
+
+        self.cache.add(current_key, 0, timeout)
+        try:
+            count = self.cache.incr(current_key)
+        except ValueError:
+            # счётчик истёк между add() и incr()
+            count = 1
+            self.cache.set(current_key, count, timeout)
+        return count, self.cache.get(previous_key, 0)
+
+    def undo(self, current_key):
+        client = get_redis_client(self.cache)
+        if client is not None:
+            client.decr(current_key)
+            return
+        try:
+            self.cache.decr(current_key)
+        except ValueError:
+            pass
+
+    def throttle_success(self):
+        return True
+
+    def wait(self):
+        """
+        Время до смены окна, после которой вес предыдущего окна падает
+        """
+        return self.duration - self.now % self.duration
+
+
+class AnonSlidingWindowThrottle(SlidingWindowMixin, AnonRateThrottle):
+    pass
+
+
+class UserSlidingWindowThrottle(SlidingWindowMixin, UserRateThrottle):
+    pass
+
+
+class ScopedSlidingWindowThrottle(SlidingWindowMixin, ScopedRateThrottle):
+    """
+    Ограничение по throttle_scope представления, как в ScopedRateThrottle
+    """
+
+    def allow_request(self, request, view):
+        self.scope = getattr(view, self.scope_attr, None)
+        if not self.scope:
+            return True
+        self.rate = self.get_rate()
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        return super().allow_request(request, view)
+
+
+class PartnerResyncThrottle(UserSlidingWindowThrottle):
+    """
+    Ограничение частоты полной выгрузки заказов поставщика
+    (PartnerOrders без параметра since)
+    """
+    scope = 'partner_resync'
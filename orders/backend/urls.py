@@ -4,7 +4,8 @@ from django_rest_passwordreset.views import reset_password_request_token,\
 
 from .views import PartnerUpdate, PartnerState, PartnerOrders, RegisterAccount,\
     ConfirmAccount, LoginAccount, AccountDetails, CategoryView, ShopView,\
-    ProductInfoView, BasketView, ContactView, OrderView
+    ProductInfoView, BasketView, ContactView, OrderView, PartnerExport,\
+    ExportJobView, OrderExport, RequestMetricsView
 
 app_name = 'backend'
 
@@ -12,6 +13,8 @@ urlpatterns = [
     path('partner/update', PartnerUpdate.as_view(), name='partner-update'),
     path('partner/state', PartnerState.as_view(), name='partner-state'),
     path('partner/orders', PartnerOrders.as_view(), name='partner-orders'),
+    path('partner/export', PartnerExport.as_view(), name='partner-export'),
+    path('export/<int:pk>', ExportJobView.as_view(), name='export-job'),
     path('user/register', RegisterAccount.as_view(), name='user-register'),
     path('user/register/confirm', ConfirmAccount.as_view(),
          name='user-register-confirm'),
@@ -26,5 +29,8 @@ urlpatterns = [
     path('shops', ShopView.as_view(), name='shops'),
     path('products', ProductInfoView.as_view(), name='products'),
     path('basket', BasketView.as_view(), name='basket'),
-    path('order', OrderView.as_view(), name='order')
+    path('order', OrderView.as_view(), name='order'),
+    path('order/export', OrderExport.as_view(), name='order-export'),
+    path('metrics/requests', RequestMetricsView.as_view(),
+         name='request-metrics')
 ]
\ No newline at end of file
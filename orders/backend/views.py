@@ -1,11 +1,13 @@
 # from django.shortcuts import render
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse, FileResponse
 # from django.core.validators import URLValidator
 # from django.core.exceptions import ValidationError
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
-from django.db import IntegrityError
-from django.db.models import Q, Sum, F
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Sum, F, Prefetch
+from django.utils.dateparse import parse_date
 
 from celery import current_app
 
@@ -16,19 +18,27 @@ from rest_framework.generics import ListAPIView
 # from rest_framework.renderers import TemplateHTMLRenderer
 
 # from requests import get
-from ujson import loads as load_json
+from ujson import loads as load_json, dumps as dump_json
 # from yaml import load as load_yaml, Loader
 from distutils.util import strtobool
 
 from .models import Shop, Category, Product, ProductInfo, Parameter, \
-    ProductParameter, Order, OrderItem, Contact, ConfirmEmailToken
+    ProductParameter, Order, OrderItem, Contact, ConfirmEmailToken, \
+    OrderChange, ShopOrderLine, OutboxMessage, ExportJob, STATE_CHOICES
 from .serializers import UserSerializer, CategorySerializer, ShopSerializer, \
-    ProductInfoSerializer, OrderItemSerializer, OrderSerializer, \
-    ContactSerializer
+    ProductInfoSerializer, OrderSerializer, ContactSerializer, \
+    PartnerOrderSerializer
 # from .signals import new_user_registered, new_order
+from . import cache as catalog_cache, metrics
+from .cache import CachedListMixin
+from .exports import CATALOG_FORMATS, ORDER_EXPORT_FORMATS, export_catalog
+from .idempotency import idempotent
+from .notifications import notify_new_user, notify_new_order, \
+    notify_order_state_changes
+from .routers import ReplicaReadsMixin
+from .throttling import PartnerResyncThrottle
 
-from .tasks import send_new_user_email_task, send_new_order_email_task, \
-    do_import_task
+from .tasks import do_import_task, export_catalog_task, export_orders_task
 
 # Наиболее часто повторяющиеся статусы ошибок
 
@@ -36,8 +46,15 @@ NO_AUTH_STATUS = {'Status': False, 'Error': 'Необходимо авториз
 LACK_OF_ARGS_STATUS = {'Status': False,
                        'Errors': 'Не указаны все необходимые аргументы'}
 SHOP_ONLY_STATUS = {'Status': False, 'Error': 'Только для магазинов'}
+STAFF_ONLY_STATUS = {'Status': False,
+                     'Error': 'Только для администраторов'}
 ORDER_ERROR_STATUS = {'Status': False, 'Error': 'Ошибка обработки заказа'}
 
+# Статусы, которые поставщик может проставлять своим заказам
+
+PARTNER_ORDER_STATES = [state for state, _ in STATE_CHOICES
+                        if state not in ('basket', 'new')]
+
 # Views для работы с поставщиками
 
 class PartnerUpdate(APIView):
@@ -94,15 +111,27 @@ class PartnerState(APIView):
             try:
                 Shop.objects.filter(user_id=request.user.id).update(
                     state=strtobool(state))
+                catalog_cache.invalidate(catalog_cache.SHOPS)
                 return JsonResponse({'Status': True})
             except ValueError as error:
                 return JsonResponse({'Status': False, 'Errors': str(error)})
 
 
-class PartnerOrders(APIView):
+class PartnerOrders(ReplicaReadsMixin, APIView):
     """
     Работа с заказами от поставщика
+    ?since=<cursor> - лента заказов, изменённых после курсора,
+    ?limit=<n> - размер страницы ленты.
+    Без since отдаётся полная выгрузка с ограничением частоты.
+    POST меняет статус сразу нескольких заказов
     """
+    def get_throttles(self):
+        throttles = super().get_throttles()
+        if (self.request.method == 'GET'
+                and 'since' not in self.request.query_params):
+            throttles.append(PartnerResyncThrottle())
+        return throttles
+
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse(NO_AUTH_STATUS, status=401)
@@ -110,22 +139,198 @@ class PartnerOrders(APIView):
         if request.user.type != 'shop':
             return JsonResponse(SHOP_ONLY_STATUS, status=403)
 
-        order = Order.objects.filter(
-            ordered_items__product_info__shop__user_id=request.user.id
-        ).exclude(
-            state='basket'
+        shop_id = Shop.objects.filter(
+            user_id=request.user.id).values_list('id', flat=True).first()
+
+        if 'since' in request.query_params:
+            return self.get_feed(request, shop_id)
+
+        order_ids = ShopOrderLine.objects.filter(
+            shop_id=shop_id).values('order_id')
+        orders = self.get_orders(shop_id, order_ids).exclude(
+            state='basket').order_by('-dt')
+
+        serializer = PartnerOrderSerializer(orders, many=True)
+        return Response(serializer.data)
+
+    @staticmethod
+    def get_orders(shop_id, order_ids):
+        """
+        Заказы с позициями только указанного магазина
+        """
+        return Order.objects.filter(
+            id__in=order_ids
         ).prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter'
+            Prefetch('shop_lines', to_attr='partner_lines',
+                     queryset=ShopOrderLine.objects.filter(shop_id=shop_id))
         ).select_related(
             'contact'
-        ).annotate(
-            total_sum=Sum(F('ordered_items__quantity')
-                          * F('ordered_items__product_info__price'))
-        ).distinct()
+        )
+
+    def get_feed(self, request, shop_id):
+        """
+        Страница ленты изменений заказов магазина по журналу OrderChange
+        """
+        since = request.query_params.get('since')
+        limit = request.query_params.get('limit',
+                                         str(settings.PARTNER_FEED_PAGE_SIZE))
+        if not (since.isdigit() and limit.isdigit() and int(limit) > 0):
+            return JsonResponse(
+                {'Status': False, 'Errors': 'Неверный формат курсора'})
+        since = int(since)
+        limit = min(int(limit), settings.PARTNER_FEED_MAX_PAGE_SIZE)
+
+        changes = list(OrderChange.objects.filter(
+            shop_id=shop_id, id__gt=since
+        ).order_by('id').values_list('id', 'order_id')[:limit + 1])
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+
+        # заказ, изменённый несколько раз, выдаём один раз -
+        # на позиции последнего изменения
+        positions = {order_id: position
+                     for position, (_, order_id) in enumerate(changes)}
+        orders = sorted(self.get_orders(shop_id, list(positions)),
+                        key=lambda order: positions[order.id])
+
+        serializer = PartnerOrderSerializer(orders, many=True)
+        return Response({'cursor': changes[-1][0] if changes else since,
+                         'has_more': has_more,
+                         'results': serializer.data})
+
+    # меняем статус заказов
+    def post(self, request, *args, **kwargs):
+        """
+        На вход - данные:
+        'items' - id заказов через запятую,
+        'state' - новый статус заказов
+        Статус общий для всего заказа, поэтому заказы с товарами
+        других магазинов поставщик менять не может
+        """
+        if not request.user.is_authenticated:
+            return JsonResponse(NO_AUTH_STATUS, status=401)
+
+        if request.user.type != 'shop':
+            return JsonResponse(SHOP_ONLY_STATUS, status=403)
+
+        items_string = request.data.get('items')
+        state = request.data.get('state')
+        if items_string and state:
+            if state not in PARTNER_ORDER_STATES:
+                return JsonResponse(
+                    {'Status': False, 'Errors': f'Недопустимый статус: {state}'})
+            order_ids = [order_id for order_id in items_string.split(',')
+                         if order_id.isdigit()]
+            shop_order_ids = ShopOrderLine.objects.filter(
+                shop__user_id=request.user.id, order_id__in=order_ids
+            ).values('order_id')
+            shared_order_ids = sorted(set(ShopOrderLine.objects.filter(
+                order_id__in=shop_order_ids
+            ).exclude(
+                shop__user_id=request.user.id
+            ).values_list('order_id', flat=True)))
+            if shared_order_ids:
+                return JsonResponse(
+                    {'Status': False,
+                     'Errors': 'Заказы с товарами других магазинов: {}'.format(
+                         ', '.join(map(str, shared_order_ids)))})
+            changes = Order.objects.filter(
+                id__in=shop_order_ids).transition(
+                state, user=request.user, notify=notify_order_state_changes)
+            return JsonResponse(
+                {'Status': True, 'Обновлено объектов': len(changes)})
+        return JsonResponse(LACK_OF_ARGS_STATUS)
 
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+
+class PartnerExport(APIView):
+    """
+    Выгрузка каталога магазина в формате прайса (yaml), csv или jsonl.
+    ?type=<формат> - формат выгрузки, по умолчанию yaml,
+    ?shop=<id> - магазин (только для администраторов).
+    GET отдаёт файл потоком, POST ставит выгрузку в очередь
+    """
+
+    @staticmethod
+    def get_shop(request, params):
+        """
+        Магазин для выгрузки: свой для поставщика,
+        любой по параметру shop для администратора
+        """
+        if request.user.is_staff and params.get('shop'):
+            return Shop.objects.filter(id=params['shop']).first()
+        if request.user.type == 'shop':
+            return Shop.objects.filter(user_id=request.user.id).first()
+        return None
+
+    def check_request(self, request, params):
+        """
+        Возвращает (магазин, формат, None) или (None, None, ответ с ошибкой)
+        """
+        if not request.user.is_authenticated:
+            return None, None, JsonResponse(NO_AUTH_STATUS, status=401)
+        if request.user.type != 'shop' and not request.user.is_staff:
+            return None, None, JsonResponse(SHOP_ONLY_STATUS, status=403)
+        file_format = params.get('type', 'yaml')
+        if file_format not in CATALOG_FORMATS:
+            return None, None, JsonResponse(
+                {'Status': False,
+                 'Errors': f'Неизвестный формат: {file_format}'})
+        shop = self.get_shop(request, params)
+        if shop is None:
+            return None, None, JsonResponse(
+                {'Status': False, 'Errors': 'Магазин не найден'}, status=404)
+        return shop, file_format, None
+
+    # выгружаем каталог потоком
+    def get(self, request, *args, **kwargs):
+        shop, file_format, error = self.check_request(request,
+                                                      request.query_params)
+        if error:
+            return error
+        content_type, _ = CATALOG_FORMATS[file_format]
+        response = StreamingHttpResponse(export_catalog(shop, file_format),
+                                         content_type=content_type)
+        response['Content-Disposition'] = \
+            f'attachment; filename="catalog-{shop.id}.{file_format}"'
+        return response
+
+    # ставим выгрузку в очередь
+    def post(self, request, *args, **kwargs):
+        shop, file_format, error = self.check_request(request, request.data)
+        if error:
+            return error
+        with transaction.atomic():
+            job = ExportJob.objects.create(
+                user=request.user, kind='catalog', file_format=file_format,
+                params=dump_json({'shop': shop.id}))
+            OutboxMessage.objects.enqueue(export_catalog_task, job.id)
+        return JsonResponse({'Status': True, 'Job': job.id})
+
+
+class ExportJobView(APIView):
+    """
+    Статус выгрузки; когда выгрузка готова - файл выгрузки
+    """
+
+    def get(self, request, pk, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse(NO_AUTH_STATUS, status=401)
+
+        jobs = ExportJob.objects.all()
+        if not request.user.is_staff:
+            jobs = jobs.filter(user_id=request.user.id)
+        job = jobs.filter(id=pk).first()
+        if job is None:
+            return JsonResponse(
+                {'Status': False, 'Errors': 'Выгрузка не найдена'}, status=404)
+
+        if job.state == 'done':
+            return FileResponse(job.file.open('rb'), as_attachment=True,
+                                filename=job.file.name.split('/')[-1])
+        if job.state == 'failed':
+            return JsonResponse({'Status': False, 'State': job.state,
+                                 'Errors': job.error})
+        return JsonResponse({'Status': True, 'State': job.state}, status=202)
 
 
 # Views для работы с пользователями
@@ -154,11 +359,12 @@ class RegisterAccount(APIView):
                 request.data.update({})
                 user_serializer = UserSerializer(data=request.data)
                 if user_serializer.is_valid():
-                    user = user_serializer.save()
-                    user.set_password(request.data['password'])
-                    user.save()
+                    with transaction.atomic():
+                        user = user_serializer.save()
+                        user.set_password(request.data['password'])
+                        user.save()
+                        notify_new_user(user)
 
-                    task = send_new_user_email_task.delay(user.id)
                     # new_user_registered.send(sender=self.__class__,
                     #                          user_id=user.id)
 
@@ -245,40 +451,45 @@ class LoginAccount(APIView):
 
 # Views для работы с магазинами и заказами
 
-class CategoryView(ListAPIView):
+class CategoryView(ReplicaReadsMixin, CachedListMixin, ListAPIView):
     """
     Просмотр категорий
     """
+    cache_name = catalog_cache.CATEGORIES
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
 
 
-class ShopView(ListAPIView):
+class ShopView(ReplicaReadsMixin, CachedListMixin, ListAPIView):
     """
     Просмотр списка магазинов
     """
+    cache_name = catalog_cache.SHOPS
     queryset = Shop.objects.filter(state=True)
     serializer_class = ShopSerializer
 
 
-class ProductInfoView(APIView):
+class ProductInfoView(ReplicaReadsMixin, APIView):
     """
     Поиск товаров
     """
 
     def get(self, request, *args, **kwargs):
-        query = Q(shop__state=True)
+        # активные магазины берутся из кэша, без соединения с таблицей
+        # магазинов в каждом запросе
+        shop_ids = catalog_cache.get_active_shop_ids()
         shop_id = request.query_params.get('shop_id')
         category_id = request.query_params.get('category_id')
 
         if shop_id:
-            query = query & Q(shop_id=shop_id)
+            shop_ids = [id_ for id_ in shop_ids if str(id_) == shop_id]
+        query = Q(shop_id__in=shop_ids)
         if category_id:
             query = query & Q(product__category_id=category_id)
 
-        queryset = ProductInfo.objects.filter(query).select_related('shop',
+        queryset = ProductInfo.objects.filter(query).select_related(
             'product__category').prefetch_related(
-            'product_parameters__parameter').distinct()
+            'product_parameters__parameter')
 
         serializer = ProductInfoSerializer(queryset, many=True)
 
@@ -310,6 +521,7 @@ class BasketView(APIView):
         return Response(serializer.data)
 
     # вносим изменения в корзину
+    @idempotent
     def post(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse(NO_AUTH_STATUS, status=401)
@@ -324,32 +536,39 @@ class BasketView(APIView):
                 return JsonResponse(
                     {'Status': False, 'Errors': f'Неверный формат запроса: {e}'})
             else:
-                basket, _ = Order.objects.get_or_create(user_id=request.user.id,
-                    state='basket')
-                objects_created = 0
+                if not isinstance(order_item_dict, list):
+                    return JsonResponse(
+                        {'Status': False, 'Errors': 'Неверный формат запроса'})
 
+                # одинаковые позиции суммируются
+                quantities = {}
                 for order_item in order_item_dict:
-
-                    order_item.update({'order': basket.id})
-
-                    print('order_item: ', order_item)
-
-                    serializer = OrderItemSerializer(data=order_item)
-                    if serializer.is_valid():
-                        try:
-                            serializer.save()
-                        except IntegrityError as error:
-                            return JsonResponse(
-                                {'Status': False, 'Errors': 'IntegrityError:'
-                                                            + str(error)})
-                        else:
-                            objects_created += 1
-                    else:
+                    # id и количество принимаются и строками ("5")
+                    try:
+                        product_info_id = int(order_item['product_info'])
+                        quantity = int(order_item['quantity'])
+                    except (KeyError, TypeError, ValueError):
+                        quantity = 0
+                    if quantity <= 0:
                         return JsonResponse(
-                            {'Status': False, 'Errors': 'validation_stage:'
-                                                        + serializer.errors})
+                            {'Status': False,
+                             'Errors': f'Неверная позиция: {order_item}'},
+                            status=400)
+                    quantities[product_info_id] = (
+                        quantities.get(product_info_id, 0) + quantity)
+
+                unknown = set(quantities) - set(ProductInfo.objects.filter(
+                    id__in=quantities).values_list('id', flat=True))
+                if unknown:
+                    return JsonResponse(
+                        {'Status': False,
+                         'Errors': f'Неизвестные товары: {sorted(unknown)}'})
+
+                basket, _ = Order.objects.get_or_create(user_id=request.user.id,
+                    state='basket')
+                OrderItem.objects.merge_quantities(basket.id, quantities)
                 return JsonResponse(
-                    {'Status': True, 'Создано объектов': objects_created})
+                    {'Status': True, 'Создано объектов': len(quantities)})
         return JsonResponse(LACK_OF_ARGS_STATUS)
 
     # Удаляем позицию из корзины
@@ -485,7 +704,7 @@ class ContactView(APIView):
 
 # Views для работы с заказами
 
-class OrderView(APIView):
+class OrderView(ReplicaReadsMixin, APIView):
     """
     Работаем с заказами пользователя
     """
@@ -511,6 +730,7 @@ class OrderView(APIView):
         serializer = OrderSerializer(order, many=True)
         return Response(serializer.data)
 
+    @idempotent
     def post(self, request, *args, **kwargs):
         """
         На вход - json с данными:
@@ -523,19 +743,91 @@ class OrderView(APIView):
         if {'id', 'contact'}.issubset(request.data):
             if request.data['id'].isdigit() or type(request.data['id']) == int:
                 try:
-                    is_updated = Order.objects.filter(user_id=request.user.id,
-                        id=request.data['id']).update(
-                        contact_id=request.data['contact'], state='new')
+                    is_updated = Order.objects.filter(
+                        user_id=request.user.id, id=request.data['id']
+                    ).transition(
+                        'new', user=request.user,
+                        notify=lambda changes, state: notify_new_order(
+                            request.user, request.data['id']),
+                        contact_id=request.data['contact'])
                 except IntegrityError as error:
                     return JsonResponse(
                         {'Status': False, 'Errors': f'Неверные аргументы: {error}'})
                 else:
                     if is_updated:
-
-                        task = send_new_order_email_task.delay(request.user.id)
                         # new_order.send(sender=self.__class__,
                         #                user_id=request.user.id)
 
                         return JsonResponse({'Status': True})
                     return JsonResponse(ORDER_ERROR_STATUS)
 
+
+class OrderExport(APIView):
+    """
+    Выгрузка позиций заказов за период для бухгалтерии.
+    Администратор выгружает все заказы, поставщик - позиции своего магазина
+    """
+
+    def post(self, request, *args, **kwargs):
+        """
+        На вход - данные:
+        'date_from', 'date_to' - период в формате ГГГГ-ММ-ДД,
+        'type' - формат файла (csv, parquet), по умолчанию csv
+        """
+        if not request.user.is_authenticated:
+            return JsonResponse(NO_AUTH_STATUS, status=401)
+
+        if request.user.is_staff:
+            shop_id = None
+        elif request.user.type == 'shop':
+            shop_id = Shop.objects.filter(
+                user_id=request.user.id).values_list('id', flat=True).first()
+        else:
+            return JsonResponse(SHOP_ONLY_STATUS, status=403)
+
+        if not {'date_from', 'date_to'}.issubset(request.data):
+            return JsonResponse(LACK_OF_ARGS_STATUS)
+        try:
+            date_from = parse_date(request.data['date_from'])
+            date_to = parse_date(request.data['date_to'])
+        except ValueError:
+            date_from = date_to = None
+        if date_from is None or date_to is None or date_from > date_to:
+            return JsonResponse({'Status': False,
+                                 'Errors': 'Неверный период выгрузки'})
+        file_format = request.data.get('type', 'csv')
+        if file_format not in ORDER_EXPORT_FORMATS:
+            return JsonResponse(
+                {'Status': False,
+                 'Errors': f'Неизвестный формат: {file_format}'})
+
+        with transaction.atomic():
+            job = ExportJob.objects.create(
+                user=request.user, kind='orders', file_format=file_format,
+                params=dump_json({'date_from': date_from.isoformat(),
+                                  'date_to': date_to.isoformat(),
+                                  'shop': shop_id}))
+            OutboxMessage.objects.enqueue(export_orders_task, job.id)
+        return JsonResponse({'Status': True, 'Job': job.id})
+
+
+class RequestMetricsView(APIView):
+    """
+    Метрики запросов процесса по маршрутам (только для администраторов).
+    DELETE сбрасывает накопленные метрики
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse(NO_AUTH_STATUS, status=401)
+        if not request.user.is_staff:
+            return JsonResponse(STAFF_ONLY_STATUS, status=403)
+        return JsonResponse(metrics.snapshot())
+
+    def delete(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse(NO_AUTH_STATUS, status=401)
+        if not request.user.is_staff:
+            return JsonResponse(STAFF_ONLY_STATUS, status=403)
+        metrics.reset()
+        return JsonResponse({'Status': True})
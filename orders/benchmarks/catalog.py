@@ -0,0 +1,117 @@
+"""
+Генератор синтетического прайса в формате data/shop1.yaml.
+
+    python benchmarks/catalog.py --shops 3 --goods 1000000 --out /tmp/catalog
+
+Создаёт по файлу shop-<n>.yaml на магазин. Файлы пишутся потоком,
+поэтому размер прайса ограничен только диском. Товары (Product)
+выбираются из общего для всех магазинов набора имён, как у реальных
+поставщиков одних и тех же моделей; результат определяется --seed
+"""
+import argparse
+import json
+import os
+import random
+
+# id категорий генератора не пересекаются с id из data/*.yaml
+CATEGORY_BASE_ID = 100000
+BRANDS = ('Apple', 'Samsung', 'Xiaomi', 'Huawei', 'Sony', 'LG', 'Lenovo',
+          'Asus', 'Acer', 'Philips', 'Bosch', 'Canon')
+COLORS = ('чёрный', 'белый', 'серый', 'синий', 'красный', 'золотистый')
+
+
+def quote(value):
+    # строка json - корректная строка yaml в двойных кавычках
+    return json.dumps(value, ensure_ascii=False)
+
+
+def shop_name(number):
+    return f'Bench shop {number}'
+
+
+def category_name(number):
+    return f'Bench category {number}'
+
+
+def parameter_names(count):
+    return [f'Параметр {number}' for number in range(count)]
+
+
+def product_name(number, categories):
+    brand = BRANDS[number % len(BRANDS)]
+    return (f'{category_name(number % categories)} {brand} '
+            f'model-{number} ({COLORS[number % len(COLORS)]})')
+
+
+def write_catalog(file, number, goods, categories=50, parameters=8,
+                  products=None, seed=0):
+    """
+    Записывает в file прайс магазина number из goods позиций.
+    products - размер общего набора товаров (по умолчанию goods)
+    """
+    products = products or goods
+    rng = random.Random(f'{seed}:{number}')
+    names = parameter_names(parameters)
+
+    file.write(f'shop: {quote(shop_name(number))}\n')
+    file.write('categories:\n')
+    for category in range(categories):
+        file.write(f'  - id: {CATEGORY_BASE_ID + category}\n'
+                   f'    name: {quote(category_name(category))}\n')
+
+    file.write('\ngoods:\n')
+    # позиции одного магазина ссылаются на разные товары
+    for external_id, product in enumerate(
+            rng.sample(range(products), goods)
+            if goods <= products else range(goods), start=1):
+        product %= products
+        price = rng.randrange(100, 200000, 10)
+        file.write(
+            f'  - id: {external_id}\n'
+            f'    category: {CATEGORY_BASE_ID + product % categories}\n'
+            f'    model: {quote(f"bench/{product}")}\n'
+            f'    name: {quote(product_name(product, categories))}\n'
+            f'    price: {price}\n'
+            f'    price_rrc: {price + price // 10}\n'
+            f'    quantity: {rng.randrange(0, 100)}\n'
+            f'    parameters:\n')
+        for name in rng.sample(names, min(4, parameters)):
+            file.write(f'      {quote(name)}: {rng.randrange(1, 1000)}\n')
+
+
+def generate(directory, shops=3, goods=1000, categories=50, parameters=8,
+             products=None, seed=0):
+    """
+    Прайсы shops магазинов по goods позиций, возвращает пути к файлам
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for number in range(1, shops + 1):
+        path = os.path.join(directory, f'shop-{number}.yaml')
+        with open(path, 'w', encoding='utf-8') as file:
+            write_catalog(file, number, goods, categories, parameters,
+                          products, seed)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--out', required=True, help='каталог для прайсов')
+    parser.add_argument('--shops', type=int, default=3)
+    parser.add_argument('--goods', type=int, default=1000,
+                        help='позиций в прайсе каждого магазина')
+    parser.add_argument('--products', type=int,
+                        help='товаров в общем наборе (по умолчанию --goods)')
+    parser.add_argument('--categories', type=int, default=50)
+    parser.add_argument('--parameters', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for path in generate(args.out, args.shops, args.goods, args.categories,
+                         args.parameters, args.products, args.seed):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Общие функции нагрузочных тестов: подсчёт перцентилей и сохранение
+результатов в json для сравнения между коммитами
+"""
+import json
+import os
+import subprocess
+from collections import Counter
+from datetime import datetime
+
+ORDERS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, percent):
+    """
+    Перцентиль по ближайшему рангу
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(1, round(percent / 100 * len(values)))
+    return values[rank - 1]
+
+
+def summarize(samples, elapsed):
+    """
+    Итоги сценария по списку (статус, время, число запросов к базе),
+    статус 0 - сервер не ответил.
+    Время в миллисекундах, перцентили - по успешным ответам
+    """
+    latencies = [latency for status, latency, _ in samples
+                 if 0 < status < 400]
+    queries = [count for _, _, count in samples if count is not None]
+    result = {
+        'requests': len(samples),
+        'elapsed': round(elapsed, 3),
+        'requests_per_second': round(len(samples) / elapsed, 1)
+        if elapsed else None,
+        'statuses': {str(status): count for status, count in sorted(
+            Counter(status for status, _, _ in samples).items())},
+    }
+    for percent in (50, 95, 99):
+        value = percentile(latencies, percent)
+        result[f'p{percent}'] = round(value * 1000, 2) \
+            if value is not None else None
+    result['queries_avg'] = round(sum(queries) / len(queries), 2) \
+        if queries else None
+    result['queries_max'] = max(queries) if queries else None
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ORDERS_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path, results):
+    """
+    Записывает результаты с отметкой коммита и времени запуска
+    """
+    results = dict(results, commit=git_commit(),
+                   created_at=datetime.now().isoformat(timespec='seconds'))
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+    return results
+
+
+def compare(baseline, results):
+    """
+    Изменение p50/p95/p99 и числа запросов к базе относительно
+    результатов прошлого запуска, по сценариям
+    """
+    changes = {}
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        changes[name] = {
+            key: (previous[key], current[key])
+            for key in ('p50', 'p95', 'p99', 'queries_avg')
+            if previous.get(key) is not None
+            and current.get(key) is not None
+        }
+    return changes
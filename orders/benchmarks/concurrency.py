@@ -0,0 +1,173 @@
+"""
+Сравнение WSGI и ASGI при большом числе одновременных соединений.
+
+Серверы запускаются отдельно, с одной базой и одинаковым числом
+процессов, например:
+
+    gunicorn orders.wsgi -w 4 --threads 32 -b 127.0.0.1:8000
+    uvicorn orders.asgi:application --workers 4 --port 8001
+
+    python benchmarks/concurrency.py --sync-url http://127.0.0.1:8000 \\
+        --async-url http://127.0.0.1:8001 --connections 1000
+
+Каждое из --connections соединений выполняет --requests запросов
+к маршрутам каталога. --slow-clients соединений одновременно отправляют
+заголовки по байту в течение --slow-seconds секунд, как медленные
+мобильные клиенты. Ограничение частоты анонимных запросов
+(DEFAULT_THROTTLE_RATES['anon']) на время теста нужно поднять, иначе
+большая часть ответов - 429. Клиент не использует сторонних библиотек
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+from benchmarks.common import summarize, save_results
+
+PATHS = ('/api/categories', '/api/shops', '/api/products?shop_id=1')
+
+
+async def read_response(reader):
+    """
+    Читает ответ HTTP/1.1, возвращает статус
+    """
+    status_line = await reader.readline()
+    status = int(status_line.split()[1])
+    length = 0
+    chunked = False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding' and 'chunked' in value:
+            chunked = True
+    if not chunked:
+        await reader.readexactly(length)
+        return status
+    while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        await reader.readexactly(size + 2)
+        if not size:
+            return status
+
+
+def request_bytes(host, path, keep_alive=True):
+    return (f'GET {path} HTTP/1.1\r\nHost: {host}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
+            f'\r\n').encode()
+
+
+async def client(address, host, requests, samples, offset):
+    """
+    Соединение, выполняющее requests запросов подряд
+    """
+    try:
+        reader, writer = await asyncio.open_connection(*address)
+    except OSError:
+        samples.extend((0, 0.0, None) for _ in range(requests))
+        return
+    try:
+        for number in range(requests):
+            path = PATHS[(offset + number) % len(PATHS)]
+            started = time.perf_counter()
+            try:
+                writer.write(request_bytes(host, path))
+                status = await read_response(reader)
+            except (OSError, ValueError, IndexError,
+                    asyncio.IncompleteReadError):
+                samples.extend((0, 0.0, None)
+                               for _ in range(requests - number))
+                return
+            samples.append((status, time.perf_counter() - started, None))
+    finally:
+        writer.close()
+
+
+async def slow_client(address, host, seconds):
+    """
+    Соединение, отправляющее заголовки по байту за seconds секунд
+    """
+    try:
+        reader, writer = await asyncio.open_connection(*address)
+    except OSError:
+        return
+    data = request_bytes(host, PATHS[0], keep_alive=False)
+    try:
+        for byte in range(len(data)):
+            writer.write(data[byte:byte + 1])
+            await asyncio.sleep(seconds / len(data))
+        await read_response(reader)
+    except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def load(url, connections, requests, slow_clients, slow_seconds):
+    parts = urlsplit(url)
+    address = (parts.hostname, parts.port or 80)
+    samples = []
+    slow = [asyncio.ensure_future(slow_client(address, parts.netloc,
+                                              slow_seconds))
+            for _ in range(slow_clients)]
+    # медленные клиенты успевают занять соединения
+    await asyncio.sleep(0.5 if slow_clients else 0)
+    started = time.perf_counter()
+    await asyncio.gather(*(client(address, parts.netloc, requests, samples,
+                                  number)
+                           for number in range(connections)))
+    elapsed = time.perf_counter() - started
+    await asyncio.gather(*slow)
+    return summarize(samples, elapsed)
+
+
+def run(url, args):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(load(
+            url, args.connections, args.requests, args.slow_clients,
+            args.slow_seconds))
+    finally:
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sync-url', help='адрес WSGI-сервера')
+    parser.add_argument('--async-url', help='адрес ASGI-сервера')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=5,
+                        help='запросов на соединение')
+    parser.add_argument('--slow-clients', type=int, default=0)
+    parser.add_argument('--slow-seconds', type=float, default=10)
+    parser.add_argument('--output', help='файл для результатов в json')
+    args = parser.parse_args()
+    if not (args.sync_url or args.async_url):
+        parser.error('нужен --sync-url и/или --async-url')
+
+    scenarios = {}
+    for name, url in (('wsgi', args.sync_url), ('asgi', args.async_url)):
+        if url:
+            scenarios[name] = run(url, args)
+    results = {
+        'parameters': {key: getattr(args, key) for key in (
+            'connections', 'requests', 'slow_clients', 'slow_seconds')},
+        'scenarios': scenarios,
+    }
+    if args.output:
+        results = save_results(args.output, results)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
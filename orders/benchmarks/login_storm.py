@@ -0,0 +1,137 @@
+"""
+Нагрузочный тест входа: одновременный логин множества пользователей,
+как в начале рабочего дня.
+
+Запуск из каталога orders (база из настроек проекта должна быть
+создана миграциями):
+
+    python benchmarks/login_storm.py --users 200 --concurrency 50
+    PASSWORD_HASHER=argon2 python benchmarks/login_storm.py
+    python benchmarks/login_storm.py --url http://localhost:8000/api/user/login
+
+Без --url запросы выполняются в процессе через django.test.Client,
+ограничения частоты запросов (throttling) для входа при этом отключаются.
+Пользователи login-storm-<n>@example.com создаются перед тестом
+и удаляются после него
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'orders.settings')
+
+import django
+
+django.setup()
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import connections
+from django.test import Client
+from django.urls import reverse
+
+from backend.models import User
+from backend.views import LoginAccount
+from benchmarks.common import percentile
+
+PASSWORD = 'storm-Password-2020'
+EMAIL = 'login-storm-{}@example.com'
+
+
+def create_users(count):
+    # один хеш на всех: подготовка не должна занимать минуты
+    password = make_password(PASSWORD)
+    User.objects.filter(email__startswith='login-storm-').delete()
+    User.objects.bulk_create(
+        User(email=EMAIL.format(number), username=EMAIL.format(number),
+             password=password, is_active=True)
+        for number in range(count))
+
+
+def delete_users():
+    User.objects.filter(email__startswith='login-storm-').delete()
+
+
+def make_login(url):
+    if url:
+        from requests import post
+
+        def login(email):
+            response = post(url, data={'email': email, 'password': PASSWORD})
+            return response.status_code
+    else:
+        LoginAccount.throttle_classes = []
+        path = reverse('backend:user-login')
+
+        def login(email):
+            try:
+                response = Client().post(path, {'email': email,
+                                                'password': PASSWORD})
+                return response.status_code
+            finally:
+                connections.close_all()
+    return login
+
+
+def run(users, concurrency, url=None):
+    login = make_login(url)
+
+    def timed(email):
+        started = time.perf_counter()
+        status = login(email)
+        return status, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(
+            timed, [EMAIL.format(number) for number in range(users)]))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for status, latency in results if status == 200]
+    return {
+        'hasher': settings.PASSWORD_HASHERS[0],
+        'users': users,
+        'concurrency': concurrency,
+        'hashing_workers': settings.PASSWORD_HASHING_WORKERS,
+        'hashing_queue': settings.PASSWORD_HASHING_QUEUE,
+        'elapsed': round(elapsed, 3),
+        'logins_per_second': round(len(latencies) / elapsed, 1),
+        'statuses': dict(Counter(status for status, _ in results)),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--url', help='адрес user/login запущенного сервера')
+    parser.add_argument('--json', action='store_true',
+                        help='вывести результат в json')
+    args = parser.parse_args()
+
+    create_users(args.users)
+    try:
+        result = run(args.users, args.concurrency, args.url)
+    finally:
+        delete_users()
+
+    if args.json:
+        print(json.dumps(result))
+        return
+    for key, value in result.items():
+        if isinstance(value, float) and key.startswith('p'):
+            value = f'{value * 1000:.1f} ms'
+        print(f'{key:>18}: {value}')
+
+
+if __name__ == '__main__':
+    main()
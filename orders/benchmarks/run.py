@@ -0,0 +1,368 @@
+"""
+Сценарии нагрузочного теста магазина на синтетическом каталоге:
+импорт прайсов, просмотр каталога, наполнение корзины, оформление
+заказа и лента заказов поставщика.
+
+Запуск из каталога orders (база из настроек проекта должна быть
+создана миграциями):
+
+    python benchmarks/run.py --goods 2000 --output results/local.json
+    python benchmarks/run.py --scenarios import browse --goods 1000000
+    python benchmarks/run.py --baseline results/local.json
+    python benchmarks/run.py --url http://localhost:8000 --token <токен>
+
+Без --url запросы выполняются в процессе через django.test.Client,
+ограничения частоты запросов (throttling) при этом отключаются.
+С --url запросы идут к запущенному серверу с той же базой; число
+запросов к базе берётся из api/metrics/requests по токену
+администратора --token. Импорт всегда выполняется в процессе задачей
+do_import_task, прайсы отдаёт локальный http-сервер.
+
+Пользователи bench-*@example.com и их магазины, заказы и позиции
+создаются сценарием import и удаляются после теста, если не задан
+--keep. Прочие сценарии без import работают с данными, оставленными
+прошлым запуском с --keep
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from random import Random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'orders.settings')
+
+import django
+
+django.setup()
+
+from django.db import connection, connections
+from django.test import Client
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.views import APIView
+
+from backend import metrics
+from backend.models import User, Shop, Contact, Order, ProductInfo
+from backend.tasks import do_import_task
+from benchmarks.catalog import generate, CATEGORY_BASE_ID
+from benchmarks.common import summarize, save_results, compare
+
+SCENARIOS = ('import', 'browse', 'basket', 'checkout', 'partner_feed')
+PARTNER_EMAIL = 'bench-partner-{}@example.com'
+BUYER_EMAIL = 'bench-buyer-{}@example.com'
+
+
+class LocalClient:
+    """
+    Запросы в процессе, число запросов к базе - из метрик
+    RequestMetricsMiddleware
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        metrics.add_listener(self.record)
+
+    def record(self, record):
+        self.local.queries = record.queries
+
+    def request(self, method, path, data=None, token=None):
+        extra = {'HTTP_AUTHORIZATION': f'Token {token}'} if token else {}
+        self.local.queries = None
+        started = time.perf_counter()
+        try:
+            status = getattr(Client(), method)(
+                path, data or {}, **extra).status_code
+        except Exception:
+            # Client передаёт исключения представления, сервер ответил бы 500
+            status = 500
+        finally:
+            connections.close_all()
+        return status, time.perf_counter() - started, self.local.queries
+
+    def route_queries(self):
+        return None
+
+    def close(self):
+        metrics.remove_listener(self.record)
+
+
+class RemoteClient:
+    """
+    Запросы к запущенному серверу
+    """
+
+    def __init__(self, url, token=None):
+        from requests import request
+        self.send = request
+        self.url = url.rstrip('/')
+        self.token = token
+        if token:
+            self.request('delete', reverse('backend:request-metrics'),
+                         token=token)
+
+    def request(self, method, path, data=None, token=None):
+        headers = {'Authorization': f'Token {token}'} if token else {}
+        arguments = {'params' if method == 'get' else 'data': data}
+        started = time.perf_counter()
+        try:
+            status = self.send(method, self.url + path, headers=headers,
+                               **arguments).status_code
+        except OSError:
+            # нет ответа сервера
+            status = 0
+        return status, time.perf_counter() - started, None
+
+    def route_queries(self):
+        """
+        Запросы к базе по маршрутам из метрик сервера
+        """
+        if not self.token:
+            return None
+        response = self.send(
+            'get', self.url + reverse('backend:request-metrics'),
+            headers={'Authorization': f'Token {self.token}'})
+        return {name: {'queries_avg': values['queries_avg'],
+                       'queries_max': values['queries_max']}
+                for name, values in response.json().items()}
+
+    def close(self):
+        pass
+
+
+def disable_throttling():
+    APIView.check_throttles = lambda self, request: None
+
+
+def delete_users():
+    User.objects.filter(email__startswith='bench-').delete()
+
+
+def create_users(email, count, user_type):
+    User.objects.bulk_create(
+        User(email=email.format(number), username=email.format(number),
+             type=user_type, is_active=True)
+        for number in range(1, count + 1))
+    for user in User.objects.filter(
+            email__in=[email.format(number)
+                       for number in range(1, count + 1)]):
+        Token.objects.create(user=user)
+
+
+@contextmanager
+def serve_directory(directory):
+    """
+    http-сервер, отдающий файлы каталога directory, для do_import_task
+    """
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return os.path.join(directory,
+                                os.path.basename(path.split('?')[0]))
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def run_calls(call, arguments, concurrency):
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(lambda args: call(*args), arguments))
+    else:
+        samples = [call(*args) for args in arguments]
+    return samples, time.perf_counter() - started
+
+
+class Benchmark:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.rng = Random(args.seed)
+        if 'import' in args.scenarios:
+            delete_users()
+            create_users(PARTNER_EMAIL, args.shops, 'shop')
+            create_users(BUYER_EMAIL, args.buyers, 'buyer')
+        # без импорта используются данные прошлого запуска с --keep
+        self.partners = list(Token.objects.filter(
+            user__email__startswith='bench-partner-').order_by('user_id'))
+        self.buyers = list(Token.objects.filter(
+            user__email__startswith='bench-buyer-').order_by('user_id'))
+        self.contacts = dict(Contact.objects.filter(
+            user__email__startswith='bench-buyer-'
+        ).values_list('user_id', 'id'))
+        for token in self.buyers:
+            if token.user_id not in self.contacts:
+                self.contacts[token.user_id] = Contact.objects.create(
+                    user_id=token.user_id, city='Москва', street='Тверская',
+                    phone='+70000000000').id
+
+    def product_ids(self):
+        return list(ProductInfo.objects.filter(
+            shop__user__email__startswith='bench-partner-'
+        ).values_list('id', flat=True))
+
+    def import_catalogs(self):
+        """
+        Импорт прайсов задачей do_import_task, по образцу на магазин
+        """
+        samples = []
+        started = time.perf_counter()
+        with tempfile.TemporaryDirectory() as directory:
+            paths = generate(directory, self.args.shops, self.args.goods,
+                             self.args.categories, seed=self.args.seed)
+            with serve_directory(directory) as url:
+                for token, path in zip(self.partners, paths):
+                    record = metrics.RequestRecord()
+                    import_started = time.perf_counter()
+                    with connection.execute_wrapper(record.execute_wrapper):
+                        result = do_import_task(
+                            token.user_id, url + os.path.basename(path))
+                    samples.append((200 if result['Status'] else 500,
+                                    time.perf_counter() - import_started,
+                                    record.queries))
+        elapsed = time.perf_counter() - started
+        result = summarize(samples, elapsed)
+        result['rows_per_second'] = round(
+            self.args.shops * self.args.goods / elapsed, 1)
+        return result
+
+    def browse(self):
+        shop_ids = list(Shop.objects.filter(
+            user__email__startswith='bench-partner-'
+        ).values_list('id', flat=True))
+        paths = (reverse('backend:categories'), reverse('backend:shops'))
+        products = reverse('backend:products')
+        arguments = []
+        for number in range(self.args.requests):
+            if number % 4 < 2:
+                arguments.append(('get', paths[number % 4]))
+                continue
+            arguments.append(('get', products, {
+                'shop_id': self.rng.choice(shop_ids),
+                'category_id': CATEGORY_BASE_ID + self.rng.randrange(
+                    self.args.categories)}))
+        return self.run(arguments)
+
+    def fill_baskets(self):
+        product_ids = self.product_ids()
+        path = reverse('backend:basket')
+        arguments = []
+        for number in range(self.args.requests):
+            items = [{'product_info': product_id, 'quantity': 1}
+                     for product_id in self.rng.sample(
+                         product_ids, min(3, len(product_ids)))]
+            token = self.buyers[number % len(self.buyers)]
+            arguments.append(('post', path, {'items': json.dumps(items)},
+                              token.key))
+        return self.run(arguments)
+
+    def checkout(self):
+        baskets = dict(Order.objects.filter(
+            user__email__startswith='bench-buyer-', state='basket'
+        ).values_list('user_id', 'id'))
+        path = reverse('backend:order')
+        arguments = [
+            ('post', path, {'id': str(baskets[token.user_id]),
+                            'contact': self.contacts[token.user_id]},
+             token.key)
+            for token in self.buyers if token.user_id in baskets]
+        return self.run(arguments)
+
+    def partner_feed(self):
+        path = reverse('backend:partner-orders')
+        arguments = [
+            ('get', path, {'since': 0, 'limit': 50},
+             self.partners[number % len(self.partners)].key)
+            for number in range(self.args.requests)]
+        return self.run(arguments)
+
+    def run(self, arguments):
+        samples, elapsed = run_calls(self.client.request, arguments,
+                                     self.args.concurrency)
+        return summarize(samples, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS,
+                        default=list(SCENARIOS))
+    parser.add_argument('--shops', type=int, default=3)
+    parser.add_argument('--goods', type=int, default=2000,
+                        help='позиций в прайсе каждого магазина')
+    parser.add_argument('--categories', type=int, default=50)
+    parser.add_argument('--buyers', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='запросов в сценарии')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--url', help='адрес запущенного сервера')
+    parser.add_argument('--token', help='токен администратора для --url')
+    parser.add_argument('--output', help='файл для результатов в json')
+    parser.add_argument('--baseline',
+                        help='результаты прошлого запуска для сравнения')
+    parser.add_argument('--keep', action='store_true',
+                        help='не удалять данные теста')
+    args = parser.parse_args()
+
+    if args.url:
+        client = RemoteClient(args.url, args.token)
+    else:
+        disable_throttling()
+        client = LocalClient()
+
+    benchmark = Benchmark(client, args)
+    steps = {'import': benchmark.import_catalogs, 'browse': benchmark.browse,
+             'basket': benchmark.fill_baskets, 'checkout': benchmark.checkout,
+             'partner_feed': benchmark.partner_feed}
+    scenarios = {}
+    try:
+        # порядок сценариев фиксирован: каждый готовит данные следующему
+        for name in SCENARIOS:
+            if name in args.scenarios:
+                scenarios[name] = steps[name]()
+    finally:
+        client.close()
+        if not args.keep:
+            delete_users()
+
+    results = {
+        'mode': 'remote' if args.url else 'local',
+        'database': connection.vendor,
+        'parameters': {key: getattr(args, key) for key in (
+            'shops', 'goods', 'categories', 'buyers', 'requests',
+            'concurrency', 'seed')},
+        'scenarios': scenarios,
+    }
+    route_queries = client.route_queries()
+    if route_queries is not None:
+        results['route_queries'] = route_queries
+    if args.output:
+        results = save_results(args.output, results)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+        for name, changes in compare(baseline, results).items():
+            for key, (previous, current) in changes.items():
+                print(f'{name:>14} {key:>12}: {previous} -> {current}')
+
+
+if __name__ == '__main__':
+    main()
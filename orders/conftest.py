@@ -0,0 +1 @@
+pytest_plugins = ['backend.query_budget']
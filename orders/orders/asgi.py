@@ -0,0 +1,234 @@
+"""
+ASGI config for orders project.
+
+Django 2.2 не поддерживает ASGI и асинхронные представления, поэтому
+приложение - мост к WSGI-обработчику Django:
+
+    uvicorn orders.asgi:application --workers 4
+
+Тело запроса читается и ответ отправляется в цикле событий, так что
+медленные клиенты не занимают потоки. Django выполняется в ограниченных
+пулах потоков: горячие маршруты чтения ASGI_READ_ROUTES (каталог
+и корзина) - в отдельном пуле ASGI_READ_THREADS и не ждут записи,
+импорта и выгрузок, остальные - в пуле ASGI_THREADS. Запрос, который
+не получил поток за ASGI_QUEUE_TIMEOUT секунд, получает ответ 503
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'orders.settings')
+
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+from django.urls import resolve, Resolver404
+
+django_application = get_wsgi_application()
+
+from backend.middleware import BUSY_STATUS
+
+
+class ThreadPool:
+    """
+    Пул потоков с ограниченным числом одновременно выполняемых
+    запросов; ожидающие запросы не занимают потоков
+    """
+
+    def __init__(self, workers, name):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix=name)
+        self.semaphore = None
+
+    async def acquire(self, timeout):
+        # семафор создаётся в цикле событий сервера
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def run(self, func, *args):
+        future = asyncio.get_event_loop().run_in_executor(
+            self.executor, func, *args)
+        future.add_done_callback(lambda _: self.semaphore.release())
+        return future
+
+
+class WSGIBridge:
+    def __init__(self, application, workers, read_workers, read_routes,
+                 queue_timeout, buffer=16):
+        self.application = application
+        self.pool = ThreadPool(workers, 'asgi')
+        self.read_pool = ThreadPool(read_workers, 'asgi-read')
+        self.read_routes = set(read_routes)
+        self.queue_timeout = queue_timeout
+        self.buffer = buffer
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError(f'Тип соединения {scope["type"]} '
+                             f'не поддерживается')
+
+        body = await self.read_body(receive)
+        if body is None:
+            # клиент отключился, не отправив тело: Django не вызывается
+            return
+        pool = self.choose_pool(scope)
+        if not await pool.acquire(self.queue_timeout):
+            return await self.send_busy(send)
+
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(maxsize=self.buffer)
+        disconnected = threading.Event()
+
+        def emit(message):
+            # False - клиент отключился, дальше ответ можно не формировать
+            asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+            return not disconnected.is_set()
+
+        future = pool.run(self.run_wsgi, self.environ(scope, body), emit)
+        while True:
+            message = await queue.get()
+            if message is None:
+                break
+            if disconnected.is_set():
+                # очередь дочитывается, чтобы поток пула не завис
+                continue
+            try:
+                await send(message)
+            except Exception:
+                disconnected.set()
+        await future
+
+    def choose_pool(self, scope):
+        if scope['method'] not in ('GET', 'HEAD'):
+            return self.pool
+        try:
+            view_name = resolve(scope['path']).view_name
+        except Resolver404:
+            return self.pool
+        return self.read_pool if view_name in self.read_routes else self.pool
+
+    def run_wsgi(self, environ, emit):
+        """
+        Выполняет WSGI-приложение в потоке пула и передаёт ответ
+        в цикл событий. Ответ целиком (не потоковый) передаётся одним
+        сообщением, и поток освобождается, не дожидаясь клиента.
+        Потоковый ответ перестаёт читаться, когда клиент отключился
+        """
+        try:
+            response = {}
+
+            def start_response(status, headers, exc_info=None):
+                response['status'] = int(status.split(' ', 1)[0])
+                response['headers'] = [
+                    (name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers]
+
+            result = self.application(environ, start_response)
+            try:
+                emit({'type': 'http.response.start', **response})
+                if not getattr(result, 'streaming', False):
+                    emit({'type': 'http.response.body',
+                          'body': b''.join(result)})
+                    return
+                # потоковый ответ (выгрузки) читается в одном потоке:
+                # курсоры базы привязаны к потоку
+                for chunk in result:
+                    if chunk and not emit({'type': 'http.response.body',
+                                           'body': chunk, 'more_body': True}):
+                        return
+                emit({'type': 'http.response.body'})
+            finally:
+                # request_finished: закрытие соединений с базой этого потока
+                result.close()
+        finally:
+            emit(None)
+
+    @staticmethod
+    async def read_body(receive):
+        """
+        Тело запроса целиком или None, если клиент отключился
+        """
+        body = BytesIO()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        return body.getvalue()
+
+    @staticmethod
+    def environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+                continue
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = f'HTTP_{name}'
+            environ[key] = (f'{environ[key]},{value}' if key in environ
+                            else value)
+        return environ
+
+    @staticmethod
+    async def send_busy(send):
+        await send({'type': 'http.response.start', 'status': 503,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'retry-after', b'1')]})
+        await send({'type': 'http.response.body',
+                    'body': json.dumps(BUSY_STATUS).encode()})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.pool.executor.shutdown(wait=False)
+                self.read_pool.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = WSGIBridge(
+    django_application,
+    workers=settings.ASGI_THREADS,
+    read_workers=settings.ASGI_READ_THREADS,
+    read_routes=settings.ASGI_READ_ROUTES,
+    queue_timeout=settings.ASGI_QUEUE_TIMEOUT,
+)
@@ -48,13 +48,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'backend.middleware.RequestMetricsMiddleware',
+    'backend.middleware.SlowQueryCallerMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'backend.middleware.ReplicaPinMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'backend.middleware.PasswordHashingBusyMiddleware',
 ]
 
 ROOT_URLCONF = 'orders.urls'
@@ -77,17 +81,102 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'orders.wsgi.application'
 
+# ASGI (orders/asgi.py): потоки для Django, отдельные потоки
+# для горячих маршрутов чтения и время ожидания свободного потока
+
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', '32'))
+ASGI_READ_THREADS = int(os.environ.get('ASGI_READ_THREADS', '16'))
+ASGI_READ_ROUTES = [
+    'backend:products',
+    'backend:categories',
+    'backend:shops',
+    'backend:basket',
+]
+ASGI_QUEUE_TIMEOUT = 10
+
 
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# Профиль базы задаётся переменными окружения:
+#   DB_ENGINE=sqlite (по умолчанию) - файл DB_NAME в режиме WAL
+#     с ожиданием блокировки и прагмами SQLITE_PRAGMAS
+#     (backend.database), для локального запуска и тестов;
+#   DB_ENGINE=postgresql - DB_NAME, DB_USER, DB_PASSWORD, DB_HOST,
+#     DB_PORT, постоянные соединения на DB_CONN_MAX_AGE секунд
+#     с проверкой перед каждым запросом (DB_HEALTH_CHECKS).
+# DB_PGBOUNCER=1 - соединение через PgBouncer в режиме transaction
+#   pooling: серверные курсоры отключаются. Выгрузки читают большие
+#   выборки серверными курсорами через отдельное подключение
+#   к PostgreSQL в обход PgBouncer (DB_DIRECT_HOST, DB_DIRECT_PORT)
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+DB_HEALTH_CHECKS = os.environ.get('DB_HEALTH_CHECKS', '1') == '1'
+
+if DB_ENGINE == 'postgresql':
+    DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER') == '1'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'orders'),
+            'USER': os.environ.get('DB_USER', 'orders'),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', 'localhost'),
+            'PORT': os.environ.get('DB_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', '60')),
+            'DISABLE_SERVER_SIDE_CURSORS': DB_PGBOUNCER,
+            'OPTIONS': {'connect_timeout': 5},
+        }
+    }
+    if DB_PGBOUNCER and os.environ.get('DB_DIRECT_HOST'):
+        DATABASES['exports'] = dict(
+            DATABASES['default'],
+            HOST=os.environ['DB_DIRECT_HOST'],
+            PORT=os.environ.get('DB_DIRECT_PORT', '5432'),
+            CONN_MAX_AGE=0,
+            DISABLE_SERVER_SIDE_CURSORS=False,
+            TEST={'MIRROR': 'default'},
+        )
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DB_NAME',
+                                   os.path.join(BASE_DIR, 'db.sqlite3')),
+            'OPTIONS': {
+                # ожидание блокировки записи вместо ошибки database is locked
+                'timeout': int(os.environ.get('DB_BUSY_TIMEOUT', '20')),
+            },
+        }
     }
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64 * 1024,
+    'temp_store': 'MEMORY',
+    'mmap_size': 256 * 1024 * 1024,
 }
 
+# Реплики для чтения (backend.routers): DB_REPLICAS - через запятую
+# хосты PostgreSQL или файлы SQLite (копии основной базы)
+
+for number, replica in enumerate(
+        filter(None, os.environ.get('DB_REPLICAS', '').split(',')), start=1):
+    DATABASES[f'replica{number}'] = dict(
+        DATABASES['default'], TEST={'MIRROR': 'default'},
+        **{'HOST' if DB_ENGINE == 'postgresql' else 'NAME': replica})
+
+DATABASE_REPLICAS = [alias for alias in DATABASES
+                     if alias.startswith('replica')]
+DATABASE_ROUTERS = ['backend.routers.ReplicaRouter']
+REPLICA_PIN_CACHE = 'default'
+REPLICA_PIN_SECONDS = 5
+REPLICA_RETRY_SECONDS = 30
+
+# Подключение для выгрузок (backend.exports)
+EXPORT_DATABASE = 'exports' if 'exports' in DATABASES else 'default'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -108,6 +197,40 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Хеширование паролей: PASSWORD_HASHER - pbkdf2, argon2 (пакет argon2-cffi)
+# или bcrypt (пакет bcrypt). Остальные хешеры нужны для проверки
+# ранее сохранённых паролей, которые пересчитываются при входе
+
+PASSWORD_HASHER = os.environ.get('PASSWORD_HASHER', 'pbkdf2')
+POOLED_PASSWORD_HASHERS = {
+    'pbkdf2': 'backend.hashing.PooledPBKDF2PasswordHasher',
+    'argon2': 'backend.hashing.PooledArgon2PasswordHasher',
+    'bcrypt': 'backend.hashing.PooledBCryptSHA256PasswordHasher',
+}
+PASSWORD_HASHERS = [POOLED_PASSWORD_HASHERS[PASSWORD_HASHER]] + [
+    hasher for name, hasher in POOLED_PASSWORD_HASHERS.items()
+    if name != PASSWORD_HASHER
+] + ['django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher']
+
+# Параметры хешеров (None - значение Django по умолчанию)
+
+PBKDF2_ITERATIONS = None
+ARGON2_TIME_COST = 2
+ARGON2_MEMORY_COST = 512
+ARGON2_PARALLELISM = 2
+BCRYPT_ROUNDS = 12
+
+# Пул хеширования паролей в каждом процессе: не больше
+# PASSWORD_HASHING_WORKERS хешей одновременно и PASSWORD_HASHING_QUEUE
+# ожидающих, ожидание не дольше PASSWORD_HASHING_TIMEOUT секунд.
+# Остальные запросы получают 503 с заголовком Retry-After
+
+PASSWORD_HASHING_WORKERS = os.cpu_count() or 1
+PASSWORD_HASHING_QUEUE = 2 * PASSWORD_HASHING_WORKERS
+PASSWORD_HASHING_TIMEOUT = 3
+PASSWORD_HASHING_RETRY_AFTER = 1
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/2.0/topics/i18n/
 
@@ -127,6 +250,14 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Файлы выгрузок (ExportJob) сохраняются в MEDIA_ROOT/exports
+
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Размер порции строк при чтении больших выборок курсором
+
+EXPORT_CHUNK_SIZE = 2000
+
 # Default user auth model
 
 AUTH_USER_MODEL = "backend.User"
@@ -142,7 +273,7 @@ REST_FRAMEWORK = {
         'rest_framework.renderers.BrowsableAPIRenderer',
     ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'backend.authentication.CachedTokenAuthentication',
     ),
     # Testing settings
     'TEST_REQUEST_DEFAULT_FORMAT': 'json',
@@ -153,16 +284,88 @@ REST_FRAMEWORK = {
     ],
     # DRF Throttling options
     'DEFAULT_THROTTLE_CLASSES': (
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle',
+        'backend.throttling.AnonSlidingWindowThrottle',
+        'backend.throttling.UserSlidingWindowThrottle',
+        'backend.throttling.ScopedSlidingWindowThrottle',
     ),
     'DEFAULT_THROTTLE_RATES': {
         'anon': '20/hour',
         'user': '100/hour',
-        'uploads': '100/day'
+        'uploads': '100/day',
+        'partner_resync': '12/hour'
+    }
+}
+
+# Кэш: в продакшене - общий Redis (REDIS_CACHE_URL, пакет django-redis),
+# локально и в тестах - LocMem в памяти процесса
+
+REDIS_CACHE_URL = os.environ.get('REDIS_CACHE_URL')
+
+if REDIS_CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': REDIS_CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
     }
+
+# Счётчики throttling: общий для всех процессов кэш (Redis)
+
+THROTTLE_CACHE = 'default'
+
+# Бюджет запросов к базе (вместе с SAVEPOINT) на один запрос к маршруту:
+# превышение роняет тесты (плагин backend.query_budget)
+
+QUERY_BUDGETS = {
+    'backend:products': 4,
+    'backend:categories': 3,
+    'backend:shops': 3,
+    'backend:basket': 10,
+    'backend:order': 16,
+    'backend:partner-orders': 12,
 }
 
+# Метрики Prometheus (/metrics): адреса, с которых разрешён сбор,
+# и глубина очередей Celery (запрос к брокеру при каждом сборе).
+# При нескольких процессах задайте переменную окружения
+# prometheus_multiproc_dir
+
+METRICS_ALLOWED_IPS = os.environ.get(
+    'METRICS_ALLOWED_IPS', '127.0.0.1').split(',')
+METRICS_QUEUE_DEPTH = os.environ.get('METRICS_QUEUE_DEPTH', '1') == '1'
+
+# Кэш списков категорий и магазинов (backend.cache): сбрасывается
+# при изменениях, время хранения ограничивает только занимаемую память
+
+CATALOG_CACHE = 'default'
+CATALOG_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Кэш аутентификации по токену: общий кэш и локальный LRU процесса.
+# Отзыв токена в другом процессе виден через AUTH_TOKEN_REVOCATION_CHECK секунд
+
+AUTH_TOKEN_CACHE = 'default'
+AUTH_TOKEN_CACHE_TTL = 60
+AUTH_TOKEN_LOCAL_CACHE_SIZE = 1024
+AUTH_TOKEN_LOCAL_TTL = 5
+AUTH_TOKEN_REVOCATION_CHECK = 1
+
+# Повторы запросов с заголовком Idempotency-Key (корзина и оформление заказа)
+
+IDEMPOTENCY_CACHE = 'default'
+IDEMPOTENCY_TTL = 24 * 60 * 60
+IDEMPOTENCY_LOCK_TIMEOUT = 60
+
+# Лента заказов поставщика (PartnerOrders ?since=<cursor>)
+
+PARTNER_FEED_PAGE_SIZE = 100
+PARTNER_FEED_MAX_PAGE_SIZE = 1000
+
 # Email options
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -177,6 +380,82 @@ EMAIL_PORT = '465'
 EMAIL_USE_SSL = True
 SERVER_EMAIL = EMAIL_HOST_USER
 
+# Письма уходят пачками по EMAIL_BATCH_SIZE через одно SMTP-соединение
+# воркера, которое проверяется NOOP после EMAIL_KEEPALIVE секунд простоя
+
+EMAIL_BATCH_SIZE = 100
+# письма, взятые в отправку упавшим воркером, возвращаются в очередь
+# через EMAIL_CLAIM_TIMEOUT секунд (больше ограничения времени задачи)
+EMAIL_CLAIM_TIMEOUT = 10 * 60
+# один запуск разбора очереди длится не дольше EMAIL_DRAIN_SECONDS
+# (меньше soft_time_limit задачи) и планирует следующий
+EMAIL_DRAIN_SECONDS = 4 * 60
+EMAIL_FLUSH_DELAY = 1
+EMAIL_KEEPALIVE = 30
+EMAIL_TIMEOUT = 30
+
+# Квота почтового провайдера: не более EMAIL_RATE_LIMIT писем,
+# всплеск до EMAIL_RATE_BURST писем подряд. Квота делится между процессами
+# одного воркера очереди email (backend.mail), других воркеров у очереди
+# быть не должно
+
+EMAIL_RATE_LIMIT = '60/m'
+EMAIL_RATE_BURST = 10
+
+# Сводки по заказам для пользователей с включённым order_digest:
+# события копятся ORDER_DIGEST_WINDOW секунд и уходят одним письмом
+
+ORDER_DIGEST_WINDOW = 15 * 60
+
+# Outbox: задачи публикуются в брокер процессом
+# `python manage.py relay_outbox` пачками по OUTBOX_BATCH_SIZE
+
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_POLL_INTERVAL = 1
+OUTBOX_RETENTION = 7 * 24 * 60 * 60
+
+# Журнал медленных запросов к базе (backend.slow_queries): порог в мс
+# (по умолчанию журнал выключен, например SLOW_QUERY_THRESHOLD_MS=100),
+# доля записываемых медленных запросов и число самых медленных запросов,
+# для которых один раз записывается план выполнения. Записываются
+# шаблоны запросов без параметров. Журнал ротируется по размеру
+
+SLOW_QUERY_THRESHOLD_MS = os.environ.get('SLOW_QUERY_THRESHOLD_MS')
+SLOW_QUERY_THRESHOLD_MS = (float(SLOW_QUERY_THRESHOLD_MS)
+                           if SLOW_QUERY_THRESHOLD_MS else None)
+SLOW_QUERY_SAMPLE_RATE = float(os.environ.get('SLOW_QUERY_SAMPLE_RATE', '1'))
+SLOW_QUERY_EXPLAIN_TOP = 20
+SLOW_QUERY_LOG = os.environ.get(
+    'SLOW_QUERY_LOG', os.path.join(BASE_DIR, 'slow_queries.log'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'slow_queries': {
+            'format': '%(asctime)s %(process)d %(message)s',
+        },
+    },
+    'handlers': {
+        'slow_queries': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': SLOW_QUERY_LOG,
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 5,
+            'encoding': 'utf-8',
+            'delay': True,
+            'formatter': 'slow_queries',
+        },
+    },
+    'loggers': {
+        'backend.slow_queries': {
+            'handlers': ['slow_queries'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
+
 try:
     from .settings_local import DEBUG, SECRET_KEY, EMAIL_HOST, \
         EMAIL_HOST_USER, EMAIL_HOST_PASSWORD, EMAIL_PORT, EMAIL_USE_SSL, \
@@ -184,6 +463,9 @@ try:
 except:
     pass
 
+# Получатели накладных по оформленным заказам
+INVOICE_RECIPIENTS = [SERVER_EMAIL]
+
 
 # CELERY STUFF
 BROKER_REDIS_PORT = '6379'
@@ -192,4 +474,38 @@ CELERY_RESULT_BACKEND = f'redis://localhost:{BROKER_REDIS_PORT}'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
-CELERY_TIMEZONE = 'Europe/Moscow'
\ No newline at end of file
+CELERY_TIMEZONE = 'Europe/Moscow'
+
+# Письма, импорт и накладные разбираются отдельными воркерами
+# и не мешают друг другу:
+#   celery -A orders worker -Q email -c 1
+#   celery -A orders worker -Q import
+#   celery -A orders worker -Q invoices -c 1
+#   celery -A orders worker -Q export
+#   celery -A orders worker -Q celery
+CELERY_DEFAULT_QUEUE = 'celery'
+CELERY_ROUTES = {
+    'send_*': {'queue': 'email'},
+    'do_import': {'queue': 'import'},
+    'render_invoices': {'queue': 'invoices'},
+    'export_*': {'queue': 'export'},
+}
+CELERYD_TASK_SOFT_TIME_LIMIT = 5 * 60
+CELERYD_TASK_TIME_LIMIT = 6 * 60
+CELERYD_PREFETCH_MULTIPLIER = 1
+
+# Таймаут загрузки файла прайса при импорте, секунд
+IMPORT_HTTP_TIMEOUT = 60
+
+# Периодический разбор очереди писем на случай, если отложенный
+# разбор не был запланирован
+CELERYBEAT_SCHEDULE = {
+    'send-queued-emails': {
+        'task': 'send_queued_emails',
+        'schedule': 60.0,
+    },
+    'send-order-digests': {
+        'task': 'send_order_digests',
+        'schedule': 60.0,
+    },
+}
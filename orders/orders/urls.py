@@ -2,9 +2,12 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from backend.prometheus import metrics_view
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('backend.urls', namespace='backend')),
+    path('metrics', metrics_view, name='metrics'),
     # path('api-auth/', include('rest_framework.urls'))
 ]